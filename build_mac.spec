@@ -25,6 +25,11 @@ a = Analysis(
         'tkinter',
         'pyarrow',
         'pyarrow.parquet',
+        'pyarrow.compute',
+        'pyarrow.dataset',
+        'pyarrow.feather',
+        'duckdb',
+        'zstandard',
         'pandas.core.api',
         'pandas.core.frame',
         'pandas.core.series',
@@ -9,8 +9,24 @@ import pandas as pd
 from pathlib import Path
 import re
 from datetime import datetime
-import random
 import threading
+import io
+import zlib
+import struct
+import hashlib
+import json
+import shutil
+import ast
+import bisect
+import csv
+import operator
+import gzip
+import zipfile
+import queue
+import sqlite3
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import reduce
 
 
@@ -28,14 +44,156 @@ def resource_path(relative_path):
     return Path.cwd().joinpath(relative_path)
 
 
+# Extensions of the raw pyramid files, plain or compressed
+PYRAMID_FILE_EXTENSIONS = {
+    ".csv": None,
+    ".csv.gz": "gzip",
+    ".csv.zst": "zstd",
+    ".csv.zip": "zip",
+    ".zip": "zip",
+}
+
+
+# Bytes decompressed at a time and decompressed blocks held ahead of the reader
+DECOMPRESSION_BLOCK_BYTES = 4 * 1024**2
+DECOMPRESSION_QUEUE_BLOCKS = 4
+
+
+# This function lists the raw pyramid files of a directory, plain or compressed
+def list_pyramid_files(directory):
+    return sorted(
+        file
+        for file in Path(directory).glob("*")
+        if file.is_file() and file.name.lower().endswith(tuple(PYRAMID_FILE_EXTENSIONS))
+    )
+
+
+# This function returns the dates in the name of a pyramid file
+def pyramid_file_dates(path):
+    return re.findall(r"\d{8}", Path(path).name)
+
+
+# This function finds the compression of a raw pyramid file
+def pyramid_file_compression(path):
+    name = Path(path).name.lower()
+    for extension in sorted(PYRAMID_FILE_EXTENSIONS, key=len, reverse=True):
+        if name.endswith(extension):
+            return PYRAMID_FILE_EXTENSIONS[extension]
+    return None
+
+
+# This class streams the decompressed bytes of a compressed pyramid file
+class DecompressingReader(io.RawIOBase):
+    def __init__(self, path, compression):
+        self.blocks = queue.Queue(maxsize=DECOMPRESSION_QUEUE_BLOCKS)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.error = None
+        self.thread = threading.Thread(target=self.decompress, args=(path, compression), daemon=True)
+        self.thread.start()
+
+    # Function used to open the decompressed stream of the file
+    def open_stream(self, path, compression):
+        if compression == "gzip":
+            return gzip.open(path, "rb")
+        if compression == "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        archive = zipfile.ZipFile(path)
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        # An archive holds one pyramid file, the CSV when there are other members
+        member = next((info for info in members if info.filename.lower().endswith(".csv")), members[0] if members else None)
+        if member is None:
+            archive.close()
+            raise ValueError(f"{Path(path).name} is an empty archive")
+        stream = archive.open(member)
+        stream_close = stream.close
+
+        # Function used to close the archive with its member
+        def close():
+            stream_close()
+            archive.close()
+
+        stream.close = close
+        return stream
+
+    # Function used to hand a block to the reader unless it has been closed
+    def put(self, block):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Function run by the background thread
+    def decompress(self, path, compression):
+        try:
+            with self.open_stream(path, compression) as stream:
+                while True:
+                    block = stream.read(DECOMPRESSION_BLOCK_BYTES)
+                    if not block or not self.put(block):
+                        break
+        except Exception as e:
+            self.error = e
+        self.put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.pending):
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+
+# This function opens a raw pyramid file for reading as bytes
+def open_pyramid_file(path):
+    compression = pyramid_file_compression(path)
+    if compression is None:
+        return open(path, "rb")
+    return io.BufferedReader(DecompressingReader(path, compression), buffer_size=DECOMPRESSION_BLOCK_BYTES)
+
+
+# Floats are parsed round-trip exact, as DuckDB parses them
+PYRAMID_FLOAT_PRECISION = "round_trip"
+
+
+# This function reads a raw pyramid file like pandas.read_csv
+def read_pyramid_csv(path, **kwargs):
+    kwargs.setdefault("float_precision", PYRAMID_FLOAT_PRECISION)
+    if pyramid_file_compression(path) is None:
+        return pd.read_csv(path, **kwargs)
+    with open_pyramid_file(path) as f:
+        return pd.read_csv(f, **kwargs)
+
+
 # This function pulls all of the individual and household IDs
 def indiv_id_finder(config, progress_bar, warning_window):
     individuals = pd.DataFrame(columns=["HH_ID", "MEM_ID"])
     for pyramid_type in ["PEOPLE_WAVES_LOCATION", "INDIV_INC_MONTHLY_LOCATION"]:
-        pyramid_files = list(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type]).glob("*.csv"))
-        progress_value = 50 / len(pyramid_files)
+        pyramid_files = list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type]))
+        progress_value = 30 / len(pyramid_files)
         for file in pyramid_files:
-            pyramid = pd.read_csv(
+            pyramid = read_pyramid_csv(
                 file,
                 usecols=["HH_ID", "MEM_ID"],
             ).astype(str)
@@ -57,11 +215,11 @@ def variable_finder(config):
         "INDIV_INC_MONTHLY",
         "PEOPLE_WAVES",
     ]:
-        pyramid_files = list(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]).glob("*.csv"))
+        pyramid_files = list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]))
         unique_variables = {
             var
             for file in pyramid_files
-            for var in pd.read_csv(Path(file), nrows=0).columns
+            for var in read_pyramid_csv(Path(file), nrows=0).columns
         }
         pyramid_variables[pyramid_type] = sorted(list(unique_variables))
 
@@ -78,10 +236,34 @@ def reinitializer(config, progress_bar, warning_window):
         messagebox.showerror("Error", "Data directory does not exist.")
         return 1
 
+    # Corrupt files are caught before the slower steps try to parse them
+    progress_start = progress_bar["value"]
+
+    def scan_progress(done, total):
+        progress_bar["value"] = progress_start + 10 * done / max(total, 1)
+        warning_window.update()
+
+    report = integrity_scan(config, scan_progress)
+    with open(resource_path("pyramid_integrity_report.txt"), "w") as f:
+        f.write(integrity_report_text(report))
+    # Problems are reported, and only stop the reinitialization when asked to
+    if report["problems"]:
+        problems_text = (
+            f"{len(report['problems'])} problems found in the pyramid files:\n\n"
+            + "\n".join(report["problems"][:10])
+            + "\n\nSee pyramid_integrity_report.txt for the full report."
+        )
+        if config.get("INTEGRITY_STOP_ON_PROBLEMS", False):
+            messagebox.showerror("Error", problems_text)
+            return 1
+        messagebox.showwarning("Warning", problems_text)
+
     individuals = indiv_id_finder(config, progress_bar, warning_window)
+    presence_index_builder(config, progress_bar, warning_window)
+    file_index_builder(config, progress_bar, warning_window)
     pyramid_variables = variable_finder(config)
-    individual_monthly_pyramids = [str(path) for path in Path(config["DATA_DIRECTORY"]).joinpath(config["INDIV_INC_MONTHLY_LOCATION"]).glob("*.csv")]
-    all_pyramid_dates = [re.findall(r"\d+", s) for s in individual_monthly_pyramids]
+    individual_monthly_pyramids = list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config["INDIV_INC_MONTHLY_LOCATION"]))
+    all_pyramid_dates = [pyramid_file_dates(path) for path in individual_monthly_pyramids]
     pyramid_dates = [sublist[-1] if sublist else None for sublist in all_pyramid_dates]
 
     config["MIN_SAMPLE_DATE"] = datetime.strptime(
@@ -97,6 +279,7 @@ def reinitializer(config, progress_bar, warning_window):
     config["INITIALIZATION_DATE"] = datetime.now().strftime("%m-%d-%Y")
 
     individuals.to_csv(Path(resource_path("pyramid_ids.csv")), index=False)
+    save_id_registry(individuals)
     with Path(resource_path("pyramid_variables.yaml")).open("w") as f:
         yaml.dump(pyramid_variables, f)
     with open(resource_path("config.yaml"), "w") as f:
@@ -104,6 +287,2073 @@ def reinitializer(config, progress_bar, warning_window):
     return
 
 
+# Version of the sampling algorithm, recorded in the build log
+SAMPLING_ALGORITHM = "pcg64-raw-keys-v1"
+
+
+# This function builds the integer key of an individual
+def individual_keys(hh_ids, mem_ids):
+    return np.asarray(hh_ids, dtype="int64") * 100 + np.asarray(mem_ids, dtype="int64")
+
+
+# This function saves the sorted integer ID registry used for sampling
+def save_id_registry(individuals):
+    np.savez(
+        resource_path("pyramid_ids.npz"),
+        households=np.unique(individuals["HH_ID"].astype("int64")),
+        individuals=np.unique(individual_keys(individuals["HH_ID"], individuals["MEM_ID"])),
+    )
+
+
+# This function loads the sorted IDs of the ID registry
+def load_id_registry():
+    registry_path = Path(resource_path("pyramid_ids.npz"))
+    if registry_path.exists():
+        with np.load(registry_path) as registry:
+            return registry["households"], registry["individuals"]
+    pyramid_ids = pd.read_csv(resource_path("pyramid_ids.csv"), dtype="int64")
+    return (
+        np.unique(pyramid_ids["HH_ID"].to_numpy()),
+        np.unique(individual_keys(pyramid_ids["HH_ID"], pyramid_ids["MEM_ID"])),
+    )
+
+
+# This function splits n draws across strata in proportion to their sizes
+def proportional_allocation(stratum_sizes, n):
+    if stratum_sizes.sum() == 0:
+        return np.zeros(len(stratum_sizes), dtype="int64")
+    quotas = stratum_sizes * n / stratum_sizes.sum()
+    allocation = np.floor(quotas).astype("int64")
+    remainder = n - allocation.sum()
+    allocation[np.argsort(allocation - quotas, kind="stable")[:remainder]] += 1
+    return allocation
+
+
+# This function draws n IDs without replacement from a sorted registry
+def sample_ids(registry, n, seed, strata=None, eligible=None):
+    # The smallest raw PCG64 draws are kept, stable across numpy versions
+    keys = np.random.PCG64(seed).random_raw(len(registry))
+    candidates = np.arange(len(registry)) if eligible is None else np.flatnonzero(eligible)
+    n = min(int(n), len(candidates))
+    if strata is None:
+        if n < len(candidates):
+            chosen = candidates[np.argpartition(keys[candidates], n - 1)[:n]]
+        else:
+            chosen = candidates
+    else:
+        # Keeping the smallest draws of each stratum up to its allocation
+        codes = strata[candidates]
+        allocation = proportional_allocation(np.bincount(codes), n)
+        order = np.lexsort((keys[candidates], codes))
+        sorted_codes = codes[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+        chosen = candidates[order[rank < allocation[sorted_codes]]]
+    return np.sort(registry[chosen])
+
+
+# Household attributes that can be used to stratify samples
+STRATA_VARIABLES = ["STATE", "REGION_TYPE"]
+
+
+# This function builds the presence index of strata and waves
+def presence_index_builder(config, progress_bar, warning_window):
+    pyramid_files = sorted(
+        list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config["PEOPLE_WAVES_LOCATION"])),
+        key=pyramid_file_dates,
+    )
+    progress_value = 15 / max(len(pyramid_files), 1)
+    wave_starts = []
+    wave_ends = []
+    people = []
+    for wave, file in enumerate(pyramid_files):
+        wave_dates = pyramid_file_dates(file)
+        wave_starts.append(int(wave_dates[0]))
+        wave_ends.append(int(wave_dates[-1]))
+        available_vars = read_pyramid_csv(file, nrows=0).columns
+        wave_people = read_pyramid_csv(
+            file,
+            usecols=[var for var in ["HH_ID", "MEM_ID"] + STRATA_VARIABLES if var in available_vars],
+            dtype={var: "category" for var in STRATA_VARIABLES},
+        ).drop_duplicates()
+        wave_people["WAVE"] = wave
+        people.append(wave_people)
+        progress_bar["value"] = progress_bar["value"] + progress_value
+        warning_window.update()
+    people = pd.concat(people, axis=0, ignore_index=True)
+
+    # Bitmaps of the waves in which each household and individual were surveyed
+    households = np.unique(people["HH_ID"].astype("int64"))
+    individuals = np.unique(individual_keys(people["HH_ID"], people["MEM_ID"]))
+    household_waves = np.zeros((len(households), len(pyramid_files)), dtype=bool)
+    household_waves[
+        np.searchsorted(households, people["HH_ID"].astype("int64")), people["WAVE"]
+    ] = True
+    individual_waves = np.zeros((len(individuals), len(pyramid_files)), dtype=bool)
+    individual_waves[
+        np.searchsorted(individuals, individual_keys(people["HH_ID"], people["MEM_ID"])),
+        people["WAVE"],
+    ] = True
+    index = {
+        "wave_starts": np.array(wave_starts, dtype="int64"),
+        "wave_ends": np.array(wave_ends, dtype="int64"),
+        "households": households,
+        "household_waves": np.packbits(household_waves, axis=1),
+        "individuals": individuals,
+        "individual_waves": np.packbits(individual_waves, axis=1),
+    }
+
+    # Strata attributes come from the latest wave of each household
+    latest = people.drop_duplicates("HH_ID", keep="last").sort_values("HH_ID")
+    for var in STRATA_VARIABLES:
+        values = latest[var].astype(str) if var in latest.columns else pd.Series("", index=latest.index)
+        codes, labels = pd.factorize(values.fillna(""), sort=True)
+        index[f"household_{var.lower()}"] = codes.astype("int32")
+        index[f"{var.lower()}_labels"] = np.asarray(labels, dtype=str)
+
+    np.savez(resource_path("pyramid_index.npz"), **index)
+    return
+
+
+# This function loads the presence index, None when it is not built
+def load_presence_index():
+    index_path = Path(resource_path("pyramid_index.npz"))
+    if not index_path.exists():
+        return None
+    with np.load(index_path) as index:
+        return {key: index[key] for key in index.files}
+
+
+# Bytes of text a compressed pyramid file holds per byte on disk, roughly
+COMPRESSED_PYRAMID_EXPANSION = 5
+
+# Rows read to type the columns of an unsampled pyramid file
+EMPTY_PYRAMID_SNIFF_ROWS = 1000
+
+
+# Bytes read at a time when scanning a pyramid file for the start of each row
+ROW_INDEX_BLOCK_BYTES = 64 * 1024**2
+
+
+# This function finds the byte range of every line of a file
+def line_offsets(file):
+    starts = [np.zeros(1, dtype="int64")]
+    position = 0
+    with open(file, "rb") as f:
+        while True:
+            block = f.read(ROW_INDEX_BLOCK_BYTES)
+            if not block:
+                break
+            starts.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10) + position + 1)
+            position += len(block)
+    starts = np.concatenate(starts)
+    # A trailing newline does not start another line
+    if len(starts) > 1 and starts[-1] == position:
+        starts = starts[:-1]
+    return starts, np.append(starts[1:], position)
+
+
+# This function combines the column types of the chunks of a file
+def combined_dtype(dtypes):
+    unique = set(dtypes)
+    if len(unique) == 1:
+        return unique.pop()
+    non_numeric = unique - {"int64", "float64"}
+    if not non_numeric:
+        return "float64"
+    # Chunks where a text column is entirely missing are read as floats
+    if len(non_numeric) == 1 and unique - non_numeric <= {"float64"} and "bool" not in non_numeric:
+        return non_numeric.pop()
+    return "object"
+
+
+# This function builds the byte-offset row index of a pyramid file
+def row_index_builder(file, dtypes=None):
+    households = pd.read_csv(file, usecols=["HH_ID"])["HH_ID"].to_numpy("int64")
+    starts, ends = line_offsets(file)
+    # Files where lines and rows do not line up cannot be indexed
+    if len(starts) - 1 != len(households):
+        return households, None
+    # Consecutive rows of the same household are stored as one byte range
+    run_first = np.flatnonzero(np.diff(households, prepend=-1) != 0)
+    run_last = np.append(run_first[1:], len(households)) - 1
+    order = np.lexsort((run_first, households[run_first]))
+    return households, {
+        "households": households[run_first][order],
+        "starts": starts[1:][run_first][order],
+        "ends": ends[1:][run_last][order],
+        "header_end": int(ends[0]),
+        "dtypes": dtypes or {},
+    }
+
+
+# This function builds the index of the households in each pyramid file
+def file_index_builder(config, progress_bar, warning_window):
+    pyramid_files = [
+        file
+        for pyramid_type in [
+            "ASPIRATIONAL_WAVES",
+            "CONSUMPTION_MONTHLY",
+            "CONSUMPTION_WAVES",
+            "HH_INC_MONTHLY",
+            "INDIV_INC_MONTHLY",
+            "PEOPLE_WAVES",
+        ]
+        for file in list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]))
+    ]
+    progress_value = 15 / max(len(pyramid_files), 1)
+    file_ids = []
+    file_stats = []
+    row_indexes = []
+    file_profiles = load_variable_profiles()
+    for file in pyramid_files:
+        # Size and modification time detect files changed after indexing
+        file_stats.append(os.stat(file))
+        # Copying raw files into the columnar store
+        store_path = columnar_store_path(file)
+        if store_path is not None and columnar_store_file(file) is None:
+            write_columnar_store(file, store_path)
+        # Compressed files cannot be seeked to, so they get no row index
+        if config.get("ROW_INDEX") and pyramid_file_compression(file) is None:
+            households, row_index = row_index_builder(file, pyramid_file_dtypes(file, None, file_profiles))
+        else:
+            households = read_pyramid_csv(file, usecols=["HH_ID"])["HH_ID"].to_numpy("int64")
+            row_index = None
+        file_ids.append(np.unique(households))
+        row_indexes.append(row_index)
+        progress_bar["value"] = progress_bar["value"] + progress_value
+        warning_window.update()
+    # The arrays of every file are stored back to back, split by the offsets
+    runs = [row_index or {} for row_index in row_indexes]
+    empty = np.array([], dtype="int64")
+    np.savez(
+        resource_path("pyramid_file_index.npz"),
+        paths=np.array([str(file.resolve()) for file in pyramid_files], dtype=str),
+        sizes=np.array([stat.st_size for stat in file_stats], dtype="int64"),
+        mtimes=np.array([stat.st_mtime_ns for stat in file_stats], dtype="int64"),
+        offsets=np.cumsum([0] + [len(ids) for ids in file_ids]).astype("int64"),
+        households=np.concatenate(file_ids) if file_ids else empty,
+        row_indexed=np.array([row_index is not None for row_index in row_indexes], dtype=bool),
+        run_offsets=np.cumsum([0] + [len(run.get("households", empty)) for run in runs]).astype("int64"),
+        run_households=np.concatenate([run.get("households", empty) for run in runs] + [empty]),
+        run_starts=np.concatenate([run.get("starts", empty) for run in runs] + [empty]),
+        run_ends=np.concatenate([run.get("ends", empty) for run in runs] + [empty]),
+        header_ends=np.array([run.get("header_end", 0) for run in runs], dtype="int64"),
+        dtypes=np.array([json.dumps(run.get("dtypes", {})) for run in runs], dtype=str),
+    )
+    return
+
+
+# This function loads the index entry of each pyramid file
+def load_file_index():
+    index_path = Path(resource_path("pyramid_file_index.npz"))
+    if not index_path.exists():
+        return {}
+    with np.load(index_path) as index:
+        index = {key: index[key] for key in index.files}
+    file_index = {}
+    for i, path in enumerate(index["paths"].tolist()):
+        entry = {
+            "size": int(index["sizes"][i]),
+            "mtime": int(index["mtimes"][i]),
+            "households": index["households"][index["offsets"][i] : index["offsets"][i + 1]],
+            "runs": None,
+        }
+        # Indexes built before row indexing existed only hold the households
+        if "row_indexed" in index and index["row_indexed"][i]:
+            runs = slice(index["run_offsets"][i], index["run_offsets"][i + 1])
+            entry["runs"] = (
+                index["run_households"][runs],
+                index["run_starts"][runs],
+                index["run_ends"][runs],
+            )
+            entry["header_end"] = int(index["header_ends"][i])
+            entry["dtypes"] = json.loads(index["dtypes"][i])
+        file_index[path] = entry
+    return file_index
+
+
+# This function finds the index entry of an unchanged pyramid file
+def file_index_entry(file_index, path):
+    entry = file_index.get(str(Path(path).resolve()))
+    if entry is None:
+        return None
+    stat = os.stat(path)
+    if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime"]:
+        return None
+    return entry
+
+
+# This function checks whether a pyramid file may hold the households
+def file_has_households(file_index, path, households):
+    entry = file_index_entry(file_index, path)
+    # Files that are not indexed or have changed have to be read
+    if entry is None:
+        return True
+    _, found = index_positions(entry["households"], households)
+    return bool(found.any())
+
+
+# Column of the columnar store holding each row's position in the raw file
+COLUMNAR_ROW_COLUMN = "__cpm_row__"
+
+
+# This function finds where the columnar copy of a pyramid file is kept
+def columnar_store_path(path):
+    store_directory = config.get("COLUMNAR_STORE_DIRECTORY")
+    if not store_directory:
+        return None
+    try:
+        relative_path = Path(path).resolve().relative_to(Path(config["DATA_DIRECTORY"]).resolve())
+    except ValueError:
+        return None
+    return Path(store_directory).joinpath(relative_path).with_suffix(".parquet")
+
+
+# This function writes the columnar copy of a raw pyramid file
+def write_columnar_store(file, store_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pyramid = read_pyramid_csv(file)
+    # Keeping the raw row order
+    pyramid[COLUMNAR_ROW_COLUMN] = np.arange(len(pyramid), dtype="int64")
+    keys = ["HH_ID", "MEM_ID"] if "MEM_ID" in pyramid.columns else ["HH_ID"]
+    pyramid = pyramid.sort_values(keys, kind="stable")
+    table = pa.Table.from_pandas(pyramid, preserve_index=False)
+    # Size and modification time detect raw files changed after the copy
+    stat = os.stat(file)
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            b"cpm_source_size": str(stat.st_size).encode(),
+            b"cpm_source_mtime": str(stat.st_mtime_ns).encode(),
+        }
+    )
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = store_path.with_suffix(".parquet.tmp")
+    pq.write_table(
+        table,
+        temporary_path,
+        row_group_size=config.get("COLUMNAR_STORE_ROW_GROUP_ROWS", 10000),
+        write_statistics=True,
+    )
+    os.replace(temporary_path, store_path)
+
+
+# This function opens the up-to-date columnar copy of a pyramid file
+def columnar_store_file(path):
+    store_path = columnar_store_path(path)
+    if store_path is None or not store_path.exists():
+        return None
+    import pyarrow.parquet as pq
+
+    store_file = pq.ParquetFile(store_path)
+    metadata = store_file.schema_arrow.metadata or {}
+    stat = os.stat(path)
+    if metadata.get(b"cpm_source_size") != str(stat.st_size).encode() or metadata.get(
+        b"cpm_source_mtime"
+    ) != str(stat.st_mtime_ns).encode():
+        return None
+    return store_file
+
+
+# This function reads the rows of the given households from the columnar store
+def read_columnar_store(store_file, usecols, households, pushdown=None):
+    hh_column = store_file.schema_arrow.get_field_index("HH_ID")
+    row_groups = []
+    for i in range(store_file.metadata.num_row_groups):
+        statistics = store_file.metadata.row_group(i).column(hh_column).statistics
+        if households is None or statistics is None or not statistics.has_min_max:
+            row_groups.append(i)
+        elif np.searchsorted(households, statistics.max, side="right") > np.searchsorted(
+            households, statistics.min, side="left"
+        ):
+            row_groups.append(i)
+    columns = list(usecols) + [COLUMNAR_ROW_COLUMN]
+    if row_groups:
+        table = store_file.read_row_groups(row_groups, columns=columns)
+    else:
+        table = store_file.schema_arrow.empty_table().select(columns)
+    # Row filters are applied to the Arrow table, before its rows are converted
+    if pushdown is not None:
+        table = table.filter(pushdown.arrow_expression())
+    pyramid = table.to_pandas()
+    if households is not None:
+        pyramid = pyramid[pyramid["HH_ID"].isin(households)]
+    return (
+        pyramid.sort_values(COLUMNAR_ROW_COLUMN)[list(usecols)]
+        .reset_index(drop=True)
+    )
+
+
+# This function names how a pyramid file will be read for the given households
+def pyramid_read_method(path, households=None, file_index=None):
+    if households is None:
+        return "full scan"
+    if columnar_store_file(path) is not None:
+        return "columnar store"
+    if row_index_ranges(file_index, path, households) is not None:
+        return "row index"
+    return "full scan"
+
+
+# This function finds the byte ranges holding the given households
+def row_index_ranges(file_index, path, households):
+    entry = file_index_entry(file_index, path) if households is not None and file_index else None
+    if entry is None or entry["runs"] is None:
+        return None
+    run_households, run_starts, run_ends = entry["runs"]
+    _, found = index_positions(households, run_households)
+    starts = np.sort(run_starts[found])
+    ends = np.sort(run_ends[found])
+    # Larger samples are faster to read with a full scan
+    if (ends - starts).sum() > config.get("ROW_INDEX_MAX_FRACTION", 0.05) * entry["size"]:
+        return None
+    # Adjacent byte ranges are read together
+    if len(starts):
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        starts = starts[np.append(0, breaks)]
+        ends = ends[np.append(breaks - 1, len(ends) - 1)]
+    return entry, starts, ends
+
+
+# This function reads the selected columns of a pyramid file
+def read_pyramid_file(path, usecols, households=None, file_index=None, nrows=None, chunk_rows=None, row_filter=None, pushdown=None):
+    # Reading only the row groups that can hold the households and pass the filters
+    if (households is not None or pushdown is not None) and nrows is None:
+        store_file = columnar_store_file(path)
+        if store_file is not None:
+            return read_columnar_store(store_file, usecols, households, pushdown)
+    ranges = row_index_ranges(file_index, path, households)
+    if ranges is not None:
+        entry, starts, ends = ranges
+        buffer = io.BytesIO()
+        with open(path, "rb") as f:
+            buffer.write(f.read(entry["header_end"]))
+            for start, end in zip(starts, ends):
+                f.seek(start)
+                buffer.write(f.read(end - start))
+        # The last row of a file may not end with a newline
+        if not buffer.getvalue().endswith(b"\n"):
+            buffer.write(b"\n")
+        buffer.seek(0)
+        try:
+            return pd.read_csv(
+                buffer,
+                usecols=usecols,
+                dtype={col: entry["dtypes"][col] for col in usecols if col in entry["dtypes"]},
+                float_precision=PYRAMID_FLOAT_PRECISION,
+            )
+        except (ValueError, TypeError):
+            # Rows not matching the file's types are read with a full scan
+            pass
+    # Chunked reads only keep the rows passing the filter of each chunk in memory
+    if chunk_rows and nrows is None:
+        with open_pyramid_file(path) as f:
+            chunks = [
+                row_filter(chunk) if row_filter else chunk
+                for chunk in pd.read_csv(
+                    f, usecols=usecols, chunksize=int(chunk_rows), float_precision=PYRAMID_FLOAT_PRECISION
+                )
+            ]
+        if chunks:
+            return pd.concat(chunks)
+    return read_pyramid_csv(path, usecols=usecols, nrows=nrows)
+
+
+# This function finds the positions of values in a sorted ID array
+def index_positions(ids, values):
+    if len(ids) == 0:
+        return np.zeros(len(values), dtype="int64"), np.zeros(len(values), dtype=bool)
+    position = np.searchsorted(ids, values).clip(max=len(ids) - 1)
+    return position, ids[position] == values
+
+
+# This function looks up the strata and panel eligibility of IDs
+def sampling_frame(index, level, registry, start_month, end_month, strata_vars, balanced_panel):
+    strata = None
+    if strata_vars:
+        # Individuals are stratified by the attributes of their households
+        household_position, household_found = index_positions(
+            index["households"], registry if level == "households" else registry // 100
+        )
+        strata = np.zeros(len(registry), dtype="int64")
+        for var in strata_vars:
+            # Households missing from the index are placed in a stratum of their own
+            labels = index[f"{var.lower()}_labels"]
+            codes = index[f"household_{var.lower()}"]
+            strata = strata * (len(labels) + 1) + np.where(
+                household_found, codes[household_position] if len(codes) else 0, len(labels)
+            )
+    eligible = None
+    if balanced_panel:
+        # A balanced panel keeps the IDs surveyed in every wave of the range
+        waves = (index["wave_starts"] <= int(end_month.strftime("%Y%m%d"))) & (
+            index["wave_ends"] >= int(start_month.strftime("%Y%m%d"))
+        )
+        bitmap = np.unpackbits(
+            index["household_waves" if level == "households" else "individual_waves"],
+            axis=1,
+            count=len(waves),
+        ).astype(bool)
+        position, found = index_positions(index[level], registry)
+        eligible = found
+        if len(bitmap):
+            eligible = found & bitmap[position][:, waves].all(axis=1)
+    return strata, eligible
+
+
+# This function draws a random sample of households or individuals
+def draw_sample(sample_type, n, random_seed, start_date, end_date, sample_strata=None, balanced_panel=False):
+    registry_households, registry_individuals = load_id_registry()
+    registry = registry_households if sample_type == "households" else registry_individuals
+    # Stratified and panel designs are drawn from the presence index
+    strata, eligible = None, None
+    if sample_strata or balanced_panel:
+        presence_index = load_presence_index()
+        if presence_index is None:
+            return None, None
+        strata, eligible = sampling_frame(
+            presence_index,
+            sample_type,
+            registry,
+            datetime.strptime(start_date, "%m-%Y"),
+            datetime.strptime(end_date, "%m-%Y"),
+            sample_strata,
+            balanced_panel,
+        )
+    return sample_ids(registry, n, random_seed, strata, eligible), eligible
+
+
+# Smallest memory limit a memory budget gives DuckDB, in GB
+DUCKDB_MIN_MEMORY_LIMIT_GB = 0.5
+
+
+# This function opens an in-process DuckDB connection
+def duckdb_connect(temp_directory):
+    import duckdb
+
+    con = duckdb.connect(database=":memory:")
+    memory_limit = config.get("DUCKDB_MEMORY_LIMIT_GB")
+    threads = config.get("DUCKDB_THREADS")
+    # DuckDB spills before the build reaches the soft memory limit, but keeps enough memory to read a file
+    if config.get("MEMORY_BUDGET_GB"):
+        budget_limit = max(
+            float(config["MEMORY_BUDGET_GB"]) * float(config.get("MEMORY_SOFT_LIMIT", 0.8)),
+            DUCKDB_MIN_MEMORY_LIMIT_GB,
+        )
+        memory_limit = min(float(memory_limit), budget_limit) if memory_limit else budget_limit
+    # Anything beyond the memory limit is spilled to the temporary directory
+    con.execute(f"SET temp_directory = '{Path(temp_directory).as_posix()}'")
+    con.execute("SET preserve_insertion_order = true")
+    if memory_limit:
+        con.execute(f"SET memory_limit = '{float(memory_limit)}GB'")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    return con
+
+
+# This function quotes a column name for use in a DuckDB query
+def duckdb_quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+# This function plans one month of pyramids as a single DuckDB query
+def duckdb_month_query(month_files, sample_type=None, skipped_types=(), seek_frames=None, pushdown=None, row_filter=None):
+    # Reading each pyramid with only the needed columns and sampled rows
+    relations = []
+    ctes = []
+    for i, (pyramid_type, (path, vars_to_load)) in enumerate(month_files.items()):
+        name = f"p{i}"
+        select_list = ", ".join(duckdb_quote(col) for col in vars_to_load)
+        where = ""
+        if sample_type == "households":
+            where = "WHERE HH_ID IN (SELECT HH_ID FROM sampled_households)"
+        elif sample_type == "individuals":
+            if "MEM_ID" in vars_to_load:
+                where = "WHERE HH_ID * 100 + MEM_ID IN (SELECT ID FROM sampled_individuals)"
+            else:
+                where = "WHERE HH_ID IN (SELECT DISTINCT ID // 100 FROM sampled_individuals)"
+        # Row filters that the pyramid's rows decide are applied in its scan
+        if pushdown and pyramid_type in pushdown:
+            where = (where + " AND " if where else "WHERE ") + pushdown[pyramid_type].sql(vars_to_load)
+        path_literal = "'" + Path(path).as_posix().replace("'", "''") + "'"
+        # Files holding none of the sampled IDs only contribute their columns
+        sample_size = -1
+        if pyramid_type in skipped_types:
+            sample_size = EMPTY_PYRAMID_SNIFF_ROWS
+            where = "LIMIT 0"
+        source = (
+            f"read_csv({path_literal}, header = true, sample_size = {sample_size}, "
+            "auto_type_candidates = ['BIGINT', 'DOUBLE', 'VARCHAR'])"
+        )
+        # Rows read through the row index are already registered as a frame
+        if seek_frames and pyramid_type in seek_frames:
+            source = seek_frames[pyramid_type]
+        ctes.append(f"{name} AS (SELECT {select_list} FROM {source} {where})")
+        relations.append((pyramid_type, name, list(vars_to_load)))
+
+    # Function to merge two relations the way merge_with_duplicate_handling does
+    def merge(left, right, on):
+        left_name, left_cols = left
+        right_name, right_cols = right
+        name = f"m{len(ctes)}"
+        select_list = []
+        for col in left_cols:
+            if col in on:
+                select_list.append(
+                    f"COALESCE(l.{duckdb_quote(col)}, r.{duckdb_quote(col)}) AS {duckdb_quote(col)}"
+                )
+            else:
+                select_list.append(f"l.{duckdb_quote(col)}")
+        new_cols = [col for col in right_cols if col not in left_cols]
+        select_list += [f"r.{duckdb_quote(col)}" for col in new_cols]
+        condition = " AND ".join(f"l.{duckdb_quote(col)} = r.{duckdb_quote(col)}" for col in on)
+        ctes.append(
+            f"{name} AS (SELECT {', '.join(select_list)} FROM {left_name} l "
+            f"FULL OUTER JOIN {right_name} r ON {condition})"
+        )
+        return name, left_cols + new_cols
+
+    # Separate individual and household level pyramids
+    individual = [
+        (name, cols)
+        for ptype, name, cols in relations
+        if ptype in ["INDIV_INC_MONTHLY", "PEOPLE_WAVES"]
+    ]
+    household = [
+        (name, cols)
+        for ptype, name, cols in relations
+        if ptype not in ["INDIV_INC_MONTHLY", "PEOPLE_WAVES"]
+    ]
+    order_by = []
+    if individual:
+        merged_individual = individual[0]
+        for right in individual[1:]:
+            merged_individual = merge(merged_individual, right, on=["HH_ID", "MEM_ID"])
+            order_by = ["HH_ID", "MEM_ID"]
+    if household:
+        merged_household = household[0]
+        for right in household[1:]:
+            merged_household = merge(merged_household, right, on=["HH_ID"])
+            order_by = ["HH_ID"]
+    if individual and household:
+        final = merge(merged_individual, merged_household, on=["HH_ID"])
+        order_by = ["HH_ID", "MEM_ID"] if "MEM_ID" in final[1] else ["HH_ID"]
+    elif individual:
+        final = merged_individual
+    else:
+        final = merged_household
+
+    # pandas outer merges sort on the join keys
+    query = f"WITH {', '.join(ctes)} SELECT * FROM {final[0]}"
+    if row_filter is not None:
+        query += f" WHERE {row_filter.sql(final[1])}"
+    if order_by:
+        query += " ORDER BY " + ", ".join(duckdb_quote(col) for col in order_by)
+    return query
+
+
+# This function converts a DuckDB result to the pandas dtypes
+def duckdb_to_pandas(df):
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = df[col].astype("float64") if df[col].isna().any() else df[col].astype("int64")
+    return df
+
+
+# File extensions added by the streaming compression codecs
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Codecs of Feather (Arrow IPC) output
+FEATHER_COMPRESSIONS = ("none", "lz4", "zstd")
+
+
+# This function returns a block compressor for the given codec
+def block_compressor(codec):
+    if codec == "gzip":
+        level = int(config.get("GZIP_COMPRESSION_LEVEL", 6))
+
+        def compress(block):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+
+    elif codec == "zstd":
+        import zstandard
+
+        level = int(config.get("ZSTD_COMPRESSION_LEVEL", 3))
+
+        def compress(block):
+            return zstandard.ZstdCompressor(level=level).compress(block)
+
+    else:
+        raise ValueError(f"Unsupported compression: {codec}")
+    return compress
+
+
+# This class compresses blocks on a thread pool and writes them in order
+class ParallelCompressedWriter(io.RawIOBase):
+    def __init__(self, path, codec, threads=None, block_size=16 * 1024 * 1024):
+        super().__init__()
+        threads = threads or config.get("COMPRESSION_THREADS") or os.cpu_count() or 1
+        self.file = open(path, "wb")
+        self.compress = block_compressor(codec)
+        self.executor = ThreadPoolExecutor(max_workers=int(threads))
+        self.max_pending = 2 * int(threads)
+        self.block_size = block_size
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    # Function to queue a block for compression
+    def submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffer:
+                    self.submit(bytes(self.buffer))
+                    self.buffer.clear()
+                while self.pending:
+                    self.file.write(self.pending.popleft().result())
+            finally:
+                self.executor.shutdown()
+                self.file.close()
+        super().close()
+
+
+# This function returns the pyarrow options for the Parquet compression
+def parquet_compression_options(compression):
+    options = {"use_dictionary": bool(config.get("PARQUET_USE_DICTIONARY", True))}
+    if compression:
+        options["compression"] = compression
+        if compression == "zstd":
+            options["compression_level"] = int(config.get("ZSTD_COMPRESSION_LEVEL", 3))
+        elif compression == "gzip":
+            options["compression_level"] = int(config.get("GZIP_COMPRESSION_LEVEL", 6))
+    return options
+
+
+# This function returns the Feather writer options of a codec
+def feather_compression_options(compression):
+    if not compression or compression == "none":
+        return {"compression": "uncompressed"}
+    options = {"compression": compression}
+    if compression == "zstd":
+        options["compression_level"] = int(config.get("ZSTD_COMPRESSION_LEVEL", 3))
+    return options
+
+
+# Stata 118 storage types and their missing and valid values
+STATA_INTEGER_TYPES = [
+    (65530, "<i1", 101, -127, 100),
+    (65529, "<i2", 32741, -32767, 32740),
+    (65528, "<i4", 2147483621, -2147483647, 2147483620),
+]
+STATA_FLOAT = (65527, "<f4", np.frombuffer(struct.pack("<I", 0x7F000000), "<f4")[0])
+STATA_DOUBLE = (65526, "<f8", np.frombuffer(struct.pack("<Q", 0x7FE0000000000000), "<f8")[0])
+STATA_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+# This function maps column names to unique, valid Stata names
+def stata_variable_names(columns):
+    names = {}
+    used = set()
+    for col in columns:
+        name = re.sub(r"[^A-Za-z0-9_]", "_", str(col))
+        if not re.match(r"[A-Za-z_]", name):
+            name = "_" + name
+        if len(name) > 32 or name in used:
+            # Long names get a suffix hashed from the full name
+            digest = hashlib.sha1(str(col).encode("utf-8")).hexdigest()
+            for length in range(5, len(digest) + 1):
+                candidate = f"{name[:31 - length]}_{digest[:length]}"
+                if candidate not in used:
+                    break
+            name = candidate
+        used.add(name)
+        names[col] = name
+    return names
+
+
+# This function picks the smallest Stata type that holds a column
+def stata_column_plan(series, max_labels):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return {"kind": "label", "labels": [str(c) for c in series.cat.categories]}
+    if pd.api.types.is_bool_dtype(series.dtype):
+        series = series.astype("float64")
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return {"kind": "number", "type": STATA_INTEGER_TYPES[0]}
+        low, high = values.min(), values.max()
+        if np.all(np.mod(values, 1) == 0):
+            for stata_type in STATA_INTEGER_TYPES:
+                if stata_type[3] <= low and high <= stata_type[4]:
+                    return {"kind": "number", "type": stata_type}
+        if max(abs(low), abs(high)) < 1.7e38 and np.all(
+            values.astype("float32").astype("float64") == values
+        ):
+            return {"kind": "number", "type": STATA_FLOAT}
+        return {"kind": "number", "type": STATA_DOUBLE}
+    # Text columns with few distinct values are stored with value labels
+    text = series.dropna().astype(str)
+    labels = pd.unique(text)
+    if len(labels) <= max_labels:
+        return {"kind": "label", "labels": sorted(labels)}
+    width = int(text.str.encode("utf-8").str.len().max())
+    return {"kind": "string", "width": max(1, min(width, 2045)), "truncated": width > 2045}
+
+
+# This function converts a batch of a column to its Stata type
+def stata_column_values(series, plan):
+    missing = series.isna().to_numpy()
+    if plan["kind"] == "string":
+        text = series.astype(str).where(~missing, "")
+        return np.array(text.str.encode("utf-8").tolist(), dtype=f"S{plan['width']}")
+    if plan["kind"] == "label":
+        text = series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype(str)
+        codes = pd.Categorical(text, categories=plan["labels"]).codes.astype("float64") + 1
+        codes[missing | (codes == 0)] = np.nan
+        values, stata_type = codes, plan["type"]
+    else:
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        stata_type = plan["type"]
+    return np.where(np.isnan(values), stata_type[2], values).astype(stata_type[1])
+
+
+# This function writes a DataFrame as a Stata 118 .dta file
+def write_stata(df, f, names, notes=None):
+    batch_rows = int(config.get("DTA_BATCH_ROWS", 100000))
+    max_labels = int(config.get("DTA_VALUE_LABEL_MAX", 1000))
+    plans = [stata_column_plan(df[col], max_labels) for col in df.columns]
+    if notes is not None:
+        notes.extend(
+            f"{col} truncated to the 2045 byte limit of Stata strings"
+            for col, plan in zip(df.columns, plans)
+            if plan.get("truncated")
+        )
+    for plan in plans:
+        if plan["kind"] == "label":
+            plan["type"] = next(
+                t for t in STATA_INTEGER_TYPES if len(plan["labels"]) <= t[4]
+            )
+
+    # Function to encode a fixed-width, null-padded text field
+    def fixed(text, length):
+        return str(text).encode("utf-8")[: length - 1].ljust(length, b"\0")
+
+    columns = list(df.columns)
+    stata_names = [names[col] for col in columns]
+    type_codes, formats, row_fields = [], [], []
+    for name, plan in zip(stata_names, plans):
+        if plan["kind"] == "string":
+            type_codes.append(plan["width"])
+            formats.append(f"%{plan['width']}s")
+            row_fields.append((name, f"S{plan['width']}"))
+        else:
+            type_codes.append(plan["type"][0])
+            formats.append("%10.0g" if plan["type"] == STATA_DOUBLE else "%9.0g")
+            row_fields.append((name, plan["type"][1]))
+    row_dtype = np.dtype(row_fields)
+
+    now = datetime.now()
+    timestamp = f"{now.day:02d} {STATA_MONTHS[now.month - 1]} {now.year} {now:%H:%M}".encode()
+    header = (
+        b"<stata_dta><header><release>118</release><byteorder>LSF</byteorder>"
+        + b"<K>" + struct.pack("<H", len(columns)) + b"</K>"
+        + b"<N>" + struct.pack("<Q", len(df)) + b"</N>"
+        + b"<label>" + struct.pack("<H", 0) + b"</label>"
+        + b"<timestamp>" + bytes([len(timestamp)]) + timestamp + b"</timestamp></header>"
+    )
+    value_labels = b"".join(
+        stata_value_label(name, plan["labels"])
+        for name, plan in zip(stata_names, plans)
+        if plan["kind"] == "label"
+    )
+    sections = [
+        b"<variable_types>" + np.array(type_codes, "<u2").tobytes() + b"</variable_types>",
+        b"<varnames>" + b"".join(fixed(name, 129) for name in stata_names) + b"</varnames>",
+        b"<sortlist>" + bytes(2 * (len(columns) + 1)) + b"</sortlist>",
+        b"<formats>" + b"".join(fixed(fmt, 57) for fmt in formats) + b"</formats>",
+        b"<value_label_names>"
+        + b"".join(
+            fixed(name if plan["kind"] == "label" else "", 129)
+            for name, plan in zip(stata_names, plans)
+        )
+        + b"</value_label_names>",
+        # The original column names are kept as variable labels
+        b"<variable_labels>"
+        + b"".join(fixed(str(col)[:80], 321) for col in columns)
+        + b"</variable_labels>",
+        b"<characteristics></characteristics>",
+    ]
+
+    # Offsets of every section of the file
+    offsets = [0, len(header)]
+    position = len(header) + len(b"<map>") + 14 * 8 + len(b"</map>")
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+    data_length = len(b"<data>") + len(df) * row_dtype.itemsize + len(b"</data>")
+    offsets.append(position)
+    offsets.append(position + data_length)
+    offsets.append(offsets[-1] + len(b"<strls></strls>"))
+    offsets.append(offsets[-1] + len(b"<value_labels>") + len(value_labels) + len(b"</value_labels>"))
+    offsets.append(offsets[-1] + len(b"</stata_dta>"))
+
+    f.write(header)
+    f.write(b"<map>" + np.array(offsets, "<u8").tobytes() + b"</map>")
+    for section in sections:
+        f.write(section)
+    f.write(b"<data>")
+    for start in range(0, len(df), batch_rows):
+        batch = df.iloc[start : start + batch_rows]
+        rows = np.empty(len(batch), dtype=row_dtype)
+        for col, name, plan in zip(columns, stata_names, plans):
+            rows[name] = stata_column_values(batch[col], plan)
+        f.write(rows.tobytes())
+    f.write(b"</data><strls></strls>")
+    f.write(b"<value_labels>" + value_labels + b"</value_labels></stata_dta>")
+
+
+# This function encodes a value label table
+def stata_value_label(name, labels):
+    text = b""
+    text_offsets = []
+    for label in labels:
+        text_offsets.append(len(text))
+        text += label.encode("utf-8")[:32000] + b"\0"
+    table = (
+        struct.pack("<ii", len(labels), len(text))
+        + np.array(text_offsets, "<i4").tobytes()
+        + np.arange(1, len(labels) + 1, dtype="<i4").tobytes()
+        + text
+    )
+    label_name = name.encode("utf-8").ljust(129, b"\0")
+    return b"<lbl>" + struct.pack("<i", len(table)) + label_name + bytes(3) + table + b"</lbl>"
+
+
+# Pyramid types holding one row per member, merged on HH_ID and MEM_ID
+INDIVIDUAL_PYRAMID_TYPES = ["INDIV_INC_MONTHLY", "PEOPLE_WAVES"]
+
+# Tables written by the tables output mode
+OUTPUT_TABLES = {
+    "household_month": (["CONSUMPTION_MONTHLY", "HH_INC_MONTHLY"], ["HH_ID", "MONTH"]),
+    "member_month": (["INDIV_INC_MONTHLY"], ["HH_ID", "MEM_ID", "MONTH"]),
+    "household_wave": (["ASPIRATIONAL_WAVES", "CONSUMPTION_WAVES"], ["HH_ID", "WAVE_NO"]),
+    "member_wave": (["PEOPLE_WAVES"], ["HH_ID", "MEM_ID", "WAVE_NO"]),
+}
+
+# Joins between the output tables
+OUTPUT_TABLE_JOINS = [
+    ("member_month", "household_month", ["HH_ID", "MONTH"]),
+    ("member_month", "member_wave", ["HH_ID", "MEM_ID", "WAVE_NO"]),
+    ("member_wave", "household_wave", ["HH_ID", "WAVE_NO"]),
+    ("household_month", "household_wave", ["HH_ID", "WAVE_NO"]),
+]
+
+
+# This function lists the columns of a month's merged pyramids
+def merged_columns(month_files):
+    individual = [vars_to_load for ptype, (_, vars_to_load) in month_files.items() if ptype in INDIVIDUAL_PYRAMID_TYPES]
+    household = [vars_to_load for ptype, (_, vars_to_load) in month_files.items() if ptype not in INDIVIDUAL_PYRAMID_TYPES]
+    # Columns already taken from an earlier pyramid are dropped from the later ones
+    return list(dict.fromkeys(col for vars_to_load in individual + household for col in vars_to_load))
+
+
+# This function finds the column types of a pyramid file without reading it
+def pyramid_file_dtypes(path, file_index, file_profiles):
+    entry = file_index_entry(file_index, path) if file_index else None
+    if entry is not None and entry.get("dtypes"):
+        return entry["dtypes"]
+    store_file = columnar_store_file(path)
+    if store_file is not None:
+        return {col: str(dtype) for col, dtype in store_file.schema_arrow.empty_table().to_pandas().dtypes.items()}
+    stat = os.stat(path)
+    profile = file_profiles.get(str(Path(path).resolve()))
+    if (
+        profile is not None
+        and profile["size"] == stat.st_size
+        and profile["mtime"] == stat.st_mtime_ns
+        and all("dtype" in column for column in profile["columns"].values())
+    ):
+        return {col: column["dtype"] for col, column in profile["columns"].items()}
+    return None
+
+
+# This function types the columns of a pyramid file from its first rows
+def sniff_pyramid_dtypes(path, columns):
+    head = read_pyramid_csv(path, usecols=lambda col: col in columns, nrows=EMPTY_PYRAMID_SNIFF_ROWS)
+    # Columns missing in every row read stay untyped
+    return {col: str(dtype) for col, dtype in head.dtypes.items() if head[col].notna().any()}
+
+
+# This class holds the columns and types of the build output
+# Schema types of numbers and booleans, with the nullable types of columns that can be missing
+NUMERIC_SCHEMA_DTYPES = ("int64", "Int64", "float64", "bool", "boolean")
+
+
+class OutputSchema:
+    def __init__(self, dtypes, nullable):
+        # Columns map to their type, or None until a month holds the column
+        self.dtypes = dict(dtypes)
+        self.nullable = set(nullable)
+        self.catalog_typed = sum(dtype is not None for dtype in self.dtypes.values())
+        self.sniffed_files = 0
+        self.widened = set()
+
+    # This function returns the type of a column that can hold missing values
+    def nullable_dtype(self, col, dtype):
+        if col in self.nullable:
+            if dtype.startswith(("int", "uint")):
+                return "Int64"
+            if dtype == "bool":
+                return "boolean"
+        return dtype
+
+    # This function builds the schema of a build from the files of each month
+    @classmethod
+    def from_month_files(cls, month_plans, file_index, file_profiles, merge_keys=None):
+        columns = {}
+        nullable = set()
+        file_dtypes = {}
+        sniffed_files = 0
+        for month_files in month_plans:
+            if not month_files:
+                continue
+            month_columns = merged_columns(month_files)
+            for col in month_columns:
+                columns.setdefault(col, [])
+            # Outer merges leave missing values in every column except the keys of the rows
+            if len(month_files) > 1:
+                keys = {"HH_ID"}
+                if merge_keys is not None:
+                    keys = set(merge_keys)
+                elif all(ptype in INDIVIDUAL_PYRAMID_TYPES for ptype in month_files):
+                    keys.add("MEM_ID")
+                nullable.update(col for col in month_columns if col not in keys)
+            # Each column comes from the first pyramid holding it
+            taken = set()
+            for ptype in sorted(month_files, key=lambda ptype: ptype not in INDIVIDUAL_PYRAMID_TYPES):
+                path, vars_to_load = month_files[ptype]
+                if path not in file_dtypes:
+                    file_dtypes[path] = pyramid_file_dtypes(path, file_index, file_profiles)
+                    # Files the catalog does not know are typed from their first rows
+                    if file_dtypes[path] is None:
+                        file_dtypes[path] = sniff_pyramid_dtypes(path, vars_to_load)
+                        sniffed_files += 1
+                for col in vars_to_load:
+                    if col not in taken:
+                        taken.add(col)
+                        columns[col].append(file_dtypes[path].get(col))
+        # Columns missing from some months are filled with missing values
+        for month_files in month_plans:
+            if month_files:
+                nullable.update(set(columns) - set(merged_columns(month_files)))
+        schema = cls({}, nullable)
+        for col, dtypes in columns.items():
+            schema.dtypes[col] = (
+                schema.nullable_dtype(col, combined_dtype(dtypes)) if dtypes and None not in dtypes else None
+            )
+        schema.catalog_typed = sum(dtype is not None for dtype in schema.dtypes.values())
+        schema.sniffed_files = sniffed_files
+        return schema
+
+    # This function returns the wider of a column's type and a month's type
+    def wider_dtype(self, dtype, values):
+        observed = self.nullable_dtype(values.name, str(values.dtype))
+        if observed == dtype:
+            return dtype
+        # Merges turn integers and booleans with missing values into floats and objects
+        present = values.dropna()
+        if dtype == "Int64" and observed == "float64" and np.all(np.mod(present.to_numpy(), 1) == 0):
+            return dtype
+        if dtype == "boolean" and observed in ("float64", "object") and present.map(type).isin([bool, np.bool_]).all():
+            return dtype
+        base = {"Int64": "int64", "boolean": "bool"}
+        wider = self.nullable_dtype(
+            values.name, combined_dtype([base.get(dtype, dtype), base.get(observed, observed)])
+        )
+        if wider not in NUMERIC_SCHEMA_DTYPES + ("object",) and observed == "float64" and len(present):
+            return "object"
+        return wider
+
+    # This function gives a month's frame the columns and types of the schema
+    def conform(self, df):
+        widened = []
+        columns = {}
+        for col, dtype in self.dtypes.items():
+            if col not in df.columns:
+                if dtype is None:
+                    dtype = self.dtypes[col] = "float64"
+                columns[col] = pd.Series(
+                    np.nan if dtype == "float64" else None, index=df.index, dtype=dtype
+                )
+                continue
+            values = df[col]
+            if dtype is None:
+                dtype = self.dtypes[col] = self.nullable_dtype(col, str(values.dtype))
+            else:
+                wider = self.wider_dtype(dtype, values)
+                if wider != dtype:
+                    dtype = self.dtypes[col] = wider
+                    self.widened.add(col)
+                    widened.append(col)
+            if str(values.dtype) != dtype:
+                values = values.astype(dtype)
+            columns[col] = values
+        return pd.DataFrame(columns, index=df.index), widened
+
+    # This function returns the DuckDB type of a schema column
+    def duckdb_type(self, col):
+        dtype = self.dtypes.get(col)
+        if dtype is None or dtype == "float64":
+            return "DOUBLE"
+        if dtype in ("int64", "Int64"):
+            return "BIGINT"
+        if dtype in ("bool", "boolean"):
+            return "BOOLEAN"
+        return "VARCHAR"
+
+
+# This class fills one row per ID with each variable's value in each month
+class WidePanel:
+    def __init__(self, ids, level, variables, months):
+        # IDs are sorted household IDs, or individual keys at the individual level
+        self.ids = ids
+        self.level = level
+        self.variables = variables
+        self.months = {month: position for position, month in enumerate(months)}
+        self.values = {}
+        self.observed = np.zeros(len(ids), dtype=bool)
+        self.unmatched_rows = 0
+
+    @property
+    def column_count(self):
+        return len(self.variables) * len(self.months)
+
+    # This function returns the array of a variable, allocating it if needed
+    def variable_values(self, var, dtype):
+        numeric = dtype in ("int64", "Int64", "float64")
+        values = self.values.get(var)
+        if values is None:
+            values = self.values[var] = np.full(
+                (len(self.ids), len(self.months)),
+                np.nan if numeric else None,
+                dtype="float64" if numeric else object,
+            )
+        elif values.dtype != object and not numeric:
+            # A numeric variable holding text in a later month keeps its values
+            values = self.values[var] = values.astype(object)
+        return values
+
+    # This function copies a month's rows into the arrays
+    def add_month(self, month, df, schema):
+        if self.level == "individuals":
+            rows = df[df["MEM_ID"].notna()] if "MEM_ID" in df.columns else df.iloc[:0]
+            self.unmatched_rows += len(df) - len(rows)
+            keys = individual_keys(rows["HH_ID"], rows["MEM_ID"])
+        else:
+            rows = df
+            keys = rows["HH_ID"].to_numpy("int64")
+        positions, found = index_positions(self.ids, keys)
+        self.unmatched_rows += int((~found).sum())
+        positions = positions[found]
+        self.observed[positions] = True
+        for var in self.variables:
+            if var in rows.columns:
+                values = self.variable_values(var, schema.dtypes.get(var))
+                if values.dtype != object:
+                    column = rows[var].to_numpy(dtype="float64", na_value=np.nan)
+                else:
+                    column = rows[var].to_numpy()
+                values[positions, self.months[month]] = column[found]
+
+    # This function builds the wide table of the IDs seen in any month
+    def to_frame(self, schema):
+        ids = self.ids[self.observed]
+        if self.level == "individuals":
+            columns = {"HH_ID": ids // 100, "MEM_ID": ids % 100}
+        else:
+            columns = {"HH_ID": ids}
+        for var in self.variables:
+            dtype = schema.dtypes.get(var)
+            values = self.variable_values(var, dtype)[self.observed]
+            # Text and integers keep the type they have in the long output
+            if values.dtype != object:
+                column_dtype = "Int64" if dtype in ("int64", "Int64") else values.dtype
+            else:
+                column_dtype = object if dtype in (None, "object") else dtype
+            for month, position in self.months.items():
+                columns[f"{var}_{month.strftime('%Y_%m')}"] = pd.Series(values[:, position], dtype=column_dtype)
+        return pd.DataFrame(columns)
+
+
+# Keys of a variable selection file that hold build settings
+RESERVED_SELECTION_KEYS = ["AGGREGATION", "FILTERS"]
+
+# Version of the aggregation, part of the cache key
+AGGREGATION_VERSION = "weighted-sums-v1"
+
+
+# This function returns the first day of the month after the given month
+def add_month(month):
+    return month.replace(month=month.month % 12 + 1, year=month.year + month.month // 12)
+
+
+# This function reads the aggregation settings of a variable selection
+def aggregation_settings(selected_vars):
+    settings = selected_vars.get("AGGREGATION") or {}
+    group_by = settings.get("GROUP_BY", ["STATE", "MONTH"])
+    return {
+        "GROUP_BY": [group_by] if isinstance(group_by, str) else list(group_by),
+        "WEIGHT": settings.get("WEIGHT"),
+        "VARIABLES": list(settings["VARIABLES"]) if settings.get("VARIABLES") else None,
+    }
+
+
+# This function computes the weighted sums and counts of one month
+def aggregate_partial(df, aggregation):
+    group_by = aggregation["GROUP_BY"]
+    excluded = set(group_by) | {"HH_ID", "MEM_ID", "WAVE_NO", "MONTH", aggregation["WEIGHT"]}
+    if aggregation["VARIABLES"] is not None:
+        variables = [var for var in aggregation["VARIABLES"] if var in df.columns]
+    else:
+        # Without a variable list every numeric variable is aggregated
+        variables = [
+            var
+            for var in df.columns
+            if var not in excluded and pd.api.types.is_numeric_dtype(df[var])
+        ]
+    if aggregation["WEIGHT"]:
+        weights = pd.to_numeric(df[aggregation["WEIGHT"]], errors="coerce")
+    else:
+        weights = pd.Series(1.0, index=df.index)
+    parts = {"N": pd.Series(1, index=df.index, dtype="int64")}
+    for var in variables:
+        # Rows missing the value or the weight are left out
+        values = pd.to_numeric(df[var], errors="coerce")
+        present = values.notna() & weights.notna()
+        parts[f"{var}_N"] = present.astype("int64")
+        parts[f"{var}_WEIGHT"] = weights.where(present, 0.0)
+        parts[f"{var}_SUM"] = (values * weights).where(present, 0.0)
+    partial = pd.DataFrame(parts)
+    for col in group_by:
+        partial[col] = df[col] if col in df.columns else None
+    return partial.groupby(group_by, dropna=False, sort=True).sum()
+
+
+# This function combines the monthly partial aggregates
+def aggregate_table(partials, aggregation):
+    table = pd.concat(partials).groupby(level=aggregation["GROUP_BY"], dropna=False, sort=True).sum()
+    columns = {"N": table["N"]}
+    for var in dict.fromkeys(col[: -len("_SUM")] for col in table.columns if col.endswith("_SUM")):
+        columns[f"{var}_N"] = table[f"{var}_N"].astype("int64")
+        if aggregation["WEIGHT"]:
+            columns[f"{var}_WEIGHT"] = table[f"{var}_WEIGHT"]
+        columns[f"{var}_SUM"] = table[f"{var}_SUM"]
+        columns[f"{var}_MEAN"] = table[f"{var}_SUM"] / table[f"{var}_WEIGHT"].where(table[f"{var}_WEIGHT"] != 0)
+    table = pd.DataFrame(columns).reset_index()
+    # Months such as Jan 2019 are put in calendar order rather than in text order
+    if "MONTH" in table.columns:
+        table = table.sort_values(
+            aggregation["GROUP_BY"],
+            key=lambda col: pd.to_datetime(col, format="%b %Y", errors="coerce") if col.name == "MONTH" else col,
+            kind="stable",
+            ignore_index=True,
+        )
+    return table
+
+
+# Comparison operators of row filters, with how pandas and DuckDB spell them
+ROW_FILTER_OPERATORS = {
+    ast.Eq: ("==", operator.eq, "="),
+    ast.NotEq: ("!=", operator.ne, "<>"),
+    ast.Lt: ("<", operator.lt, "<"),
+    ast.LtE: ("<=", operator.le, "<="),
+    ast.Gt: (">", operator.gt, ">"),
+    ast.GtE: (">=", operator.ge, ">="),
+}
+
+# Operators of a comparison written the other way round
+ROW_FILTER_FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+# This class parses and applies row filter expressions
+class RowFilter:
+    def __init__(self, expressions):
+        if isinstance(expressions, str):
+            expressions = [expressions]
+        self.expressions = [str(expression).strip() for expression in expressions if str(expression).strip()]
+        self.trees = []
+        self.columns = set()
+        for expression in self.expressions:
+            try:
+                tree = ast.parse(expression, mode="eval").body
+            except SyntaxError as e:
+                raise ValueError(f"{expression}: {e.msg}")
+            self.trees.append(self.parse(tree, expression))
+        for tree in self.trees:
+            self.columns |= self.tree_columns(tree)
+
+    # This function turns a parsed expression into nested tuples
+    def parse(self, node, expression):
+        if isinstance(node, ast.BoolOp):
+            return ("and" if isinstance(node.op, ast.And) else "or", [self.parse(value, expression) for value in node.values])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ("not", self.parse(node.operand, expression))
+        if isinstance(node, ast.Compare):
+            # Chained comparisons such as 18 <= AGE < 65 hold when each link holds
+            comparisons = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                comparisons.append(self.parse_comparison(left, op, right, expression))
+                left = right
+            return comparisons[0] if len(comparisons) == 1 else ("and", comparisons)
+        raise ValueError(f"{expression}: expected a comparison such as STATE == 'Kerala'")
+
+    # This function parses one comparison of a column with literals
+    def parse_comparison(self, left, op, right, expression):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(left, ast.Name) or not isinstance(right, (ast.List, ast.Tuple, ast.Set)):
+                raise ValueError(f"{expression}: in and not in need a column on the left and a list on the right")
+            values = tuple(self.literal(value, expression) for value in right.elts)
+            return ("compare", left.id, "in" if isinstance(op, ast.In) else "not in", values)
+        if type(op) not in ROW_FILTER_OPERATORS:
+            raise ValueError(f"{expression}: unsupported comparison")
+        symbol = ROW_FILTER_OPERATORS[type(op)][0]
+        if isinstance(left, ast.Name) and not isinstance(right, ast.Name):
+            return ("compare", left.id, symbol, self.literal(right, expression))
+        if isinstance(right, ast.Name) and not isinstance(left, ast.Name):
+            return ("compare", right.id, ROW_FILTER_FLIPPED[symbol], self.literal(left, expression))
+        raise ValueError(f"{expression}: each comparison needs one column and one literal")
+
+    # This function reads a text, number or boolean literal
+    def literal(self, node, expression):
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            value = self.literal(node.operand, expression)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return -value
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool)):
+            return node.value
+        raise ValueError(f"{expression}: values must be quoted text, numbers, True or False")
+
+    # This function lists the columns a parsed expression reads
+    def tree_columns(self, tree):
+        if tree[0] == "compare":
+            return {tree[1]}
+        if tree[0] == "not":
+            return self.tree_columns(tree[1])
+        return set().union(*(self.tree_columns(child) for child in tree[1]))
+
+    # This function evaluates a parsed expression on a frame
+    def evaluate(self, tree, df):
+        if tree[0] == "and":
+            return reduce(operator.and_, (self.evaluate(child, df) for child in tree[1]))
+        if tree[0] == "or":
+            return reduce(operator.or_, (self.evaluate(child, df) for child in tree[1]))
+        if tree[0] == "not":
+            return ~self.evaluate(tree[1], df)
+        _, column, symbol, value = tree
+        if column not in df.columns:
+            return pd.array([pd.NA] * len(df), dtype="boolean")
+        series = df[column]
+        if symbol == "in":
+            result = series.isin(value)
+        elif symbol == "not in":
+            result = ~series.isin(value)
+        else:
+            function = next(function for name, function, _ in ROW_FILTER_OPERATORS.values() if name == symbol)
+            try:
+                result = function(series, value)
+            except TypeError:
+                raise ValueError(f"{column} cannot be compared with {value!r}")
+        result = pd.array(np.asarray(result, dtype=bool), dtype="boolean")
+        result[np.asarray(series.isna())] = pd.NA
+        return result
+
+    # This function returns which rows of a frame pass every expression
+    def mask(self, df):
+        keep = np.ones(len(df), dtype=bool)
+        for tree in self.trees:
+            keep &= np.asarray(self.evaluate(tree, df).fillna(False), dtype=bool)
+        return keep
+
+    # This function writes a parsed expression as a DuckDB condition
+    def tree_sql(self, tree, columns):
+        if tree[0] in ("and", "or"):
+            return "(" + f" {tree[0].upper()} ".join(self.tree_sql(child, columns) for child in tree[1]) + ")"
+        if tree[0] == "not":
+            return f"(NOT {self.tree_sql(tree[1], columns)})"
+        _, column, symbol, value = tree
+        name = duckdb_quote(column) if column in columns else "NULL"
+        if symbol in ("in", "not in"):
+            # An empty list holds nothing, which is still unknown for missing values
+            if not value:
+                return f"({name} {'<>' if symbol == 'in' else '='} {name})"
+            return f"({name} {symbol.upper()} ({', '.join(self.sql_literal(item) for item in value)}))"
+        sql_symbol = next(sql for name_, _, sql in ROW_FILTER_OPERATORS.values() if name_ == symbol)
+        return f"({name} {sql_symbol} {self.sql_literal(value)})"
+
+    # This function writes a literal for DuckDB
+    def sql_literal(self, value):
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return repr(value)
+
+    # This function returns the DuckDB condition of every expression
+    def sql(self, columns):
+        return " AND ".join(self.tree_sql(tree, set(columns)) for tree in self.trees) or "TRUE"
+
+    # This function writes a parsed expression as an Arrow expression
+    def tree_arrow(self, tree):
+        import pyarrow.compute as pc
+
+        if tree[0] == "and":
+            return reduce(operator.and_, (self.tree_arrow(child) for child in tree[1]))
+        if tree[0] == "or":
+            return reduce(operator.or_, (self.tree_arrow(child) for child in tree[1]))
+        if tree[0] == "not":
+            return ~self.tree_arrow(tree[1])
+        _, column, symbol, value = tree
+        field = pc.field(column)
+        if symbol == "in":
+            return (field.isin(list(value)) | (field != field)) if value else field != field
+        if symbol == "not in":
+            return (~field.isin(list(value)) & (field == field)) if value else field == field
+        function = next(function for name, function, _ in ROW_FILTER_OPERATORS.values() if name == symbol)
+        return function(field, value)
+
+    # This function returns the Arrow expression of every expression
+    def arrow_expression(self):
+        return reduce(operator.and_, (self.tree_arrow(tree) for tree in self.trees))
+
+
+# This function finds the pyramids of a month that can apply each row filter
+def row_filter_pushdown(row_filter, month_files):
+    # Columns of the merged month come from the first pyramid holding them
+    order = [ptype for ptype in month_files if ptype in INDIVIDUAL_PYRAMID_TYPES] + [
+        ptype for ptype in month_files if ptype not in INDIVIDUAL_PYRAMID_TYPES
+    ]
+    pushed = {}
+    for expression, tree in zip(row_filter.expressions, row_filter.trees):
+        columns = row_filter.tree_columns(tree)
+        if columns <= {"HH_ID", "MEM_ID"}:
+            # The merge keys are the same in every pyramid they are merged on
+            targets = [ptype for ptype in order if columns <= set(month_files[ptype][1])]
+            if "MEM_ID" in columns:
+                targets = [ptype for ptype in targets if ptype in INDIVIDUAL_PYRAMID_TYPES]
+        else:
+            sources = {
+                next((ptype for ptype in order if col in month_files[ptype][1]), None)
+                for col in columns - {"HH_ID", "MEM_ID"}
+            }
+            source = sources.pop() if len(sources) == 1 else None
+            targets = [source] if source is not None and columns <= set(month_files[source][1]) else []
+        for ptype in targets:
+            pushed.setdefault(ptype, []).append(expression)
+    return {ptype: RowFilter(expressions) for ptype, expressions in pushed.items()}
+
+
+# This function finds where the partial aggregates of a month are cached
+def aggregate_cache_path(build_key, month, month_files):
+    month_key = hashlib.sha256(build_key.encode())
+    month_key.update(month.strftime("%Y-%m").encode())
+    for pyramid_type, (path, vars_to_load) in sorted(month_files.items()):
+        stat = os.stat(path)
+        month_key.update(
+            json.dumps([pyramid_type, str(Path(path).resolve()), vars_to_load, stat.st_size, stat.st_mtime_ns]).encode()
+        )
+    cache_directory = config.get("AGGREGATE_CACHE_DIRECTORY") or resource_path("aggregate_cache")
+    return Path(cache_directory).joinpath(f"{month_key.hexdigest()}.pkl")
+
+
+# Version of the result cache layout and builder output, part of every cache key
+RESULT_CACHE_VERSION = "result-cache-v1"
+
+# Settings in config.yaml that change the contents of the output
+RESULT_CACHE_CONFIG_KEYS = [
+    "DTA_BATCH_ROWS",
+    "DTA_VALUE_LABEL_MAX",
+    "GZIP_COMPRESSION_LEVEL",
+    "PARQUET_ROW_GROUP_ROWS",
+    "PARQUET_USE_DICTIONARY",
+    "ZSTD_COMPRESSION_LEVEL",
+]
+
+
+# This class holds an exclusive lock on the result cache
+class ResultCacheLock:
+    def __init__(self, cache_directory):
+        self.path = Path(cache_directory).joinpath(".lock")
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a+")
+        if os.name == "nt":
+            import msvcrt
+
+            # msvcrt only retries for a few seconds, so waiting for the lock is looped
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(1)
+        else:
+            import fcntl
+
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if os.name == "nt":
+            import msvcrt
+
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+
+
+# This function hashes the build parameters and input files
+def result_cache_key(parameters, input_files):
+    key = hashlib.sha256(json.dumps(parameters, sort_keys=True, default=str).encode())
+    for path in input_files:
+        stat = os.stat(path)
+        key.update(json.dumps([str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]).encode())
+    return key.hexdigest()
+
+
+# This function hard-links a file, copying it where links are not possible
+def link_or_copy(source, destination):
+    Path(destination).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+# This function copies a file into a folder tree without its permissions
+def copy_file(source, destination):
+    Path(destination).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source, destination)
+
+
+# This function fills an output folder from a cached build
+def fetch_cached_result(cache_directory, key, output_folder):
+    with ResultCacheLock(cache_directory):
+        entry = Path(cache_directory).joinpath(key)
+        if not entry.is_dir():
+            return False
+        for file in entry.rglob("*"):
+            if file.is_file():
+                copy_file(file, Path(output_folder).joinpath(file.relative_to(entry)))
+        # The modification time of an entry marks when it was last used
+        os.utime(entry)
+    return True
+
+
+# This function returns the bytes held by the files of a cache entry
+def cache_entry_bytes(path):
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+# This function removes a cache entry
+def remove_cache_entry(path):
+    for file in path.rglob("*"):
+        if file.is_file():
+            os.chmod(file, 0o644)
+    shutil.rmtree(path)
+
+
+# This function stores a finished build in the result cache
+def store_cached_result(cache_directory, key, output_folder, max_bytes):
+    problems = []
+    with ResultCacheLock(cache_directory):
+        # Staging folders found under the lock are left over from a crashed build
+        for path in Path(cache_directory).glob("*.tmp"):
+            try:
+                remove_cache_entry(path)
+            except OSError as e:
+                problems.append(f"could not remove the unfinished entry {path.name} ({e})")
+
+        entry = Path(cache_directory).joinpath(key)
+        if not entry.is_dir():
+            staging = Path(cache_directory).joinpath(f"{key}.tmp")
+            for file in Path(output_folder).rglob("*"):
+                if file.is_file() and file.name != "log.txt":
+                    copy_file(file, staging.joinpath(file.relative_to(output_folder)))
+            staging.mkdir(parents=True, exist_ok=True)
+            os.rename(staging, entry)
+
+        # Entries that cannot be read or removed are skipped
+        entries = []
+        total_bytes = 0
+        for path in Path(cache_directory).iterdir():
+            if not path.is_dir():
+                continue
+            try:
+                size = cache_entry_bytes(path)
+                total_bytes += size
+                if not path.name.endswith(".tmp") and path != entry:
+                    entries.append((path.stat().st_mtime, path, size))
+            except OSError as e:
+                problems.append(f"could not measure {path.name} ({e})")
+        for _, path, size in sorted(entries, key=lambda item: item[0]):
+            if total_bytes <= max_bytes:
+                break
+            try:
+                remove_cache_entry(path)
+                total_bytes -= size
+            except OSError as e:
+                problems.append(f"could not evict {path.name} ({e})")
+    return problems
+
+
+# Output formats writing a single database file
+DATABASE_FORMATS = (".sqlite", ".duckdb")
+DATABASE_INDEX_COLUMNS = ["HH_ID", "MEM_ID", "MONTH"]
+
+
+# This function quotes a column or table name for SQL
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+# This function opens a SQLite or DuckDB database file, picked by its extension
+def database_connection(database_path):
+    if str(database_path).lower().endswith(".duckdb"):
+        import duckdb
+
+        return duckdb.connect(str(database_path))
+    con = sqlite3.connect(database_path)
+    # Loading without a rollback journal
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    return con
+
+
+# This function returns the SQLite storage class for a column type
+def sqlite_column_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+# This function converts a column to Python values SQLite can bind
+def sqlite_values(series):
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = series.dt.strftime("%Y-%m-%d %H:%M:%S")
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+# This function appends the rows of a DataFrame to a database table
+def export_database(df, database_path, table):
+    con = database_connection(database_path)
+    try:
+        if str(database_path).lower().endswith(".duckdb"):
+            con.register("chunk", df)
+            exists = con.execute(
+                "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [table]
+            ).fetchone()[0]
+            if exists:
+                con.execute(f"INSERT INTO {quote_identifier(table)} BY NAME SELECT * FROM chunk")
+            else:
+                con.execute(f"CREATE TABLE {quote_identifier(table)} AS SELECT * FROM chunk")
+            con.unregister("chunk")
+        else:
+            columns = [quote_identifier(col) for col in df.columns]
+            con.execute(
+                f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ("
+                + ", ".join(f"{name} {sqlite_column_type(df[col].dtype)}" for name, col in zip(columns, df.columns))
+                + ")"
+            )
+            insert = (
+                f"INSERT INTO {quote_identifier(table)} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})"
+            )
+            # Each chunk is loaded in one transaction, in batches
+            batch_rows = int(config.get("SQLITE_BATCH_ROWS", 50000))
+            with con:
+                for start in range(0, len(df), batch_rows):
+                    batch = df.iloc[start : start + batch_rows]
+                    con.executemany(insert, zip(*[sqlite_values(batch[col]) for col in batch.columns]))
+    finally:
+        con.close()
+    return database_path
+
+
+# This function indexes the ID and month columns of a database file
+def index_database(database_path, tables):
+    con = database_connection(database_path)
+    indexes = 0
+    try:
+        for table, index_columns in tables.items():
+            table_columns = [
+                column[0]
+                for column in con.execute(f"SELECT * FROM {quote_identifier(table)} LIMIT 0").description
+            ]
+            for col in index_columns:
+                if col in table_columns:
+                    con.execute(
+                        f"CREATE INDEX IF NOT EXISTS {quote_identifier(f'{table}_{col}')} "
+                        f"ON {quote_identifier(table)} ({quote_identifier(col)})"
+                    )
+                    indexes += 1
+        # Statistics on the new indexes let SQLite's planner pick them for lookups
+        if not str(database_path).lower().endswith(".duckdb"):
+            con.execute("ANALYZE")
+            con.commit()
+    finally:
+        con.close()
+    return indexes
+
+
+# This function exports the merged data
+def export_dataframe(df, file_path, format, compression=None, threads=None, notes=None):
+    # Parquet passes "none" on to pyarrow to turn off its default snappy compression
+    if compression == "none" and format.lower() != ".parquet":
+        compression = None
+    try:
+        if format.lower() in DATABASE_FORMATS:
+            # A standalone database file holds one table named after the file
+            output_path = f"{file_path}{format.lower()}"
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            table = Path(file_path).name
+            export_database(df, output_path, table)
+            index_database(output_path, {table: DATABASE_INDEX_COLUMNS})
+        elif format.lower() == ".csv":
+            if compression:
+                # Compressing in parallel blocks
+                output_path = f"{file_path}.csv{COMPRESSION_EXTENSIONS[compression]}"
+                with ParallelCompressedWriter(output_path, compression, threads) as f:
+                    df.to_csv(f, index=False, mode="wb")
+            else:
+                output_path = f"{file_path}.csv"
+                df.to_csv(output_path, index=False)
+        elif format.lower() == ".parquet":
+            output_path = f"{file_path}.parquet"
+            df.to_parquet(
+                output_path, index=False, **parquet_compression_options(compression)
+            )
+        elif format.lower() == ".feather":
+            import pyarrow as pa
+            import pyarrow.feather as feather
+
+            output_path = f"{file_path}.feather"
+            feather.write_feather(
+                pa.Table.from_pandas(df, preserve_index=False),
+                output_path,
+                **feather_compression_options(compression),
+            )
+        elif format.lower() == ".dta":
+            names = stata_variable_names(df.columns)
+            if compression:
+                output_path = f"{file_path}.dta{COMPRESSION_EXTENSIONS[compression]}"
+                with ParallelCompressedWriter(output_path, compression, threads) as f:
+                    write_stata(df, f, names, notes)
+            else:
+                output_path = f"{file_path}.dta"
+                with open(output_path, "wb") as f:
+                    write_stata(df, f, names, notes)
+        return output_path
+    except Exception as e:
+        messagebox.showerror("Error", f"Could not export {Path(file_path).name}{format.lower()}: {e}")
+        raise
+
+
+# This class tracks the resident memory of the build
+class MemoryGovernor:
+    def __init__(self, budget_gb, soft_limit=0.8):
+        self.budget_bytes = float(budget_gb) * 1024**3 if budget_gb else None
+        self.soft_limit = float(soft_limit)
+        self.peak_bytes = 0
+        self.events = {}
+
+    # Function to read the resident memory of the process
+    def resident_bytes(self):
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    # Function to check whether memory has reached the soft limit
+    def near_limit(self):
+        if self.budget_bytes is None:
+            return False
+        resident = self.resident_bytes()
+        if resident is None:
+            return False
+        self.peak_bytes = max(self.peak_bytes, resident)
+        return resident >= self.soft_limit * self.budget_bytes
+
+    # Function returning the bytes left before the soft limit, None without a budget
+    def headroom_bytes(self):
+        if self.budget_bytes is None:
+            return None
+        resident = self.resident_bytes()
+        if resident is None:
+            return None
+        return max(0.0, self.soft_limit * self.budget_bytes - resident)
+
+    # Function to count the steps taken to stay within the budget
+    def record(self, event):
+        self.events[event] = self.events.get(event, 0) + 1
+
+    # Function to summarise the budget and the steps taken for the build log
+    def summary(self):
+        lines = [
+            f"Memory Budget: {self.budget_bytes / 1024**3:.2f} GB (soft limit {self.soft_limit:.0%})",
+            f"Peak Resident Memory: {self.peak_bytes / 1024**3:.2f} GB",
+        ]
+        lines += [f"{event}: {count}" for event, count in sorted(self.events.items())]
+        return "\n".join(lines)
+
+
+# Keys of the two independent hashes identifying an exported row
+EXPORTED_ROW_HASH_KEYS = ("exported-rows-01", "exported-rows-02")
+
+
+# This class remembers the rows already exported, so that no part repeats a row of an earlier part
+class ExportedRows:
+    def __init__(self, spill_dir):
+        # Sorted runs of the first hash, each with the second hash of the same rows
+        self.runs = []
+        self.spill_dir = spill_dir
+        self.spilled = False
+        self.spill_files = 0
+        self.dropped = 0
+
+    # Function to hash the rows, with numbers compared by value whatever their type
+    def hashes(self, df):
+        columns = {}
+        for col in df.columns:
+            values = df[col]
+            if pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+                numbers = values.to_numpy(dtype="float64", na_value=np.nan) + 0.0
+                columns[col] = np.where(np.isnan(numbers), np.nan, numbers)
+            else:
+                columns[col] = values.astype(object).where(values.notna(), None)
+        normalized = pd.DataFrame(columns, index=df.index)
+        return tuple(
+            pd.util.hash_pandas_object(normalized, index=False, hash_key=key).to_numpy()
+            for key in EXPORTED_ROW_HASH_KEYS
+        )
+
+    # Function to drop the duplicate rows of a chunk, and the rows exported before
+    def drop_seen(self, df):
+        unique = df.drop_duplicates()
+        if self.runs and len(unique):
+            first, second = self.hashes(unique)
+            seen = np.zeros(len(unique), dtype=bool)
+            for run_first, run_second in self.runs:
+                starts = np.searchsorted(run_first, first, side="left")
+                counts = np.searchsorted(run_first, first, side="right") - starts
+                # Rows sharing the first hash are told apart by the second
+                for offset in range(counts.max(initial=0)):
+                    matches = counts > offset
+                    positions = np.minimum(starts + offset, len(run_first) - 1)
+                    seen |= matches & (run_second[positions] == second)
+            unique = unique[~seen]
+        self.dropped += len(df) - len(unique)
+        return unique
+
+    # Function to store a run, on disk once the hashes were spilled
+    def store(self, first, second):
+        if not self.spilled:
+            return first, second
+        run = []
+        for values in (first, second):
+            self.spill_files += 1
+            path = os.path.join(self.spill_dir, f"exported_rows_{self.spill_files}.npy")
+            np.save(path, values)
+            run.append(np.load(path, mmap_mode="r"))
+        return tuple(run)
+
+    # Function to move the hashes to memory-mapped files
+    def spill(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.spilled = True
+        self.runs = [self.store(np.asarray(first), np.asarray(second)) for first, second in self.runs]
+
+    # Function to remember the rows of an exported part
+    def add(self, df):
+        if df.empty:
+            return
+        first, second = self.hashes(df)
+        order = np.argsort(first, kind="stable")
+        self.runs.append(self.store(first[order], second[order]))
+        # Runs of similar length are merged, so that a lookup searches few runs
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            merged = self.runs[-2:]
+            first = np.concatenate([run[0] for run in merged])
+            second = np.concatenate([run[1] for run in merged])
+            order = np.argsort(first, kind="stable")
+            self.runs[-2:] = [self.store(first[order], second[order])]
+            # The files of the merged runs are no longer needed
+            merged_files = [values.filename for run in merged for values in run if isinstance(values, np.memmap)]
+            del merged
+            for path in merged_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+# This class estimates the on-disk size of output parts
+class OutputSizeEstimator:
+    def __init__(self, file_format, compression, scratch_path, sample_rows=20000):
+        self.file_format = file_format
+        self.compression = compression
+        self.scratch_path = scratch_path
+        self.sample_rows = sample_rows
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.sample_size = 0
+        self.sample_bytes_per_row = None
+
+    # Estimating from a sample of the chunk until enough rows are seen
+    @property
+    def calibrated(self):
+        return self.rows_written > 0 or self.sample_size >= self.sample_rows
+
+    # Function returning the rows to calibrate from
+    def sample_positions(self, rows):
+        if rows <= self.sample_rows:
+            return np.arange(rows)
+        run = self.sample_rows // 20
+        starts = np.linspace(0, rows - run, 20).astype(int)
+        return np.unique(np.concatenate([np.arange(start, start + run) for start in starts]))
+
+    # Function to add the measured size of an exported part to the estimate
+    def record(self, rows, output_path):
+        self.rows_written += rows
+        self.bytes_written += os.path.getsize(output_path)
+
+    # Function returning the estimated bytes per row
+    def bytes_per_row(self, df):
+        if self.rows_written:
+            return self.bytes_written / self.rows_written
+        if not self.calibrated and len(df) > self.sample_size:
+            sample = df.iloc[self.sample_positions(len(df))]
+            output_path = export_dataframe(
+                sample, self.scratch_path, self.file_format, self.compression
+            )
+            self.sample_bytes_per_row = os.path.getsize(output_path) / len(sample)
+            self.sample_size = len(sample)
+            os.remove(output_path)
+        return self.sample_bytes_per_row
+
+
+# Partition value of rows missing a partition column
+PARTITION_MISSING_VALUE = "UNKNOWN"
+
+
+# This function writes one month of data into a hive-partitioned Parquet dataset
+def export_partitioned_parquet(
+    df, dataset_dir, month, partition_cols, metadata_collector, compression=None, notes=None
+):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # Sorting by ID keeps the HH_ID min/max statistics of each row group narrow
+    sort_cols = [col for col in ["HH_ID", "MEM_ID"] if col in df.columns]
+    if sort_cols:
+        df = df.sort_values(sort_cols, kind="stable")
+    # Missing partition values get a named partition, as readers cannot unify null partitions
+    df = df.assign(
+        **{
+            col: df[col].astype(str).where(df[col].notna(), PARTITION_MISSING_VALUE)
+            for col in partition_cols
+            if col in df.columns
+        }
+    )
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # Partition keys, named to avoid clashing with the MONTH column
+    table = table.append_column("YEAR", pa.array([month.year] * len(df), pa.int16()))
+    table = table.append_column("MONTH_NUM", pa.array([month.month] * len(df), pa.int8()))
+    partition_fields = [table.schema.field("YEAR"), table.schema.field("MONTH_NUM")]
+    for col in partition_cols:
+        if col in df.columns:
+            partition_fields.append(table.schema.field(col))
+        else:
+            if notes is not None:
+                notes.append(f"Column {col} is not in the output, not partitioning on it")
+
+    # Function to record the footer of every written file for the _metadata summary
+    def collect_metadata(written_file):
+        written_file.metadata.set_file_path(
+            Path(written_file.path).relative_to(dataset_dir).as_posix()
+        )
+        metadata_collector.append(written_file.metadata)
+
+    row_group_rows = int(config.get("PARQUET_ROW_GROUP_ROWS", 100000))
+    ds.write_dataset(
+        table,
+        dataset_dir,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema(partition_fields), flavor="hive"),
+        basename_template=f"part-{month.strftime('%Y%m')}-{{i}}.parquet",
+        file_options=ds.ParquetFileFormat().make_write_options(
+            write_statistics=True, **parquet_compression_options(compression)
+        ),
+        min_rows_per_group=row_group_rows,
+        max_rows_per_group=row_group_rows,
+        existing_data_behavior="overwrite_or_ignore",
+        preserve_order=True,
+        file_visitor=collect_metadata,
+    )
+
+
+# This function writes the summary files of a partitioned dataset
+def finalize_partitioned_parquet(dataset_dir, metadata_collector, notes=None):
+    import pyarrow.parquet as pq
+
+    if not metadata_collector:
+        return
+    schema = metadata_collector[0].schema.to_arrow_schema()
+    pq.write_metadata(schema, os.path.join(dataset_dir, "_common_metadata"))
+    try:
+        pq.write_metadata(
+            schema,
+            os.path.join(dataset_dir, "_metadata"),
+            metadata_collector=metadata_collector,
+        )
+    except (RuntimeError, ValueError) as e:
+        # Row groups can only be summarised when every file shares the schema
+        if notes is not None:
+            notes.append(f"Skipping _metadata, the partition schemas differ: {e}")
+
+
 # This function constructs the sampled data
 def pyramid_builder(
     data_dir,
@@ -122,6 +2372,15 @@ def pyramid_builder(
     n_individuals=None,
     running_flag=lambda: True,
     summary_text="",
+    backend="pandas",
+    partition_by_state=False,
+    compression=None,
+    sample_strata=None,
+    balanced_panel=False,
+    output_mode="microdata",
+    shard_dates=None,
+    filter_expression=None,
+    update_status=print,
 ):
 
     # Function used to check if the filename is appropraite for the month iteration
@@ -153,10 +2412,16 @@ def pyramid_builder(
     # Initialize variables
     continuing_df = pd.DataFrame()
     file_counter = 1
+
+    # Close to the memory budget, chunks are flushed early
+    governor = MemoryGovernor(config.get("MEMORY_BUDGET_GB"), config.get("MEMORY_SOFT_LIMIT", 0.8))
+    spill_dir = os.path.join(output_folder, "spill")
     file_size_bytes = float(file_size) * 1024 * 1024 * 1024  # Convert GB to bytes
 
-    # Set random seed
-    random.seed(random_seed)
+    # Notes added to the log after the summary
+    log_notes = []
+    # Warnings of the exports, written to log.txt once the build is done
+    build_warnings = []
 
     # Check output directory
     if output_dir is None:
@@ -176,8 +2441,8 @@ def pyramid_builder(
 
     # Sampling households or individuals based on user selection
     if is_sample_enabled:
-        sampled_individuals = []
-        sampled_households = []
+        sampled_individuals = np.array([], dtype="int64")
+        sampled_households = np.array([], dtype="int64")
         if not Path(resource_path("pyramid_ids.csv")):
             messagebox.showerror("Error", "Pyramid IDs not found.")
             return 1
@@ -188,31 +2453,58 @@ def pyramid_builder(
             else:
                 sampled_ids = pd.read_csv(resource_path(selected_ids_location))
             if "MEM_ID" in sampled_ids.columns and "HH_ID" in sampled_ids.columns:
-                sampled_individuals = (
-                    str(sampled_ids["HH_ID"])
-                    + sampled_ids["MEM_ID"].astype(str).str.zfill(2)
-                ).tolist()
-                sample_type == "individuals"
+                sampled_individuals = np.unique(
+                    individual_keys(sampled_ids["HH_ID"], sampled_ids["MEM_ID"])
+                )
+                sample_type = "individuals"
             elif "HH_ID" in sampled_ids.columns:
-                sampled_households = sampled_ids["HH_ID"].tolist()
-                sample_type == "households"
+                sampled_households = np.unique(sampled_ids["HH_ID"].astype("int64"))
+                sample_type = "households"
         else:
-            pyramid_ids = pd.read_csv(resource_path("pyramid_ids.csv"))
-            if sample_type == "households":
-                sampled_households = random.sample(
-                    pyramid_ids["HH_ID"].tolist(), int(n_households)
+            sampled, eligible = draw_sample(
+                sample_type,
+                n_households if sample_type == "households" else n_individuals,
+                random_seed,
+                start_date,
+                end_date,
+                sample_strata,
+                balanced_panel,
+            )
+            if sampled is None:
+                messagebox.showerror(
+                    "Error", "Presence index not found. Please reinitialize the program."
                 )
+                return 1
+            if sample_type == "households":
+                sampled_households = sampled
             elif sample_type == "individuals":
-                sampled_individuals = random.sample(
-                    (
-                        str(pyramid_ids["HH_ID"]) + pyramid_ids["MEM_ID"].astype(str).str.zfill(2)
-                    ).tolist(),
-                    int(n_individuals),
-                )
-        if sampled_households:
-            sampled_households = list(map(str, sampled_households))
-        if sampled_individuals:
-            sampled_individuals = list(map(str, sampled_individuals))
+                sampled_individuals = sampled
+            log_notes.append(
+                f"Sampling Algorithm: {SAMPLING_ALGORITHM} (numpy {np.__version__})\n"
+                f"Sampling Seed: {random_seed}\n"
+                f"Sampling Design: "
+                + (f"stratified by {' and '.join(sample_strata)}" if sample_strata else "simple random")
+                + (", balanced panel" if balanced_panel else "")
+            )
+            if eligible is not None:
+                log_notes[-1] += f"\nBalanced Panel Eligible {sample_type.capitalize()}: {int(eligible.sum())}"
+        log_notes.append(
+            f"Sampled Households: {len(sampled_households)}\n"
+            f"Sampled Individuals: {len(sampled_individuals)}"
+        )
+
+        # Pyramid files holding none of the sampled households are not read
+        file_index = load_file_index()
+        index_households = (
+            sampled_households
+            if sample_type == "households"
+            else np.unique(sampled_individuals // 100)
+        )
+        skipped_files = 0
+        read_methods = {}
+    else:
+        file_index = {}
+        index_households = None
 
     # Variable selection as either the selected list or all variables
     if var_selection == "selected":
@@ -223,7 +2515,9 @@ def pyramid_builder(
             with open(resource_path(selected_vars_location), "r") as f:
                 selected_vars = yaml.safe_load(f)
             selected_pyramid_types = [
-                key for key in selected_vars.keys() if selected_vars[key]
+                key
+                for key in selected_vars.keys()
+                if selected_vars[key] and key not in RESERVED_SELECTION_KEYS
             ]
     else:
         selected_pyramid_types = [
@@ -243,47 +2537,264 @@ def pyramid_builder(
     # Pull all of the available data files for each of the pyramids
     selected_pyramid_files = {}
     for pyramid_type in selected_pyramid_types:
-        selected_pyramid_files[pyramid_type] = sorted(list(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]).glob("*.csv")))
-
-    # Function used to export the merged data
-    def export_dataframe(df, file_path, format):
+        selected_pyramid_files[pyramid_type] = list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]))
+
+    # Row filters of the variable selection and of the builder
+    filter_expressions = selected_vars.get("FILTERS") or []
+    if isinstance(filter_expressions, str):
+        filter_expressions = [filter_expressions]
+    if filter_expression:
+        filter_expressions = list(filter_expressions) + [filter_expression]
+    row_filter = None
+    if filter_expressions:
+        if output_mode == "tables":
+            messagebox.showerror("Error", "Row filters are not available in tables mode.")
+            return 1
         try:
-            if format.lower() == ".csv":
-                df.to_csv(f"{file_path}.csv", index=False)
-            elif format.lower() == ".parquet":
-                df.to_parquet(f"{file_path}.parquet", index=False)
-            elif format.lower() == ".dta":
-                if any(len(col) > 32 for col in df.columns):
-                    df.columns = [col[:32] for col in df.columns]
-                df.to_stata(f"{file_path}.dta", write_index=False)
-        except Exception as e:
-            print(f"Error exporting file: {e}")
-            raise
+            row_filter = RowFilter(filter_expressions)
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid row filter: {e}")
+            return 1
 
-    # Setting start and end dates
-    current_month = datetime.strptime(start_date, "%m-%Y").replace(day=1)
-    end_month = datetime.strptime(end_date, "%m-%Y").replace(day=1)
+    # Reusing the output of a cached build with the same inputs
+    cache_directory = config.get("RESULT_CACHE_DIRECTORY")
+    if cache_directory:
+        cache_inputs = [file for files in selected_pyramid_files.values() for file in files]
+        ids_file_hash = None
+        if is_sample_enabled:
+            # Sampling also depends on the ID registry and the presence index
+            cache_inputs += [
+                Path(resource_path(name))
+                for name in ["pyramid_ids.npz", "pyramid_ids.csv", "pyramid_index.npz"]
+                if Path(resource_path(name)).exists()
+            ]
+            if selected_ids_location:
+                ids_file_hash = hashlib.sha256(
+                    Path(resource_path(selected_ids_location)).read_bytes()
+                ).hexdigest()
+        cache_key = result_cache_key(
+            {
+                "versions": [RESULT_CACHE_VERSION, SAMPLING_ALGORITHM, AGGREGATION_VERSION],
+                "file_format": file_format,
+                "file_size": float(file_size),
+                "random_seed": random_seed if is_sample_enabled else None,
+                "start_date": start_date,
+                "end_date": end_date,
+                "selected_vars": selected_vars,
+                "is_sample_enabled": is_sample_enabled,
+                "sample_type": sample_type,
+                "ids_file": ids_file_hash,
+                "n_households": n_households,
+                "n_individuals": n_individuals,
+                "partition_by_state": partition_by_state,
+                "compression": compression,
+                "sample_strata": sample_strata,
+                "balanced_panel": balanced_panel,
+                "output_mode": output_mode,
+                "shard_dates": shard_dates,
+                "filter_expression": filter_expression,
+                "config": {key: config.get(key) for key in RESULT_CACHE_CONFIG_KEYS},
+            },
+            cache_inputs,
+        )
+        if fetch_cached_result(cache_directory, cache_key, output_folder):
+            log_notes.append(f"Result Cache: reused the cached build {cache_key}")
+            with open(os.path.join(output_folder, "log.txt"), "w") as f:
+                f.write(summary_text)
+                for note in log_notes:
+                    f.write(f"\n\n{note}")
+            return output_folder
+        log_notes.append(f"Result Cache: stored as {cache_key}")
+
+    # Checking the files of the build before any work is done
+    if config.get("INTEGRITY_CHECK_BEFORE_BUILD", False):
+        report = integrity_scan(
+            config,
+            pyramid_types=selected_pyramid_types,
+            start_month=datetime.strptime(start_date, "%m-%Y"),
+            end_month=datetime.strptime(end_date, "%m-%Y"),
+        )
+        if report["problems"]:
+            messagebox.showerror(
+                "Error",
+                f"{len(report['problems'])} problems found in the pyramid files:\n\n"
+                + "\n".join(report["problems"][:10]),
+            )
+            return 1
+        log_notes.append(
+            f"Integrity Check: {report['files']} files with {report['rows']:,} rows passed"
+            f" ({report['scanned']} scanned, the rest unchanged since the last scan);"
+            f" {len(report['drift'])} column changes between consecutive files"
+        )
 
-    # Looping through each time period
-    while current_month <= end_month:
-        if not running_flag():
-            print("Operation cancelled by user")
+    # Function used to keep only the sampled rows of a pyramid
+    def sample_filter(pyramid_iteration):
+        if sample_type == "households":
+            pyramid_iteration = pyramid_iteration[
+                pyramid_iteration["HH_ID"].isin(sampled_households)
+            ]
+        elif sample_type == "individuals":
+            if "MEM_ID" in pyramid_iteration.columns:
+                # For pyramids that have individual-level data
+                pyramid_iteration = pyramid_iteration[
+                    (
+                        pyramid_iteration["HH_ID"] * 100
+                        + pyramid_iteration["MEM_ID"]
+                    ).isin(sampled_individuals)
+                ]
+            else:
+                # For household-level pyramids, just filter by the household part of the individual IDs
+                pyramid_iteration = pyramid_iteration[
+                    pyramid_iteration["HH_ID"].isin(
+                        np.unique(sampled_individuals // 100)
+                    )
+                ]
+        return pyramid_iteration
+
+    # Function used to export a finished chunk in the selected format
+    def export_chunk(df):
+        nonlocal file_counter
+        if is_partitioned:
+            export_partitioned_parquet(
+                df,
+                dataset_dir,
+                current_month,
+                ["STATE"] if partition_by_state else [],
+                dataset_metadata,
+                compression,
+                build_warnings,
+            )
+        elif is_database:
+            export_database(df, database_path, "pyramids")
+        else:
+            file_path = os.path.join(output_folder, f"pyramid_part_{file_counter}")
+            # Compressing on a single thread keeps fewer blocks in memory
+            threads = None
+            if compression and governor.near_limit():
+                governor.record("Single-Threaded Compressed Exports")
+                threads = 1
+            output_path = export_dataframe(df, file_path, file_format, compression, threads, build_warnings)
+            size_estimator.record(len(df), output_path)
+            # Keeping track of the columns renamed to fit Stata's naming rules
+            if file_format.lower() == ".dta":
+                stata_renamed.update(
+                    {
+                        col: name
+                        for col, name in stata_variable_names(df.columns).items()
+                        if col != name
+                    }
+                )
+        file_counter += 1
+        remember_exported_rows(exported_rows, df)
+
+    # Function used to remember the exported rows, on disk close to the memory budget
+    def remember_exported_rows(rows, df):
+        rows.add(df)
+        if not rows.spilled and governor.near_limit():
+            governor.record("Spilled Exported Row Hashes")
+            rows.spill()
+
+    # Function used to export every full-size part of a chunk
+    def export_parts(df, final):
+        if is_partitioned or (is_database and len(df)):
+            export_chunk(df)
+            return df.iloc[:0]
+        if df.empty:
+            return df
+        row_bytes = size_estimator.bytes_per_row(df)
+        update_status(f"Current chunk size: {len(df)} rows (~{len(df) * row_bytes / (1024**3):.2f} GB on disk)")
+        part_rows = max(1, int(file_size_bytes // row_bytes))
+        while len(df) >= part_rows:
+            export_chunk(df.iloc[:part_rows])
+            df = df.iloc[part_rows:]
+            part_rows = max(1, int(file_size_bytes // size_estimator.bytes_per_row(df)))
+        if final and len(df):
+            export_chunk(df)
+            return df.iloc[:0]
+        return df
+
+    # Rows repeating a row of an earlier part are dropped, however the build was split into parts
+    exported_rows = ExportedRows(os.path.join(spill_dir, "exported_rows"))
+
+    # Parts are sized from the measured bytes per row of the output format
+    size_estimator = OutputSizeEstimator(
+        file_format, compression, os.path.join(output_folder, "size_calibration")
+    )
+
+    # Columns renamed to fit Stata's naming rules
+    stata_renamed = {}
+
+    # Partitioned Parquet output is written month by month into a single dataset
+    is_partitioned = file_format.lower() == ".parquet (partitioned)"
+    dataset_dir = os.path.join(output_folder, "pyramid_dataset")
+    dataset_metadata = []
+
+    # Database output loads every month into a single database file
+    is_database = file_format.lower() in DATABASE_FORMATS
+    database_path = os.path.join(output_folder, f"pyramids{file_format.lower()}")
+
+    # Aggregation mode keeps only the weighted sums and counts of each month
+    aggregation = None
+    if output_mode == "aggregates":
+        aggregation = aggregation_settings(selected_vars)
+        aggregation_columns = {
+            col
+            for col in aggregation["GROUP_BY"] + [aggregation["WEIGHT"]]
+            if col
+            and not any(col in selected_vars[pyramid_type] for pyramid_type in selected_pyramid_types)
+        }
+        aggregate_partials = []
+        cached_months = 0
+        aggregation_key = json.dumps(
+            [
+                AGGREGATION_VERSION,
+                aggregation,
+                sample_type if is_sample_enabled else None,
+                hashlib.sha256(
+                    sampled_households.tobytes() + sampled_individuals.tobytes()
+                ).hexdigest()
+                if is_sample_enabled
+                else None,
+            ]
+        )
+        # Filtered builds aggregate other rows, so their months are cached apart
+        if row_filter is not None:
+            aggregation_key += json.dumps(row_filter.expressions)
+
+    # Columns only loaded to evaluate the row filters
+    filter_only_columns = set()
+    if row_filter is not None:
+        filter_only_columns = {
+            col
+            for col in row_filter.columns
+            if col not in ["HH_ID", "MEM_ID", "WAVE_NO", "MONTH"]
+            and not any(col in selected_vars[pyramid_type] for pyramid_type in selected_pyramid_types)
+            and (aggregation is None or col not in aggregation_columns)
+        }
+        filter_pushdowns = 0
+
+    # Function used to aggregate a month's rows and cache the result
+    def add_aggregate(month_df, cache_path):
+        if aggregation["WEIGHT"] and aggregation["WEIGHT"] not in month_df.columns:
+            messagebox.showerror(
+                "Error", f"Weight variable {aggregation['WEIGHT']} is not in the selected pyramids."
+            )
             return 1
-        # Dictionary to store current month's pyramids
-        current_pyramids = {}
-        # Looping through each of the desired pyramids
+        partial = aggregate_partial(month_df.drop_duplicates(), aggregation)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        partial.to_pickle(cache_path)
+        aggregate_partials.append(partial)
+
+    # Function used to find the file and variables of each pyramid of a month
+    def find_month_files(month):
+        month_files = {}
         for pyramid_type in selected_pyramid_types:
-            if not running_flag():
-                print("Operation cancelled by user")
-                return 1
-            
             ### Finding if that pyramid has data for the given month and locating that file
-            selected_pyramids_str_paths = [str(path) for path in selected_pyramid_files[pyramid_type]]
             pyramids_time_filter = check_contains_month(
                 list_of_date_files=[
-                    re.findall(r"\d+", s) for s in selected_pyramids_str_paths
+                    pyramid_file_dates(path) for path in selected_pyramid_files[pyramid_type]
                 ],
-                current_month=current_month,
+                current_month=month,
             )
             correct_pyramid = [
                 inner_list
@@ -297,143 +2808,1400 @@ def pyramid_builder(
                 continue
 
             # Reading in the variables in the given pyramid file
-            available_vars = pd.read_csv(correct_pyramid, nrows=0).columns.tolist()
+            if correct_pyramid not in file_columns:
+                file_columns[correct_pyramid] = read_pyramid_csv(correct_pyramid, nrows=0).columns.tolist()
+            available_vars = file_columns[correct_pyramid]
             # Ensuring that at minimum these variables are included (necessary for merging)
-            pyramid_selected_vars = list(
-                set(
-                    selected_vars[pyramid_type]
-                    + ["HH_ID", "MEM_ID", "WAVE_NO", "MONTH"]
-                )
+            pyramid_selected_vars = set(
+                selected_vars[pyramid_type] + ["HH_ID", "MEM_ID", "WAVE_NO", "MONTH"]
             )
+            # Aggregates also need their group and weight variables
+            if aggregation is not None:
+                pyramid_selected_vars.update(aggregation_columns)
+            # Columns only used by the row filters
+            pyramid_selected_vars.update(filter_only_columns)
+            # Keeping the file's column order, which is the order read_csv returns them in
             vars_to_load = [
-                col for col in pyramid_selected_vars if col in available_vars
+                col for col in available_vars if col in pyramid_selected_vars
             ]
+            month_files[pyramid_type] = (correct_pyramid, vars_to_load)
+        return month_files
 
-            # Reading in the pyramid for the selected columns
-            pyramid_iteration = pd.read_csv(correct_pyramid, usecols=vars_to_load)
-            # Sampling the pyramid if desired
+    # Setting start and end dates
+    current_month = datetime.strptime(start_date, "%m-%Y").replace(day=1)
+    end_month = datetime.strptime(end_date, "%m-%Y").replace(day=1)
+
+    # Finding the files of every month up front for the output schema
+    file_columns = {}
+    month_plans = {}
+    month = current_month
+    while month <= end_month:
+        month_plans[month] = find_month_files(month)
+        month = add_month(month)
+    if row_filter is not None:
+        loaded_columns = {
+            col
+            for month_files in month_plans.values()
+            for _, vars_to_load in month_files.values()
+            for col in vars_to_load
+        }
+        missing_columns = row_filter.columns - loaded_columns
+        if missing_columns:
+            messagebox.showerror(
+                "Error",
+                f"Row filter columns not found in the selected pyramids: {', '.join(sorted(missing_columns))}",
+            )
+            return 1
+        log_notes.append("Row Filters:\n" + "\n".join(row_filter.expressions))
+    output_schema = None
+    if output_mode in ("microdata", "wide"):
+        # Columns only loaded for the row filters are not part of the output
+        output_schema = OutputSchema.from_month_files(
+            [
+                {
+                    ptype: (path, [col for col in vars_to_load if col not in filter_only_columns])
+                    for ptype, (path, vars_to_load) in month_files.items()
+                }
+                for month_files in month_plans.values()
+            ],
+            file_index or load_file_index(),
+            load_variable_profiles(),
+        )
+        schema_nulls = {col for col in output_schema.nullable if col in output_schema.dtypes}
+        log_notes.append(
+            f"Output Schema: {len(output_schema.dtypes)} columns, "
+            f"{output_schema.catalog_typed} typed before the build, "
+            f"{len(schema_nulls)} able to hold missing values; "
+            f"{output_schema.sniffed_files} files not in the file catalog typed from their first "
+            f"{EMPTY_PYRAMID_SNIFF_ROWS} rows"
+        )
+
+    # A shard only reads and writes its own months
+    if shard_dates is not None:
+        current_month = datetime.strptime(shard_dates[0], "%m-%Y")
+        end_month = datetime.strptime(shard_dates[1], "%m-%Y")
+        month_plans = {
+            month: month_files
+            for month, month_files in month_plans.items()
+            if current_month <= month <= end_month
+        }
+        log_notes.append(f"Shard: {shard_dates[0]} to {shard_dates[1]} of {start_date} to {end_date}")
+
+    # Wide mode fills one row per ID, with a column per variable and month
+    wide_panel = None
+    if output_mode == "wide":
+        wide_level = (
+            "individuals"
+            if any(ptype in INDIVIDUAL_PYRAMID_TYPES for ptype in selected_pyramid_types)
+            else "households"
+        )
+        if is_sample_enabled and wide_level == sample_type:
+            wide_ids = sampled_households if wide_level == "households" else sampled_individuals
+        elif is_sample_enabled and wide_level == "individuals":
+            # Every registered member of the sampled households
+            registry_individuals = load_id_registry()[1]
+            wide_ids = registry_individuals[np.isin(registry_individuals // 100, sampled_households)]
+        elif is_sample_enabled:
+            wide_ids = np.unique(sampled_individuals // 100)
+        else:
+            wide_ids = load_id_registry()[0 if wide_level == "households" else 1]
+        wide_panel = WidePanel(
+            wide_ids,
+            wide_level,
+            [col for col in output_schema.dtypes if col not in ["HH_ID", "MEM_ID", "WAVE_NO", "MONTH"]],
+            list(month_plans),
+        )
+        max_columns = int(config.get("WIDE_PANEL_MAX_COLUMNS") or 10000)
+        if wide_panel.column_count > max_columns:
+            messagebox.showerror(
+                "Error",
+                f"The wide panel would have {wide_panel.column_count} columns "
+                f"({len(wide_panel.variables)} variables x {len(month_plans)} months), "
+                f"more than the limit of {max_columns}. Select fewer variables or months.",
+            )
+            return 1
+
+    # Tables mode writes each table in its own folder, with its own schema and parts
+    output_tables = None
+    if output_mode == "tables":
+        output_tables = {}
+        schema_index = file_index or load_file_index()
+        schema_profiles = load_variable_profiles()
+        for table, (table_types, table_keys) in OUTPUT_TABLES.items():
+            table_types = [ptype for ptype in selected_pyramid_types if ptype in table_types]
+            if not table_types:
+                continue
+            table_plans = [
+                {ptype: month_files[ptype] for ptype in table_types if ptype in month_files}
+                for month_files in month_plans.values()
+            ]
+            output_tables[table] = {
+                "types": table_types,
+                "keys": table_keys,
+                "schema": OutputSchema.from_month_files(
+                    table_plans, schema_index, schema_profiles, merge_keys=table_keys
+                ),
+                "df": pd.DataFrame(),
+                "exported": ExportedRows(os.path.join(spill_dir, f"{table}_exported_rows")),
+                "parts": [],
+                "rows": 0,
+                "estimator": OutputSizeEstimator(
+                    ".parquet" if is_partitioned else file_format,
+                    compression,
+                    os.path.join(output_folder, f"{table}_size_calibration"),
+                ),
+            }
+        # Wave files cover several months but are only read once
+        tables_read_files = set()
+        # The tables are built with pandas
+        if backend == "duckdb":
+            log_notes.append("Backend: tables are built with pandas")
+            backend = "pandas"
+
+    # Function used to export a table's full-size parts
+    def export_table_parts(table, df, final):
+        state = output_tables[table]
+        table_format = ".parquet" if is_partitioned else file_format
+        # Every table is a table of the one database file
+        if is_database:
+            if len(df):
+                export_database(df, database_path, table)
+                remember_exported_rows(state["exported"], df)
+                state["parts"] = [os.path.basename(database_path)]
+                state["rows"] += len(df)
+            return df.iloc[:0]
+        while len(df):
+            row_bytes = state["estimator"].bytes_per_row(df)
+            part_rows = max(1, int(file_size_bytes // row_bytes))
+            if len(df) < part_rows and not final:
+                break
+            os.makedirs(os.path.join(output_folder, table), exist_ok=True)
+            part = df.iloc[:part_rows]
+            output_path = export_dataframe(
+                part,
+                os.path.join(output_folder, table, f"{table}_part_{len(state['parts']) + 1}"),
+                table_format,
+                compression,
+                notes=build_warnings,
+            )
+            state["estimator"].record(len(part), output_path)
+            remember_exported_rows(state["exported"], part)
+            state["parts"].append(os.path.relpath(output_path, output_folder))
+            state["rows"] += len(part)
+            # Keeping track of the columns renamed to fit Stata's naming rules
+            if table_format.lower() == ".dta":
+                stata_renamed.update(
+                    {
+                        col: name
+                        for col, name in stata_variable_names(part.columns).items()
+                        if col != name
+                    }
+                )
+            df = df.iloc[part_rows:]
+        return df
+
+    # Function used to add a month's rows to each table
+    def add_table_rows(month_files, skipped_types, final):
+        for table, state in output_tables.items():
+            table_files = {
+                ptype: month_files[ptype]
+                for ptype in state["types"]
+                if ptype in month_files and month_files[ptype][0] not in tables_read_files
+            }
+            frames = []
+            for pyramid_type, (correct_pyramid, vars_to_load) in table_files.items():
+                if not running_flag():
+                    update_status("Operation cancelled by user")
+                    return 1
+                tables_read_files.add(correct_pyramid)
+                # Files without any sampled households add no rows
+                if pyramid_type in skipped_types:
+                    continue
+                if is_sample_enabled:
+                    read_method = pyramid_read_method(
+                        correct_pyramid, index_households, file_index
+                    )
+                    read_methods[read_method] = read_methods.get(read_method, 0) + 1
+                pyramid_iteration = read_pyramid_file(
+                    correct_pyramid, vars_to_load, index_households, file_index
+                )
+                if is_sample_enabled:
+                    pyramid_iteration = sample_filter(pyramid_iteration)
+                frames.append(pyramid_iteration)
+            if frames:
+                update_status(f"Adding rows to {table}")
+                table_df = frames[0]
+                for right_df in frames[1:]:
+                    # Columns already taken from an earlier pyramid are dropped from the later ones
+                    duplicate_cols = set(table_df.columns) & set(right_df.columns) - set(state["keys"])
+                    table_df = pd.merge(
+                        table_df,
+                        right_df.drop(columns=list(duplicate_cols)),
+                        on=state["keys"],
+                        how="outer",
+                    )
+                table_df, widened = state["schema"].conform(table_df)
+                if state["df"].empty:
+                    state["df"] = table_df
+                else:
+                    for col in widened:
+                        state["df"][col] = state["df"][col].astype(state["schema"].dtypes[col])
+                    state["df"] = pd.concat([state["df"], table_df], ignore_index=True)
+                state["df"] = state["exported"].drop_seen(state["df"])
+            state["df"] = export_table_parts(table, state["df"], final)
+
+    # Releasing the DuckDB connection, prefetch thread and scratch folders
+    con = None
+    prefetcher = None
+    duckdb_temp_directory = config.get("DUCKDB_TEMP_DIRECTORY") or os.path.join(output_folder, "duckdb_tmp")
+    try:
+        # Setting up the DuckDB backend which keeps the current chunk inside the engine
+        if backend == "duckdb":
+            try:
+                import duckdb
+
+                con = duckdb_connect(duckdb_temp_directory)
+            except ImportError:
+                messagebox.showerror("Error", "The DuckDB backend requires the duckdb package.")
+                return 1
+            if is_sample_enabled and sample_type == "households":
+                con.register(
+                    "sampled_households",
+                    pd.DataFrame({"HH_ID": sampled_households}),
+                )
+            elif is_sample_enabled and sample_type == "individuals":
+                con.register(
+                    "sampled_individuals",
+                    pd.DataFrame({"ID": sampled_individuals}),
+                )
+            chunk_columns = {}
+
+        # Function used to read one pyramid file of a month
+        def read_month_pyramid(pyramid_type, correct_pyramid, vars_to_load, skipped, chunk_rows=None, pushed=None):
+            if skipped:
+                # Only the columns are needed from a file without any sampled households
+                return (
+                    read_pyramid_csv(
+                        correct_pyramid, usecols=vars_to_load, nrows=EMPTY_PYRAMID_SNIFF_ROWS
+                    ).iloc[:0],
+                    None,
+                )
+            read_method = None
             if is_sample_enabled:
-                if sample_type == "households":
-                    pyramid_iteration = pyramid_iteration[
-                        pyramid_iteration["HH_ID"].astype(str).isin(sampled_households)
-                    ]
-                elif sample_type == "individuals":
-                    if "MEM_ID" in pyramid_iteration.columns:
-                        # For pyramids that have individual-level data
-                        pyramid_iteration = pyramid_iteration[
-                            (
-                                pyramid_iteration["HH_ID"].astype(str)
-                                + pyramid_iteration["MEM_ID"].astype(str).str.zfill(2)
-                            ).isin(sampled_individuals)
-                        ]
-                    else:
-                        # For household-level pyramids, just filter by the household part of the individual IDs
-                        sampled_households = [
-                            id[:8] for id in sampled_individuals
-                        ]  # Assuming HH_ID is 8 digits
-                        pyramid_iteration = pyramid_iteration[
-                            pyramid_iteration["HH_ID"]
-                            .astype(str)
-                            .isin(sampled_households)
-                        ]
-            # Storing the pyramid iteration to the data dictionary
-            current_pyramids[pyramid_type] = pyramid_iteration
-
-        # Merge pyramids for current month
-        merged_df = None
-        individual_pyramids = []
-        household_pyramids = []
-
-        # Separate individual and household level pyramids
-        for ptype, df in current_pyramids.items():
-            print(f"Processing {ptype}")
-            # Remove duplicate columns except for key columns
-            if ptype in ["INDIV_INC_MONTHLY", "PEOPLE_WAVES"]:
-                individual_pyramids.append(df)
+                read_method = pyramid_read_method(correct_pyramid, index_households, file_index)
+
+            # Function used to keep the sampled rows that pass the row filters
+            def read_filter(pyramid_iteration):
+                if is_sample_enabled:
+                    pyramid_iteration = sample_filter(pyramid_iteration)
+                if pushed is not None:
+                    pyramid_iteration = pyramid_iteration[pushed.mask(pyramid_iteration)]
+                return pyramid_iteration
+
+            # Filtered pyramids are read in chunks
+            if pushed is not None and not chunk_rows:
+                chunk_rows = config.get("MEMORY_CHUNK_ROWS", 200000)
+            pyramid_iteration = read_pyramid_file(
+                correct_pyramid,
+                vars_to_load,
+                index_households,
+                file_index,
+                chunk_rows=chunk_rows,
+                row_filter=read_filter if is_sample_enabled or pushed is not None else None,
+                pushdown=pushed,
+            )
+            # Sampling and filtering the pyramid if desired
+            if is_sample_enabled or pushed is not None:
+                pyramid_iteration = read_filter(pyramid_iteration)
+            return pyramid_iteration, read_method
+
+        # Function used to estimate the memory a pyramid takes once read
+        def estimated_read_bytes(correct_pyramid, vars_to_load):
+            file_bytes = os.path.getsize(correct_pyramid)
+            if pyramid_file_compression(correct_pyramid) is not None:
+                file_bytes *= COMPRESSED_PYRAMID_EXPANSION
+            columns = file_columns.get(correct_pyramid) or vars_to_load
+            fraction = len(vars_to_load) / max(len(columns), 1)
+            # Only the sampled households' rows are kept
+            if is_sample_enabled and config.get("TOTAL_HOUSEHOLDS"):
+                fraction *= min(1.0, len(index_households) / float(config["TOTAL_HOUSEHOLDS"]))
+            return file_bytes * fraction
+
+        # Function used to read every pyramid of a month ahead of time
+        def read_prefetched_month(month):
+            month_pyramids = {}
+            month_read_methods = []
+            month_pushdown = row_filter_pushdown(row_filter, month_plans[month]) if row_filter is not None else {}
+            for pyramid_type, (correct_pyramid, vars_to_load) in month_plans[month].items():
+                skipped = is_sample_enabled and not file_has_households(
+                    file_index, correct_pyramid, index_households
+                )
+                month_pyramids[pyramid_type], read_method = read_month_pyramid(
+                    pyramid_type, correct_pyramid, vars_to_load, skipped, pushed=month_pushdown.get(pyramid_type)
+                )
+                month_read_methods.append(read_method)
+            return month_pyramids, month_read_methods
+
+        # Function used to merge the pyramids of a month and drop the rows failing the row filters
+        def merge_month(current_pyramids, month):
+            merged_df = None
+            individual_pyramids = []
+            household_pyramids = []
+
+            # Separate individual and household level pyramids
+            for ptype, df in current_pyramids.items():
+                # Remove duplicate columns except for key columns
+                if ptype in ["INDIV_INC_MONTHLY", "PEOPLE_WAVES"]:
+                    individual_pyramids.append(df)
+                else:
+                    household_pyramids.append(df)
+
+            # Function to load a merge input that was spilled to disk
+            def load_spilled(df):
+                if isinstance(df, str):
+                    spill_path = df
+                    df = pd.read_pickle(spill_path)
+                    os.remove(spill_path)
+                return df
+
+            # Function to handle duplicate columns during merge
+            def merge_with_duplicate_handling(left, right, on):
+                # Get duplicate columns (excluding merge keys)
+                duplicate_cols = set(left.columns) & set(right.columns) - set(on)
+                if duplicate_cols:
+                    # Drop duplicate columns from right dataframe
+                    right = right.drop(columns=duplicate_cols)
+                return pd.merge(left, right, on=on, how="outer")
+
+            # Merge individual level pyramids
+            if individual_pyramids:
+                update_status(f"Merging the individual pyramids of {month.strftime('%m-%Y')}")
+                merged_individual = load_spilled(individual_pyramids[0])
+                for right_df in individual_pyramids[1:]:
+                    merged_individual = merge_with_duplicate_handling(
+                        merged_individual, load_spilled(right_df), on=["HH_ID", "MEM_ID"]
+                    )
+
+            # Merge household level pyramids
+            if household_pyramids:
+                update_status(f"Merging the household pyramids of {month.strftime('%m-%Y')}")
+                merged_household = load_spilled(household_pyramids[0])
+                for right_df in household_pyramids[1:]:
+                    merged_household = merge_with_duplicate_handling(
+                        merged_household, load_spilled(right_df), on=["HH_ID"]
+                    )
+
+            # Final merge between individual and household level data
+            if individual_pyramids and household_pyramids:
+                merged_df = merge_with_duplicate_handling(
+                    merged_individual, merged_household, on=["HH_ID"]
+                )
+            elif individual_pyramids:
+                merged_df = merged_individual
             else:
-                household_pyramids.append(df)
-
-        # Function to handle duplicate columns during merge
-        def merge_with_duplicate_handling(left, right, on):
-            # Get duplicate columns (excluding merge keys)
-            duplicate_cols = set(left.columns) & set(right.columns) - set(on)
-            if duplicate_cols:
-                print(f"Dropping duplicate columns: {duplicate_cols}")
-                # Drop duplicate columns from right dataframe
-                right = right.drop(columns=duplicate_cols)
-            return pd.merge(left, right, on=on, how="outer")
-
-        # Merge individual level pyramids
-        if individual_pyramids:
-            print("Merging individual pyramids...")
-            merged_individual = individual_pyramids[0]
-            for right_df in individual_pyramids[1:]:
-                merged_individual = merge_with_duplicate_handling(
-                    merged_individual, right_df, on=["HH_ID", "MEM_ID"]
+                merged_df = merged_household
+
+            # Dropping the rows failing the row filters
+            if row_filter is not None:
+                merged_df = (
+                    merged_df[row_filter.mask(merged_df)]
+                    .drop(columns=[col for col in filter_only_columns if col in merged_df.columns])
+                    .reset_index(drop=True)
                 )
+            return merged_df
+
+        # Reading the next months in a background thread
+        prefetch_months = int(config.get("PREFETCH_MONTHS") or 0)
+        prefetcher = None
+        if prefetch_months and backend == "pandas" and output_tables is None:
+            prefetcher = ThreadPoolExecutor(max_workers=1)
+        prefetched = {}
+        prefetch_count = 0
+        prefetch_wait = 0.0
+
+        # Function used to start reading the months after the given month
+        def schedule_prefetch(month, month_bytes):
+            depth = prefetch_months
+            headroom = governor.headroom_bytes()
+            if headroom is not None and month_bytes:
+                depth = min(depth, int(headroom // month_bytes))
+                if depth < prefetch_months:
+                    governor.record("Prefetch Depth Reduced")
+            for upcoming in [m for m in month_plans if m > month][:depth]:
+                if upcoming in prefetched or not month_plans[upcoming]:
+                    continue
+                # Months whose aggregates are cached are never read
+                if aggregation is not None and aggregate_cache_path(
+                    aggregation_key, upcoming, month_plans[upcoming]
+                ).exists():
+                    continue
+                prefetched[upcoming] = prefetcher.submit(read_prefetched_month, upcoming)
+
+        # Looping through each time period
+        while current_month <= end_month:
+            if not running_flag():
+                update_status("Operation cancelled by user")
+                return 1
+            update_status(f"Building {current_month.strftime('%m-%Y')}")
+            # The file and variables of the current month's pyramids
+            month_files = month_plans[current_month]
+            # Pyramids of the current month whose files hold none of the sampled households
+            skipped_types = set()
+            for pyramid_type, (correct_pyramid, vars_to_load) in month_files.items():
+                if is_sample_enabled and not file_has_households(
+                    file_index, correct_pyramid, index_households
+                ):
+                    skipped_types.add(pyramid_type)
+                    skipped_files += 1
+            # Row filters decided by a single pyramid are applied while reading it
+            month_pushdown = {}
+            if row_filter is not None:
+                month_pushdown = row_filter_pushdown(row_filter, month_files)
+                filter_pushdowns += len(set(month_pushdown) - skipped_types)
+
+            # Cached aggregates of a month
+            if aggregation is not None and month_files:
+                month_cache_path = aggregate_cache_path(aggregation_key, current_month, month_files)
+                if month_cache_path.exists():
+                    aggregate_partials.append(pd.read_pickle(month_cache_path))
+                    cached_months += 1
+                    current_month = add_month(current_month)
+                    continue
+
+            # In tables mode each table gets the rows of its own pyramids
+            if output_tables is not None:
+                if add_table_rows(month_files, skipped_types, current_month == end_month):
+                    return 1
+                current_month = add_month(current_month)
+                continue
 
-        # Merge household level pyramids
-        if household_pyramids:
-            print("Merging household pyramids...")
-            merged_household = household_pyramids[0]
-            for right_df in household_pyramids[1:]:
-                merged_household = merge_with_duplicate_handling(
-                    merged_household, right_df, on=["HH_ID"]
+            if backend == "duckdb":
+                if month_files:
+                    # Reading sampled rows through the columnar store or the row index
+                    seek_frames = {}
+                    for pyramid_type, (correct_pyramid, vars_to_load) in month_files.items():
+                        # DuckDB decompresses gzip and zstd files itself but cannot read zip archives
+                        archived = pyramid_file_compression(correct_pyramid) == "zip"
+                        if pyramid_type in skipped_types:
+                            if archived:
+                                seek_frames[pyramid_type] = f"seek_{len(seek_frames)}"
+                                con.register(
+                                    seek_frames[pyramid_type],
+                                    read_pyramid_csv(
+                                        correct_pyramid, usecols=vars_to_load, nrows=EMPTY_PYRAMID_SNIFF_ROWS
+                                    ),
+                                )
+                            continue
+                        read_method = pyramid_read_method(
+                            correct_pyramid, index_households, file_index
+                        )
+                        if is_sample_enabled:
+                            read_methods[read_method] = read_methods.get(read_method, 0) + 1
+                        if read_method != "full scan" or archived:
+                            seek_frames[pyramid_type] = f"seek_{len(seek_frames)}"
+                            con.register(
+                                seek_frames[pyramid_type],
+                                read_pyramid_file(
+                                    correct_pyramid,
+                                    vars_to_load,
+                                    index_households,
+                                    file_index,
+                                    pushdown=month_pushdown.get(pyramid_type),
+                                ),
+                            )
+                    # Widening chunk columns whose type changes in this month, as pd.concat would
+                    month_query = duckdb_month_query(
+                        month_files,
+                        sample_type if is_sample_enabled else None,
+                        skipped_types,
+                        seek_frames,
+                        month_pushdown,
+                        row_filter,
+                    )
+                    # When DuckDB runs out of memory the month is merged with pandas, reading in chunks
+                    try:
+                        con.execute(f"CREATE OR REPLACE TEMP TABLE month_rows AS {month_query}")
+                        month_query = "SELECT * FROM month_rows"
+                    except duckdb.OutOfMemoryException:
+                        build_warnings.append(
+                            f"DuckDB ran out of memory reading {current_month.strftime('%m-%Y')}, which was merged with pandas"
+                        )
+                        update_status(f"DuckDB ran out of memory, merging {current_month.strftime('%m-%Y')} with pandas")
+                        month_pyramids = {
+                            pyramid_type: read_month_pyramid(
+                                pyramid_type,
+                                correct_pyramid,
+                                vars_to_load,
+                                pyramid_type in skipped_types,
+                                config.get("MEMORY_CHUNK_ROWS", 200000),
+                                month_pushdown.get(pyramid_type),
+                            )[0]
+                            for pyramid_type, (correct_pyramid, vars_to_load) in month_files.items()
+                        }
+                        con.register("pandas_month", merge_month(month_pyramids, current_month))
+                        del month_pyramids
+                        seek_frames["pandas_month"] = "pandas_month"
+                        month_query = "SELECT * FROM pandas_month"
+                    if aggregation is not None or wide_panel is not None:
+                        month_df = duckdb_to_pandas(con.execute(month_query).df())
+                        month_df = month_df.drop(columns=[col for col in filter_only_columns if col in month_df.columns])
+                        for view in seek_frames.values():
+                            con.unregister(view)
+                        con.execute("DROP TABLE IF EXISTS month_rows")
+                        if wide_panel is not None:
+                            month_df, _ = output_schema.conform(month_df)
+                            wide_panel.add_month(current_month, month_df, output_schema)
+                        elif add_aggregate(month_df, month_cache_path):
+                            return 1
+                        current_month = add_month(current_month)
+                        continue
+                    month_types = {
+                        row[0]: row[1]
+                        for row in con.execute(f"DESCRIBE {month_query}").fetchall()
+                    }
+                    if not chunk_columns:
+                        # Giving the chunk every column of the output schema
+                        select_list = ", ".join(
+                            duckdb_quote(col)
+                            if col in month_types
+                            else f"CAST(NULL AS {output_schema.duckdb_type(col)}) AS {duckdb_quote(col)}"
+                            for col in output_schema.dtypes
+                        )
+                        con.execute(f"CREATE TABLE chunk AS SELECT {select_list} FROM ({month_query})")
+                        chunk_columns = {
+                            row[0]: row[1]
+                            for row in con.execute("DESCRIBE chunk").fetchall()
+                        }
+                    else:
+                        for col, col_type in chunk_columns.items():
+                            month_type = month_types.get(col, col_type)
+                            if month_type != col_type:
+                                wider_type = (
+                                    "DOUBLE"
+                                    if {month_type, col_type} <= {"BIGINT", "DOUBLE"}
+                                    else "VARCHAR"
+                                )
+                                if wider_type != col_type:
+                                    con.execute(
+                                        f"ALTER TABLE chunk ALTER {duckdb_quote(col)} TYPE {wider_type}"
+                                    )
+                                    chunk_columns[col] = wider_type
+                        # Aligning columns to the chunk, missing columns are filled with nulls
+                        select_list = ", ".join(
+                            duckdb_quote(col) if col in month_types else "NULL"
+                            for col in chunk_columns
+                        )
+                        con.execute(
+                            f"INSERT INTO chunk SELECT {select_list} FROM ({month_query})"
+                        )
+                    for view in seek_frames.values():
+                        con.unregister(view)
+                    con.execute("DROP TABLE IF EXISTS month_rows")
+                    # Counting distinct rows
+                    chunk_rows = con.execute(
+                        "SELECT COUNT(*) FROM (SELECT DISTINCT * FROM chunk)"
+                    ).fetchone()[0]
+                    chunk_sample = pd.DataFrame()
+                    if not (is_partitioned or is_database) and not size_estimator.calibrated:
+                        con.register(
+                            "sample_positions",
+                            pd.DataFrame({"ROW": size_estimator.sample_positions(chunk_rows)}),
+                        )
+                        chunk_sample = duckdb_to_pandas(
+                            con.execute(
+                                "SELECT * FROM chunk WHERE rowid IN (SELECT ROW FROM sample_positions) ORDER BY rowid"
+                            ).df()
+                        )
+                        con.unregister("sample_positions")
+                    row_bytes = size_estimator.bytes_per_row(chunk_sample) or 0
+                    update_status(
+                        f"Current chunk size: {chunk_rows} rows (~{chunk_rows * row_bytes / (1024**3):.2f} GB on disk)"
+                    )
+
+                # Close to the memory budget the chunk is exported early
+                flush_early = bool(chunk_columns) and governor.near_limit()
+                if flush_early:
+                    governor.record("Early Flushes")
+                    if "DuckDB Single Thread" not in governor.events:
+                        governor.record("DuckDB Single Thread")
+                        con.execute("SET threads = 1")
+
+                # Check file size and exporting if chunk exceeds the desired file size
+                if chunk_columns and (
+                    is_partitioned
+                    or is_database
+                    or chunk_rows * row_bytes >= file_size_bytes
+                    or current_month == end_month
+                    or flush_early
+                ):
+                    chunk_df = duckdb_to_pandas(
+                        con.execute("SELECT * FROM chunk ORDER BY rowid").df()
+                    )
+                    chunk_df, _ = output_schema.conform(chunk_df)
+                    chunk_df = exported_rows.drop_seen(chunk_df)
+                    con.execute("DROP TABLE chunk")
+                    chunk_columns = {}
+                    chunk_df = export_parts(chunk_df, current_month == end_month or flush_early)
+                    # Rows short of a full part start the next chunk
+                    if len(chunk_df):
+                        con.register("remainder", chunk_df)
+                        con.execute("CREATE TABLE chunk AS SELECT * FROM remainder")
+                        con.unregister("remainder")
+                        chunk_columns = {
+                            row[0]: row[1]
+                            for row in con.execute("DESCRIBE chunk").fetchall()
+                        }
+                    del chunk_df
+
+                # Move to next month
+                current_month = add_month(current_month)
+                continue
+
+            # Close to the memory budget the rows carried over are exported early
+            if not (is_partitioned or is_database) and not continuing_df.empty and governor.near_limit():
+                governor.record("Early Flushes")
+                export_chunk(continuing_df)
+                continuing_df = pd.DataFrame()
+
+            # Dictionary to store current month's pyramids
+            current_pyramids = {}
+            if current_month in prefetched:
+                wait_start = time.time()
+                current_pyramids, month_read_methods = prefetched.pop(current_month).result()
+                prefetch_wait += time.time() - wait_start
+                prefetch_count += 1
+                for read_method in month_read_methods:
+                    if read_method is not None:
+                        read_methods[read_method] = read_methods.get(read_method, 0) + 1
+            else:
+                for pyramid_type, (correct_pyramid, vars_to_load) in month_files.items():
+                    if not running_flag():
+                        update_status("Operation cancelled by user")
+                        return 1
+
+                    # Spilling the pyramids already read when this read would pass the soft limit
+                    headroom = governor.headroom_bytes()
+                    if (
+                        headroom is not None
+                        and pyramid_type not in skipped_types
+                        and headroom < estimated_read_bytes(correct_pyramid, vars_to_load)
+                    ):
+                        for read_type in list(current_pyramids):
+                            if not isinstance(current_pyramids[read_type], str):
+                                os.makedirs(spill_dir, exist_ok=True)
+                                spill_path = os.path.join(spill_dir, f"{read_type}.pkl")
+                                current_pyramids[read_type].to_pickle(spill_path)
+                                governor.record("Spilled Merge Inputs")
+                                current_pyramids[read_type] = spill_path
+
+                    # Reading in the pyramid for the selected columns
+                    read_chunk_rows = None
+                    if pyramid_type not in skipped_types and governor.near_limit():
+                        governor.record("Chunked Reads")
+                        read_chunk_rows = config.get("MEMORY_CHUNK_ROWS", 200000)
+                    pyramid_iteration, read_method = read_month_pyramid(
+                        pyramid_type,
+                        correct_pyramid,
+                        vars_to_load,
+                        pyramid_type in skipped_types,
+                        read_chunk_rows,
+                        month_pushdown.get(pyramid_type),
+                    )
+                    if read_method is not None:
+                        read_methods[read_method] = read_methods.get(read_method, 0) + 1
+                    current_pyramids[pyramid_type] = pyramid_iteration
+
+            # Reading the next months while this one is merged
+            if prefetcher is not None and not governor.near_limit():
+                schedule_prefetch(
+                    current_month,
+                    sum(
+                        df.memory_usage(deep=True).sum()
+                        for df in current_pyramids.values()
+                        if not isinstance(df, str)
+                    ),
                 )
 
-        # Final merge between individual and household level data
-        if individual_pyramids and household_pyramids:
-            print("Performing final merge...")
-            merged_df = merge_with_duplicate_handling(
-                merged_individual, merged_household, on=["HH_ID"]
+            # Merge pyramids for current month
+            merged_df = merge_month(current_pyramids, current_month)
+
+            # In aggregation mode only the month's aggregates are kept
+            if aggregation is not None:
+                if add_aggregate(merged_df, month_cache_path):
+                    return 1
+                current_month = add_month(current_month)
+                continue
+
+            # Giving the month the output schema
+            merged_df, widened = output_schema.conform(merged_df)
+
+            # In wide mode the month's rows only fill their month's columns
+            if wide_panel is not None:
+                wide_panel.add_month(current_month, merged_df, output_schema)
+                current_month = add_month(current_month)
+                continue
+
+            # Concatenate with continuing DataFrame
+            if continuing_df.empty:
+                continuing_df = merged_df
+            else:
+                # Only columns whose type was not in the catalog can need widening
+                for col in widened:
+                    continuing_df[col] = continuing_df[col].astype(output_schema.dtypes[col])
+                continuing_df = pd.concat([continuing_df, merged_df], ignore_index=True)
+
+            continuing_df = exported_rows.drop_seen(continuing_df)
+
+            # Exporting every part the chunk fills, the rest carries over to the next month
+            continuing_df = export_parts(continuing_df, current_month == end_month)
+            if continuing_df.empty:
+                continuing_df = pd.DataFrame()
+
+            # Move to next month
+            current_month = add_month(current_month)
+    finally:
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=False, cancel_futures=True)
+        if con is not None:
+            con.close()
+        if not config.get("DUCKDB_TEMP_DIRECTORY"):
+            shutil.rmtree(duckdb_temp_directory, ignore_errors=True)
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # Exporting the aggregate table
+    if aggregation is not None:
+        if aggregate_partials:
+            export_dataframe(
+                aggregate_table(aggregate_partials, aggregation),
+                os.path.join(output_folder, "pyramid_aggregates"),
+                ".parquet" if is_partitioned else file_format,
+                compression,
+                notes=build_warnings,
             )
-        elif individual_pyramids:
-            merged_df = merged_individual
-        else:
-            merged_df = merged_household
+        log_notes.append(
+            f"Output Mode: aggregates\n"
+            f"Group By: {', '.join(aggregation['GROUP_BY'])}\n"
+            f"Weight: {aggregation['WEIGHT'] or 'none'}\n"
+            f"Months Computed: {len(aggregate_partials) - cached_months}\n"
+            f"Months From Cache: {cached_months}"
+        )
 
-        # Concatenate with continuing DataFrame
-        if continuing_df.empty:
-            continuing_df = merged_df
-        else:
-            print("Concatenating with previous data...")
-            # Align columns first and handle duplicates
-            merged_df = merged_df.reindex(
-                columns=continuing_df.columns, fill_value=None
+    if prefetcher is not None:
+        log_notes.append(
+            f"Prefetched Months: {prefetch_count} "
+            f"(up to {prefetch_months} ahead, {prefetch_wait:.1f} s spent waiting on reads)"
+        )
+
+    # Writing the wide panel once
+    if wide_panel is not None:
+        export_dataframe(
+            wide_panel.to_frame(output_schema),
+            os.path.join(output_folder, "pyramid_wide"),
+            ".parquet" if is_partitioned else file_format,
+            compression,
+            notes=build_warnings,
+        )
+        log_notes.append(
+            f"Output Mode: wide\n"
+            f"Level: {wide_panel.level}\n"
+            f"IDs Written: {int(wide_panel.observed.sum())} of {len(wide_panel.ids)}\n"
+            f"Columns: {wide_panel.column_count} ({len(wide_panel.variables)} variables x {len(wide_panel.months)} months)\n"
+            f"Rows Without A Listed ID: {wide_panel.unmatched_rows}"
+        )
+
+    # Describing the tables and how they join in a manifest next to them
+    if output_tables is not None:
+        manifest = {
+            "tables": {
+                table: {
+                    "pyramids": state["types"],
+                    "keys": state["keys"],
+                    "columns": {col: dtype or "float64" for col, dtype in state["schema"].dtypes.items()},
+                    "rows": state["rows"],
+                    "files": state["parts"],
+                }
+                for table, state in output_tables.items()
+            },
+            "joins": [
+                {"from": left, "to": right, "on": keys}
+                for left, right, keys in OUTPUT_TABLE_JOINS
+                if left in output_tables and right in output_tables
+            ],
+        }
+        with open(os.path.join(output_folder, "manifest.yaml"), "w") as f:
+            yaml.dump(manifest, f, sort_keys=False)
+        log_notes.append(
+            "Output Mode: tables\n"
+            + "\n".join(
+                f"{table}: {state['rows']} rows in {len(state['parts'])} files"
+                for table, state in output_tables.items()
             )
-            continuing_df = pd.concat([continuing_df, merged_df], ignore_index=True)
+        )
+
+    # Summarise the row groups of every partition file
+    if is_partitioned and output_mode == "microdata":
+        finalize_partitioned_parquet(dataset_dir, dataset_metadata, build_warnings)
+
+    # Indexing the database after the load
+    if is_database and os.path.exists(database_path):
+        if output_tables is not None:
+            index_tables = {table: state["keys"] for table, state in output_tables.items() if state["rows"]}
+        else:
+            index_tables = {"pyramids": DATABASE_INDEX_COLUMNS}
+        index_start = time.time()
+        indexes = index_database(database_path, index_tables)
+        log_notes.append(
+            f"Database: {os.path.basename(database_path)} "
+            f"({', '.join(index_tables)}; {indexes} indexes built in {time.time() - index_start:.1f} s)"
+        )
 
-        print(
-            f"Current DataFrame size: {continuing_df.memory_usage(deep=True).sum() / (1024**3):.2f} GB"
+    if row_filter is not None:
+        log_notes.append(f"Pyramid File Reads Filtered While Reading: {filter_pushdowns}")
+
+    if is_sample_enabled:
+        log_notes.append(
+            f"Pyramid File Reads Skipped (no sampled households): {skipped_files}\n"
+            + "\n".join(
+                f"Pyramid File Reads ({method}): {count}"
+                for method, count in sorted(read_methods.items())
+            )
         )
-        continuing_df = continuing_df.drop_duplicates()
 
-        # Check file size and exporting if chunk exceeds the desired file size
-        df_size = continuing_df.memory_usage(deep=True).sum()
-        if df_size >= file_size_bytes or current_month == end_month:
-            # Export to file
-            file_path = os.path.join(output_folder, f"pyramid_part_{file_counter}")
-            export_dataframe(continuing_df, file_path, file_format)
-            # Reset continuing_df and increment counter
-            continuing_df = pd.DataFrame()
-            file_counter += 1
+    # Duplicate rows are dropped across the whole build
+    duplicate_rows = exported_rows.dropped + sum(
+        state["exported"].dropped for state in (output_tables or {}).values()
+    )
+    if duplicate_rows:
+        log_notes.append(f"Duplicate Rows Dropped: {duplicate_rows}")
+
+    if governor.budget_bytes is not None:
+        log_notes.append(governor.summary())
 
-        # Move to next month with debugging
-        print(f"Current date before increment: {current_month}")
-        next_month = current_month.month % 12 + 1
-        next_year = current_month.year + (current_month.month // 12)
-        current_month = current_month.replace(month=next_month, year=next_year)
-        print(f"Current date after increment: {current_month}")
-        print(f"End date: {end_month}")
-        print(f"Comparison: {current_month <= end_month}")
+    if build_warnings:
+        log_notes.append("Warnings:\n" + "\n".join(dict.fromkeys(build_warnings)))
+
+    if stata_renamed:
+        log_notes.append(
+            "Stata Variable Names:\n"
+            + "\n".join(f"{col} -> {name}" for col, name in stata_renamed.items())
+        )
+
+    # Keeping the finished build in the result cache for identical builds
+    if cache_directory:
+        try:
+            problems = store_cached_result(
+                cache_directory,
+                cache_key,
+                output_folder,
+                float(config.get("RESULT_CACHE_MAX_GB") or 50) * 1024**3,
+            )
+        except OSError as e:
+            problems = [f"could not store the build ({e})"]
+        if problems:
+            log_notes.append("Result Cache Problems:\n" + "\n".join(problems))
 
     # Export summary log to the output directory
     with open(os.path.join(output_folder, "log.txt"), "w") as f:
         f.write(summary_text)
+        for note in log_notes:
+            f.write(f"\n\n{note}")
 
     return output_folder
 
 
+# Version of the integrity report, part of the cache
+INTEGRITY_VERSION = "integrity-scan-v1"
+
+# Bytes of a pyramid file read at a time by the integrity scan
+INTEGRITY_BLOCK_BYTES = 16 * 1024**2
+
+# Number of lines with the wrong number of fields listed for each file
+INTEGRITY_BAD_LINE_EXAMPLES = 5
+
+
+# This function counts the fields of a raw csv line
+def line_field_count(line):
+    if b'"' not in line:
+        return line.count(b",") + 1
+    return len(next(csv.reader([line.decode("utf-8", errors="replace")])))
+
+
+# This function counts and checks the rows of a pyramid file
+def scan_pyramid_file(path):
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    columns = None
+    rows = 0
+    bad_rows = 0
+    bad_lines = []
+    line_number = 0
+
+    def check_lines(lines):
+        nonlocal columns, rows, bad_rows, line_number
+        for line in lines:
+            line_number += 1
+            line = line.rstrip(b"\r")
+            # Blank lines are skipped by the readers
+            if not line.strip():
+                continue
+            if columns is None:
+                header = line.decode("utf-8-sig", errors="replace")
+                columns = next(csv.reader([header]))
+                continue
+            rows += 1
+            fields = line.count(b",") + 1
+            if fields != len(columns):
+                fields = line_field_count(line)
+            if fields != len(columns):
+                bad_rows += 1
+                if len(bad_lines) < INTEGRITY_BAD_LINE_EXAMPLES:
+                    bad_lines.append([line_number, fields])
+
+    remainder = b""
+    damaged = None
+    # Compressed files are checked and fingerprinted on their decompressed content
+    with open_pyramid_file(path) as f:
+        while True:
+            try:
+                block = f.read(INTEGRITY_BLOCK_BYTES)
+            except Exception as e:
+                if pyramid_file_compression(path) is None:
+                    raise
+                damaged = e
+                break
+            if not block:
+                break
+            digest.update(block)
+            lines = (remainder + block).split(b"\n")
+            remainder = lines.pop()
+            check_lines(lines)
+    if remainder:
+        check_lines([remainder])
+
+    errors = []
+    if damaged is not None:
+        errors.append(f"the file cannot be decompressed ({damaged})")
+    if columns is None:
+        errors.append("the file is empty")
+    elif "HH_ID" not in columns:
+        errors.append("the header has no HH_ID column")
+    if bad_rows:
+        errors.append(
+            f"{bad_rows:,} rows do not have the header's {len(columns)} fields ("
+            + ", ".join(f"line {line} has {fields}" for line, fields in bad_lines)
+            + ")"
+        )
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": digest.hexdigest(),
+        "rows": rows,
+        "columns": columns or [],
+        "errors": errors,
+    }
+
+
+# This function loads the cached scan of each pyramid file
+def load_integrity_scans():
+    report_path = Path(resource_path("pyramid_integrity.json"))
+    if not report_path.exists():
+        return {}
+    try:
+        with open(report_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != INTEGRITY_VERSION:
+        return {}
+    return cache.get("files", {})
+
+
+# This function scans the new or changed pyramid files
+def integrity_scan(config, progress=None, pyramid_types=None, start_month=None, end_month=None):
+    partial = pyramid_types is not None or start_month is not None
+    pyramid_files = [
+        (pyramid_type, file)
+        for pyramid_type in pyramid_types
+        or [
+            "ASPIRATIONAL_WAVES",
+            "CONSUMPTION_MONTHLY",
+            "CONSUMPTION_WAVES",
+            "HH_INC_MONTHLY",
+            "INDIV_INC_MONTHLY",
+            "PEOPLE_WAVES",
+        ]
+        for file in sorted(
+            list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"])),
+            key=pyramid_file_dates,
+        )
+    ]
+    # A date range limits the scan to the files covering its months
+    if start_month is not None and end_month is not None:
+        first, last = start_month.strftime("%Y-%m"), end_month.strftime("%Y-%m")
+        pyramid_files = [
+            (pyramid_type, file)
+            for pyramid_type, file in pyramid_files
+            if any(first <= month <= last for month in pyramid_file_months(file))
+        ]
+    cached_scans = load_integrity_scans()
+    scans = {}
+    stale_files = []
+    for pyramid_type, file in pyramid_files:
+        key = str(file.resolve())
+        stat = os.stat(file)
+        cached = cached_scans.get(key)
+        # Files with the same size and modification time keep their scan
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+            scans[key] = cached
+        else:
+            stale_files.append(file)
+    if progress:
+        progress(len(scans), len(pyramid_files))
+
+    threads = config.get("INTEGRITY_THREADS") or min(4, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        futures = {executor.submit(scan_pyramid_file, file): file for file in stale_files}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                scans[str(file.resolve())] = future.result()
+            except OSError as e:
+                # Unreadable files are reported but never cached
+                scans[str(file.resolve())] = {"size": None, "mtime": None, "rows": 0, "columns": [], "errors": [f"the file cannot be read: {str(e)}"]}
+            if progress:
+                progress(len(scans), len(pyramid_files))
+
+    # Keeping the scans of existing files outside a partial scan
+    if stale_files:
+        if partial:
+            cached_scans.update(scans)
+        else:
+            cached_scans = scans
+        report_path = Path(resource_path("pyramid_integrity.json"))
+        temporary_path = report_path.with_suffix(".json.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(
+                {
+                    "version": INTEGRITY_VERSION,
+                    "files": {key: scan for key, scan in cached_scans.items() if scan["size"] is not None},
+                },
+                f,
+            )
+        os.replace(temporary_path, report_path)
+
+    # Columns added or removed between consecutive files of each pyramid type
+    problems = []
+    drift = []
+    previous = {}
+    for pyramid_type, file in pyramid_files:
+        scan = scans[str(file.resolve())]
+        problems += [f"{pyramid_type} {file.name}: {error}" for error in scan["errors"]]
+        if not scan["columns"]:
+            continue
+        if pyramid_type in previous:
+            previous_file, previous_columns = previous[pyramid_type]
+            added = [col for col in scan["columns"] if col not in previous_columns]
+            removed = [col for col in previous_columns if col not in scan["columns"]]
+            if added or removed:
+                drift.append(
+                    {
+                        "type": pyramid_type,
+                        "file": file.name,
+                        "previous": previous_file,
+                        "added": added,
+                        "removed": removed,
+                    }
+                )
+        previous[pyramid_type] = (file.name, scan["columns"])
+
+    return {
+        "files": len(pyramid_files),
+        "scanned": len(stale_files),
+        "rows": sum(scans[str(file.resolve())]["rows"] for _, file in pyramid_files),
+        "problems": problems,
+        "drift": drift,
+    }
+
+
+# This function writes an integrity report as text
+def integrity_report_text(report):
+    lines = [
+        f"Checked {report['files']:,} pyramid files holding {report['rows']:,} rows "
+        f"({report['scanned']:,} scanned, the rest unchanged since the last scan).",
+        "",
+    ]
+    if report["problems"]:
+        lines.append(f"Problems ({len(report['problems'])}):")
+        lines += [f"  {problem}" for problem in report["problems"]]
+    else:
+        lines.append("Problems: none")
+    lines.append("")
+    if report["drift"]:
+        lines.append("Column changes between consecutive files:")
+        for change in report["drift"]:
+            text = f"  {change['type']} {change['previous']} -> {change['file']}:"
+            if change["added"]:
+                text += " added " + ", ".join(change["added"])
+            if change["removed"]:
+                text += (";" if change["added"] else "") + " removed " + ", ".join(change["removed"])
+            lines.append(text)
+    else:
+        lines.append("Column changes between consecutive files: none")
+    return "\n".join(lines) + "\n"
+
+
+# Version of the variable profiles, part of the cache
+PROFILE_VERSION = "variable-profiles-v1"
+
+# Number of most frequent values kept for each text variable of each file
+PROFILE_TOP_VALUES = 10
+
+# Seconds between saves of the profile cache while the profiler runs
+PROFILE_SAVE_SECONDS = 30
+
+
+# This function finds the months covered by a pyramid file
+def pyramid_file_months(path):
+    dates = [datetime.strptime(date, "%Y%m%d") for date in pyramid_file_dates(path)]
+    if not dates:
+        return []
+    month = dates[0].replace(day=1)
+    months = []
+    while month <= dates[-1]:
+        months.append(month.strftime("%Y-%m"))
+        month = add_month(month)
+    return months
+
+
+# This function reads a pyramid file in chunks
+def pyramid_file_chunks(path):
+    chunk_rows = int(config.get("MEMORY_CHUNK_ROWS") or 200000)
+    store_file = columnar_store_file(path)
+    if store_file is not None:
+        for batch in store_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas().drop(columns=[COLUMNAR_ROW_COLUMN])
+        return
+    with open_pyramid_file(path) as f:
+        yield from pd.read_csv(f, chunksize=chunk_rows, float_precision=PYRAMID_FLOAT_PRECISION)
+
+
+# This function profiles every variable of a pyramid file
+def profile_pyramid_file(path):
+    stat = os.stat(path)
+    totals = {}
+    for chunk in pyramid_file_chunks(path):
+        for var in chunk.columns:
+            values = chunk[var]
+            total = totals.setdefault(
+                var, {"rows": 0, "non_null": 0, "dtypes": [], "ranges": [], "counts": pd.Series(dtype="int64")}
+            )
+            total["rows"] += len(values)
+            total["non_null"] += int(values.notna().sum())
+            total["dtypes"].append(str(values.dtype))
+            if pd.api.types.is_numeric_dtype(values):
+                present = values.dropna()
+                if len(present):
+                    total["ranges"].append((float(present.min()), float(present.max()), float(present.sum())))
+            else:
+                total["counts"] = total["counts"].add(values.value_counts(), fill_value=0)
+    columns = {}
+    for var, total in totals.items():
+        # Combining the types of the chunks into the type of the file
+        dtype = combined_dtype(total["dtypes"])
+        profile = {"rows": total["rows"], "non_null": total["non_null"], "dtype": dtype}
+        if dtype in ("int64", "float64", "bool"):
+            if total["ranges"]:
+                mins, maxs, sums = zip(*total["ranges"])
+                profile["min"] = min(mins)
+                profile["max"] = max(maxs)
+                profile["sum"] = float(sum(sums))
+        else:
+            counts = total["counts"].sort_values(ascending=False, kind="stable").head(PROFILE_TOP_VALUES)
+            profile["top"] = [[str(value), int(count)] for value, count in counts.items()]
+        columns[var] = profile
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "months": pyramid_file_months(path),
+        "columns": columns,
+    }
+
+
+# This function loads the cached profile of each pyramid file
+def load_variable_profiles():
+    profile_path = Path(resource_path("pyramid_variable_profiles.json"))
+    if not profile_path.exists():
+        return {}
+    try:
+        with open(profile_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != PROFILE_VERSION:
+        return {}
+    return cache.get("files", {})
+
+
+# This function writes the profile cache
+def save_variable_profiles(file_profiles):
+    profile_path = Path(resource_path("pyramid_variable_profiles.json"))
+    temporary_path = profile_path.with_suffix(".json.tmp")
+    with open(temporary_path, "w") as f:
+        json.dump({"version": PROFILE_VERSION, "files": file_profiles}, f)
+    os.replace(temporary_path, profile_path)
+
+
+# This function profiles the new or changed pyramid files
+def variable_profiles_builder(config, progress=None):
+    pyramid_files = [
+        (pyramid_type, file)
+        for pyramid_type in [
+            "ASPIRATIONAL_WAVES",
+            "CONSUMPTION_MONTHLY",
+            "CONSUMPTION_WAVES",
+            "HH_INC_MONTHLY",
+            "INDIV_INC_MONTHLY",
+            "PEOPLE_WAVES",
+        ]
+        for file in list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"]))
+    ]
+    cached_profiles = load_variable_profiles()
+    file_profiles = {}
+    stale_files = []
+    for pyramid_type, file in pyramid_files:
+        key = str(file.resolve())
+        stat = os.stat(file)
+        cached = cached_profiles.get(key)
+        # Files with the same type, size and modification time keep their profile
+        if (
+            cached is not None
+            and cached["type"] == pyramid_type
+            and cached["size"] == stat.st_size
+            and cached["mtime"] == stat.st_mtime_ns
+        ):
+            file_profiles[key] = cached
+        else:
+            stale_files.append((pyramid_type, file))
+    if progress:
+        progress(len(file_profiles), len(pyramid_files))
+    if not stale_files:
+        if len(file_profiles) != len(cached_profiles):
+            save_variable_profiles(file_profiles)
+        return file_profiles
+
+    threads = config.get("PROFILE_THREADS") or min(4, os.cpu_count() or 1)
+    last_save = time.time()
+    with ThreadPoolExecutor(max_workers=int(threads)) as executor:
+        futures = {
+            executor.submit(profile_pyramid_file, file): (pyramid_type, file)
+            for pyramid_type, file in stale_files
+        }
+        for future in as_completed(futures):
+            pyramid_type, file = futures[future]
+            file_profiles[str(file.resolve())] = {"type": pyramid_type, **future.result()}
+            # Saving finished files as the pass goes
+            if time.time() - last_save > PROFILE_SAVE_SECONDS:
+                save_variable_profiles(file_profiles)
+                last_save = time.time()
+            if progress:
+                progress(len(file_profiles), len(pyramid_files))
+    save_variable_profiles(file_profiles)
+    return file_profiles
+
+
+# This function combines the file profiles into one summary per variable
+def summarize_variable_profiles(file_profiles):
+    summaries = {}
+    for entry in file_profiles.values():
+        for var, profile in entry["columns"].items():
+            summary = summaries.setdefault(entry["type"], {}).setdefault(
+                var,
+                {"rows": 0, "non_null": 0, "numeric": 0, "sum": 0.0, "min": None, "max": None, "top": {}, "months": set()},
+            )
+            summary["rows"] += profile["rows"]
+            summary["non_null"] += profile["non_null"]
+            summary["months"].update(entry["months"])
+            if "sum" in profile:
+                summary["numeric"] += profile["non_null"]
+                summary["sum"] += profile["sum"]
+                summary["min"] = profile["min"] if summary["min"] is None else min(summary["min"], profile["min"])
+                summary["max"] = profile["max"] if summary["max"] is None else max(summary["max"], profile["max"])
+            for value, count in profile.get("top", []):
+                summary["top"][value] = summary["top"].get(value, 0) + count
+    for pyramid_summaries in summaries.values():
+        for summary in pyramid_summaries.values():
+            summary["non_null_rate"] = summary["non_null"] / summary["rows"] if summary["rows"] else 0.0
+            summary["mean"] = summary["sum"] / summary["numeric"] if summary["numeric"] else None
+            summary["top"] = sorted(summary["top"].items(), key=lambda item: -item[1])[:5]
+            summary["months"] = sorted(summary["months"])
+    return summaries
+
+
+# This function describes the summary of a variable in one line
+def describe_variable_profile(summary):
+    text = f"{summary['non_null_rate']:.1%} non-null of {summary['rows']:,} rows"
+    if summary["mean"] is not None:
+        text += f"; min {summary['min']:g}, max {summary['max']:g}, mean {summary['mean']:.4g}"
+    elif summary["top"]:
+        text += "; top " + ", ".join(
+            f"{value} ({count / max(summary['non_null'], 1):.0%})" for value, count in summary["top"]
+        )
+    if summary["months"]:
+        text += f"; {len(summary['months'])} months from {summary['months'][0]} to {summary['months'][-1]}"
+    return text
+
+
+# This class indexes variable names for instant searches
+class VariableSearchIndex:
+    def __init__(self, entries):
+        # Entries are (category, variable) pairs in display order
+        self.entries = entries
+        self.names = [variable.upper() for _, variable in entries]
+        self.sorted_names = sorted(
+            (name, position) for position, name in enumerate(self.names)
+        )
+        self.trigrams = {}
+        for position, name in enumerate(self.names):
+            for start in range(len(name) - 2):
+                self.trigrams.setdefault(name[start : start + 3], set()).add(position)
+
+    # This function returns the positions of matching entries, prefix matches first
+    def search(self, query):
+        query = query.strip().upper()
+        if not query:
+            return list(range(len(self.entries)))
+
+        # Prefix matches come straight from the sorted names
+        first = bisect.bisect_left(self.sorted_names, (query,))
+        prefix = []
+        while (
+            first < len(self.sorted_names)
+            and self.sorted_names[first][0].startswith(query)
+        ):
+            prefix.append(self.sorted_names[first][1])
+            first += 1
+        prefix.sort()
+
+        # Substring candidates share every trigram of the query
+        if len(query) < 3:
+            candidates = range(len(self.names))
+        else:
+            candidates = sorted(
+                set.intersection(
+                    *(
+                        self.trigrams.get(query[start : start + 3], set())
+                        for start in range(len(query) - 2)
+                    )
+                )
+            )
+        prefixed = set(prefix)
+        return prefix + [
+            position
+            for position in candidates
+            if position not in prefixed and query in self.names[position]
+        ]
+
+
 class CPB_GUI:
     def __init__(self):
         self.root = tk.Tk()
@@ -442,6 +4210,9 @@ class CPB_GUI:
         # Create main container
         self.main_container = ttk.Frame(self.root)
         self.main_container.pack(fill="both", expand=True)
+        # Background variable profiler and the files it has profiled so far
+        self.profile_job = None
+        self.profile_progress = [0, 0]
         # Start with main menu
         self.show_main_menu()
 
@@ -730,6 +4501,33 @@ class CPB_GUI:
         individuals_spinbox.bind("<FocusOut>", validate_individual_value)
         individuals_spinbox.bind("<Return>", validate_individual_value)
 
+        # Sampling design options for drawn samples
+        design_frame = ttk.Frame(options_frame)
+        design_frame.pack(fill="x", pady=2)
+
+        ttk.Label(design_frame, text="Sampling Design:").pack(side="left")
+
+        # Mapping of the sampling designs to the household attributes used as strata
+        sampling_designs = {
+            "Simple random": [],
+            "Stratified by STATE": ["STATE"],
+            "Stratified by REGION_TYPE": ["REGION_TYPE"],
+            "Stratified by STATE and REGION_TYPE": ["STATE", "REGION_TYPE"],
+        }
+        design_combobox = ttk.Combobox(design_frame, width=30, state="disabled")
+        design_combobox["values"] = tuple(sampling_designs)
+        design_combobox.pack(side="left", padx=(5, 0))
+        design_combobox.set("Simple random")
+
+        balanced_panel = tk.BooleanVar(value=False)
+        balanced_panel_check = ttk.Checkbutton(
+            design_frame,
+            text="Balanced panel",
+            variable=balanced_panel,
+            state="disabled",
+        )
+        balanced_panel_check.pack(side="left", padx=(10, 0))
+
         # Function to check consistency of selection of sampling options
         def update_sample_state(*args):
             state = "normal" if sample_enabled.get() else "disabled"
@@ -756,12 +4554,18 @@ class CPB_GUI:
                     individuals_spinbox.configure(state="disabled")
                     ids_file_entry.configure(state="normal")
                     ids_file_button.configure(state="normal")
+                # Sampling designs only apply to drawn samples
+                drawn_state = "disabled" if sample_type.get() == "ids" else "normal"
+                design_combobox.configure(state="disabled" if drawn_state == "disabled" else "readonly")
+                balanced_panel_check.configure(state=drawn_state)
             else:
                 # Disable all input widgets when sampling is disabled
                 households_spinbox.configure(state="disabled")
                 individuals_spinbox.configure(state="disabled")
                 ids_file_entry.configure(state="disabled")
                 ids_file_button.configure(state="disabled")
+                design_combobox.configure(state="disabled")
+                balanced_panel_check.configure(state="disabled")
                 
                 # Reset to max values if disabled
                 households_value.set(str(config["TOTAL_HOUSEHOLDS"]))
@@ -972,12 +4776,62 @@ class CPB_GUI:
 
         format_var = tk.StringVar()
         format_combobox = ttk.Combobox(format_frame, width=10, state="readonly")
-        format_combobox["values"] = (".csv", ".dta", ".parquet")
+        format_combobox["values"] = (".csv", ".dta", ".parquet", ".parquet (partitioned)", ".feather", ".sqlite", ".duckdb")
         format_combobox.pack(side="left", padx=(5, 0))
 
         # Set default after a brief delay to ensure widget is fully initialized
         format_combobox.after(10, lambda: format_combobox.set(".csv"))
 
+        # Option to add STATE to the year/month partitions of a partitioned dataset
+        partition_state = tk.BooleanVar(value=False)
+        partition_state_check = ttk.Checkbutton(
+            format_frame,
+            text="Partition by STATE",
+            variable=partition_state,
+            state="disabled",
+        )
+        partition_state_check.pack(side="left", padx=(10, 0))
+
+        # Compression row
+        compression_frame = ttk.Frame(export_frame)
+        compression_frame.pack(fill="x", pady=5)
+
+        ttk.Label(compression_frame, text="Compression:").pack(side="left")
+
+        compression_combobox = ttk.Combobox(compression_frame, width=10, state="readonly")
+        compression_combobox["values"] = ("none", "gzip", "zstd")
+        compression_combobox.pack(side="left", padx=(5, 0))
+        compression_combobox.set("none")
+
+        # Function to enable the partition option only for partitioned output
+        def update_partition_state(event=None):
+            if format_combobox.get() == ".parquet (partitioned)":
+                partition_state_check.configure(state="normal")
+            else:
+                partition_state.set(False)
+                partition_state_check.configure(state="disabled")
+
+        # Function to offer the compression codecs available for the selected format
+        def update_compression_options(event=None):
+            if format_combobox.get().startswith(".parquet"):
+                compression_combobox["values"] = ("snappy", "zstd", "lz4", "gzip", "none")
+                compression_combobox.set("zstd")
+            elif format_combobox.get() == ".feather":
+                compression_combobox["values"] = FEATHER_COMPRESSIONS
+                compression_combobox.set("none")
+            elif format_combobox.get() in DATABASE_FORMATS:
+                # Database files are written uncompressed
+                compression_combobox["values"] = ("none",)
+                compression_combobox.set("none")
+            else:
+                compression_combobox["values"] = ("none", "gzip", "zstd")
+                compression_combobox.set("none")
+
+        format_combobox.bind(
+            "<<ComboboxSelected>>",
+            lambda event: [update_partition_state(), update_compression_options()],
+        )
+
         # File Size row
         size_frame = ttk.Frame(export_frame)
         size_frame.pack(fill="x", pady=5)
@@ -1031,6 +4885,38 @@ class CPB_GUI:
         seed_entry.bind("<FocusOut>", validate_seed)
         seed_entry.bind("<Return>", validate_seed)
 
+        # Backend row
+        backend_frame = ttk.Frame(export_frame)
+        backend_frame.pack(fill="x", pady=(5, 0))
+
+        ttk.Label(backend_frame, text="Backend:").pack(side="left")
+
+        backend_combobox = ttk.Combobox(backend_frame, width=10, state="readonly")
+        backend_combobox["values"] = ("pandas", "duckdb")
+        backend_combobox.pack(side="left", padx=(5, 0))
+        backend_combobox.set("pandas")
+
+        # Output mode row
+        output_mode_frame = ttk.Frame(export_frame)
+        output_mode_frame.pack(fill="x", pady=(5, 0))
+
+        ttk.Label(output_mode_frame, text="Output Mode:").pack(side="left")
+
+        output_mode_combobox = ttk.Combobox(output_mode_frame, width=10, state="readonly")
+        output_mode_combobox["values"] = ("Microdata", "Aggregates", "Tables", "Wide")
+        output_mode_combobox.pack(side="left", padx=(5, 0))
+        output_mode_combobox.set("Microdata")
+
+        # Row filter row, combined with the FILTERS of the variables file
+        row_filter_frame = ttk.Frame(export_frame)
+        row_filter_frame.pack(fill="x", pady=(5, 0))
+
+        ttk.Label(row_filter_frame, text="Row Filter:").pack(side="left")
+
+        row_filter_var = tk.StringVar()
+        row_filter_entry = ttk.Entry(row_filter_frame, textvariable=row_filter_var, width=30)
+        row_filter_entry.pack(side="left", padx=(5, 0))
+
         ### DATA BUILDER DRIVER
         # Button to initiate the data construction
         construct_button = ttk.Button(
@@ -1043,6 +4929,14 @@ class CPB_GUI:
 
         # Function to initiate building summary confirmation window
         def show_summary_popup():
+            # Checking the row filter before asking for confirmation
+            if row_filter_var.get().strip():
+                try:
+                    RowFilter(row_filter_var.get())
+                except ValueError as e:
+                    messagebox.showerror("Error", f"Invalid row filter: {e}")
+                    return
+
             # Create popup window
             popup = tk.Toplevel(self.root)
             popup.title("Summary")
@@ -1074,9 +4968,13 @@ Data Initialization Date: {config['INITIALIZATION_DATE']}
 
 Data Directory: {data_dir.get()}
 Output Directory: {output_dir.get()}
-Export Format: {format_combobox.get()}
+Export Format: {format_combobox.get()}{" by STATE" if partition_state.get() else ""}
+Compression: {compression_combobox.get()}
 File Size: {file_size_var.get()} GB
 Random Seed: {seed_var.get()}
+Backend: {backend_combobox.get()}
+Output Mode: {output_mode_combobox.get()}
+Row Filter: {row_filter_var.get().strip() or "none"}
 
 Date Range: {start_var.get()} to {end_var.get()}
 
@@ -1100,6 +4998,9 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                     )
                     summary_text += f"\n\nSample Observations: {sample_text}"
                     summary_text += f"\nSample Count: {sample_value}"
+                    summary_text += f"\nSampling Design: {design_combobox.get()}"
+                    if balanced_panel.get():
+                        summary_text += " (balanced panel)"
                 else:  # ids
                     summary_text += f"\n\nSample Type: {sample_text}"
                     summary_text += f"\nIDs File: {ids_file.get()}"
@@ -1122,7 +5023,7 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
 
             # Function to display the progress of the data construction
             def show_progress_window():
-                popup.geometry("250x200")
+                popup.geometry("250x240")
                 popup.running = True
 
                 # Store the main window's current position
@@ -1139,7 +5040,7 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
 
                 # Center the popup relative to main window
                 popup_width = 250
-                popup_height = 200
+                popup_height = 240
                 x = main_x + (self.root.winfo_width() - popup_width) // 2
                 y = main_y + (self.root.winfo_height() - popup_height) // 2
 
@@ -1161,6 +5062,18 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                 )
                 progress_bar.pack()
 
+                # Latest progress message of the builder
+                status_label = ttk.Label(progress_frame, text="", wraplength=230)
+                status_label.pack(pady=(10, 0))
+
+                # Function to show a builder message, scheduled on the main thread
+                def update_status(message):
+                    try:
+                        popup.after(0, lambda: status_label.configure(text=message))
+                    except tk.TclError:
+                        # The window was closed while the build was stopping
+                        pass
+
                 # Add Quit button
                 quit_button = ttk.Button(
                     progress_frame,
@@ -1205,6 +5118,14 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                             ),
                             running_flag=lambda: popup.running,
                             summary_text=summary_text,
+                            backend=backend_combobox.get(),
+                            partition_by_state=partition_state.get(),
+                            compression=compression_combobox.get(),
+                            sample_strata=sampling_designs[design_combobox.get()],
+                            balanced_panel=balanced_panel.get(),
+                            output_mode=output_mode_combobox.get().lower(),
+                            filter_expression=row_filter_var.get().strip() or None,
+                            update_status=update_status,
                         )
 
                         # After task completes, schedule the done button on the main thread
@@ -1283,20 +5204,47 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
         category_frame = ttk.Frame(content_frame)
         category_frame.pack(side="left", fill="y", padx=(0, 10))
 
-        # Create main frame for checkboxes
+        # Create main frame for the search box and variable list
         main_frame = ttk.Frame(content_frame)
         main_frame.pack(side="left", fill="both", expand=True)
 
-        # Create canvas and scrollbar
-        canvas = tk.Canvas(main_frame, width=400)
-        scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=canvas.yview)
-        scrollable_frame = ttk.Frame(canvas)
+        # Search box filtering variables across all categories
+        search_text = tk.StringVar()
+        search_frame = ttk.Frame(main_frame)
+        search_frame.pack(fill="x", pady=(0, 5))
+        ttk.Label(search_frame, text="Search:").pack(side="left", padx=(0, 5))
+        search_entry = ttk.Entry(search_frame, textvariable=search_text)
+        search_entry.pack(side="left", fill="x", expand=True)
+
+        # Status of the background variable profiler
+        profile_status = tk.StringVar(value="")
+        ttk.Label(main_frame, textvariable=profile_status).pack(anchor="w")
+
+        # Profile of the variable under the pointer
+        profile_details = tk.StringVar(value="")
+        ttk.Label(
+            main_frame, textvariable=profile_details, wraplength=520, justify="left"
+        ).pack(side="bottom", fill="x", pady=(5, 0))
+
+        # Only the visible rows get widgets, so the list is drawn on a plain frame
+        list_frame = tk.Frame(main_frame, width=400)
+        scrollbar = ttk.Scrollbar(main_frame, orient="vertical")
+        scrollbar.pack(side="right", fill="y")
+        list_frame.pack(side="left", fill="both", expand=True)
 
-        # Configure canvas
-        canvas.configure(yscrollcommand=scrollbar.set)
+        # Every variable of every category, with its search index
+        entries = [
+            (category, var)
+            for category in variables_dict.keys()
+            for var in variables_dict[category]
+        ]
+        search_index = VariableSearchIndex(entries)
+        category_entries = {category: [] for category in variables_dict.keys()}
+        for position, (category, var) in enumerate(entries):
+            category_entries[category].append(position)
 
-        # Dictionary to store checkbutton variables
-        self.var_dict = {category: {} for category in variables_dict.keys()}
+        # Sets storing the selected variables of each category
+        self.selected_vars = {category: set() for category in variables_dict.keys()}
 
         # Dictionary to store category buttons
         self.category_buttons = {}
@@ -1304,6 +5252,109 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
         # Current category tracker
         self.current_category = tk.StringVar(value=list(variables_dict.keys())[0])
 
+        # Summaries of the variables from the last profiler pass
+        profiles = summarize_variable_profiles(load_variable_profiles())
+
+        # Listed entry positions, first listed row and the pool of row widgets
+        row_height = 26
+        listing = {"positions": category_entries[self.current_category.get()], "first": 0}
+        rows = []
+
+        # Function to draw the listed variables onto the pool of rows
+        def render_rows():
+            positions = listing["positions"]
+            searching = bool(search_text.get().strip())
+            for row, (selected, chk) in enumerate(rows):
+                index = listing["first"] + row
+                if index < len(positions):
+                    category, var = entries[positions[index]]
+                    text = (
+                        f"{var}  ({button_display_names.get(category, category)})"
+                        if searching
+                        else var
+                    )
+                    summary = profiles.get(category, {}).get(var)
+                    if summary is not None:
+                        text += f"   {summary['non_null_rate']:.0%} non-null"
+                    chk.configure(text=text)
+                    selected.set(var in self.selected_vars[category])
+                    chk.place(x=0, y=row * row_height, relwidth=1, height=row_height)
+                else:
+                    chk.place_forget()
+
+            if positions and rows:
+                scrollbar.set(
+                    listing["first"] / len(positions),
+                    min(1, (listing["first"] + len(rows)) / len(positions)),
+                )
+            else:
+                scrollbar.set(0, 1)
+
+        # Function to move the list in response to the scrollbar or mousewheel
+        def scroll_rows(*args):
+            if args[0] == "moveto":
+                listing["first"] = int(float(args[1]) * len(listing["positions"]))
+            elif args[0] == "scroll":
+                step = int(args[1])
+                listing["first"] += step * max(1, len(rows)) if args[2] == "pages" else step
+            listing["first"] = max(
+                0, min(listing["first"], len(listing["positions"]) - len(rows))
+            )
+            render_rows()
+
+        scrollbar.configure(command=scroll_rows)
+
+        # Function to record a click on one of the rows
+        def toggle_row(row):
+            index = listing["first"] + row
+            if index < len(listing["positions"]):
+                category, var = entries[listing["positions"][index]]
+                if rows[row][0].get():
+                    self.selected_vars[category].add(var)
+                else:
+                    self.selected_vars[category].discard(var)
+
+        # Function to show the profile of the variable under the pointer
+        def show_row_profile(row):
+            index = listing["first"] + row
+            if index < len(listing["positions"]):
+                category, var = entries[listing["positions"][index]]
+                summary = profiles.get(category, {}).get(var)
+                profile_details.set(
+                    f"{var}: {describe_variable_profile(summary)}"
+                    if summary is not None
+                    else f"{var}: not profiled yet"
+                )
+
+        # Function to size the pool of rows to the visible height
+        def resize_rows(event):
+            count = max(1, event.height // row_height)
+            while len(rows) < count:
+                selected = tk.BooleanVar(value=False)
+                chk = ttk.Checkbutton(
+                    list_frame,
+                    variable=selected,
+                    command=lambda r=len(rows): toggle_row(r),
+                )
+                chk.bind("<Enter>", lambda e, r=len(rows): show_row_profile(r))
+                rows.append((selected, chk))
+            while len(rows) > count:
+                rows.pop()[1].destroy()
+            scroll_rows("scroll", 0, "units")
+
+        list_frame.bind("<Configure>", resize_rows)
+
+        # Function to list either the search matches or the current category
+        def refresh_listing(*args):
+            if search_text.get().strip():
+                listing["positions"] = search_index.search(search_text.get())
+            else:
+                listing["positions"] = category_entries[self.current_category.get()]
+            listing["first"] = 0
+            render_rows()
+
+        search_text.trace_add("write", refresh_listing)
+
         # Function to change the displayed variables based on the selection pyramid
         def show_category_variables(category):
             # Update button states
@@ -1313,22 +5364,11 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                 else:
                     btn.state(["!pressed"])  # Remove pressed state from other buttons
 
-            # Clear current checkboxes
-            for widget in scrollable_frame.winfo_children():
-                widget.destroy()
-
-            # Create checkboxes for selected category
-            for var in variables_dict[category]:
-                if var not in self.var_dict[category]:
-                    self.var_dict[category][var] = tk.BooleanVar(value=False)
-
-                chk = ttk.Checkbutton(
-                    scrollable_frame, text=var, variable=self.var_dict[category][var]
-                )
-                chk.pack(anchor="w", pady=2)
-
             self.current_category.set(category)
-            canvas.configure(scrollregion=canvas.bbox("all"))
+            if search_text.get():
+                search_text.set("")  # Clearing the search refreshes the list
+            else:
+                refresh_listing()
 
         # Create style for the buttons
         style = ttk.Style()
@@ -1350,18 +5390,18 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
             btn.pack(pady=5)
             self.category_buttons[category] = btn
 
-        # Show initial category
-        show_category_variables(list(variables_dict.keys())[0])
-
+        # Select and deselect act on the listed variables
         def select_all():
-            current = self.current_category.get()
-            for var in self.var_dict[current].values():
-                var.set(True)
+            for position in listing["positions"]:
+                category, var = entries[position]
+                self.selected_vars[category].add(var)
+            render_rows()
 
         def deselect_all():
-            current = self.current_category.get()
-            for var in self.var_dict[current].values():
-                var.set(False)
+            for position in listing["positions"]:
+                category, var = entries[position]
+                self.selected_vars[category].discard(var)
+            render_rows()
 
         def export_selected():
             # Create warning popup
@@ -1419,8 +5459,8 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                 for category in variables_dict.keys():
                     selected = [
                         var
-                        for var, bool_var in self.var_dict[category].items()
-                        if bool_var.get()
+                        for var in variables_dict[category]
+                        if var in self.selected_vars[category]
                     ]
                     # if selected:  # Only add category if there are selected variables
                     selected_vars[category] = selected
@@ -1452,36 +5492,49 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
                 )
             )
 
-        # Set up scrollable frame
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-
-        # Pack canvas and scrollbar
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
-
-        def on_frame_configure(event=None):
-            canvas.configure(scrollregion=canvas.bbox("all"))
-            canvas.itemconfig(frame_id, width=canvas.winfo_width())
-
-        # Create the window and store its id
-        frame_id = canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-
-        # Bind the frame to configure events
-        scrollable_frame.bind("<Configure>", on_frame_configure)
-        canvas.bind(
-            "<Configure>",
-            lambda e: canvas.itemconfig(frame_id, width=canvas.winfo_width()),
-        )
-
         # Configure mousewheel scrolling
         def on_mousewheel(event):
-            canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
+            scroll_rows("scroll", int(-1 * (event.delta / 120)), "units")
 
-        canvas.bind_all("<MouseWheel>", on_mousewheel)
+        list_frame.bind_all("<MouseWheel>", on_mousewheel)
 
         # Show initial category
         show_category_variables(list(variables_dict.keys())[0])
 
+        # Function to update the profiler status until the pass is finished
+        def poll_profiler():
+            if not list_frame.winfo_exists():
+                return
+            if self.profile_job is not None and self.profile_job.is_alive():
+                done, total = self.profile_progress
+                profile_status.set(f"Profiling variables: {done} of {total} files")
+                list_frame.after(1000, poll_profiler)
+            else:
+                profiles.clear()
+                profiles.update(summarize_variable_profiles(load_variable_profiles()))
+                profile_status.set(getattr(self.profile_job, "error", ""))
+                render_rows()
+
+        # Start the profiler in the background, unless a pass is already running
+        if config.get("DATA_DIRECTORY") and not (
+            self.profile_job is not None and self.profile_job.is_alive()
+        ):
+
+            def run_profiler():
+                try:
+                    variable_profiles_builder(
+                        config,
+                        lambda done, total: self.profile_progress.__setitem__(
+                            slice(None), [done, total]
+                        ),
+                    )
+                except Exception as e:
+                    threading.current_thread().error = f"Profiling failed: {str(e)}"
+
+            self.profile_job = threading.Thread(target=run_profiler, daemon=True)
+            self.profile_job.start()
+        poll_profiler()
+
         # Create selection control buttons in the same frame as back button
 
         export_btn = ttk.Button(
@@ -1635,6 +5688,61 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
             # Start the progress update
             warning_window.after(100, update_progress)
 
+        # Function to check the pyramid files in the background
+        def show_integrity_check():
+            popup = tk.Toplevel(self.root)
+            popup.title("Check Data")
+            popup.geometry("700x500")
+
+            # Status message
+            status = tk.StringVar(value="Checking pyramid files...")
+            ttk.Label(popup, textvariable=status, font=("Helvetica", 14)).pack(
+                anchor="w", padx=20, pady=(20, 10)
+            )
+
+            # Close button
+            ttk.Button(popup, text="Close", command=popup.destroy, width=15).pack(
+                side="bottom", pady=20
+            )
+
+            # Report text
+            report_box = tk.Text(popup, wrap="word", height=20)
+            report_box.pack(fill="both", expand=True, padx=20)
+
+            scan = {"progress": (0, 0), "report": None, "error": None}
+
+            def run_scan():
+                try:
+                    scan["report"] = integrity_scan(
+                        config,
+                        lambda done, total: scan.__setitem__("progress", (done, total)),
+                    )
+                except Exception as e:
+                    scan["error"] = str(e)
+
+            job = threading.Thread(target=run_scan, daemon=True)
+            job.start()
+
+            def poll_scan():
+                if not popup.winfo_exists():
+                    return
+                if job.is_alive():
+                    done, total = scan["progress"]
+                    status.set(f"Checking pyramid files: {done} of {total}")
+                    popup.after(500, poll_scan)
+                elif scan["error"] is not None:
+                    status.set(f"Check failed: {scan['error']}")
+                else:
+                    report_text = integrity_report_text(scan["report"])
+                    with open(resource_path("pyramid_integrity_report.txt"), "w") as f:
+                        f.write(report_text)
+                    problems = len(scan["report"]["problems"])
+                    status.set(f"{problems} problems found." if problems else "No problems found.")
+                    report_box.insert("1.0", report_text)
+                    report_box.configure(state="disabled")
+
+            poll_scan()
+
         # Define order and custom names for config keys
         config_display = [
             ("INITIALIZATION_DATE", "Configuration Date"),
@@ -1714,8 +5822,10 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
         def update_reinit_button():
             if data_dir.get().strip():  # Enable if there's a directory
                 reinit_button.configure(state="normal")
+                check_button.configure(state="normal")
             else:  # Disable if directory is empty
                 reinit_button.configure(state="disabled")
+                check_button.configure(state="disabled")
 
         # Browse button
         browse_button = ttk.Button(
@@ -1733,6 +5843,16 @@ Variable Selection: {"All Variables" if var_selection.get() == "all" else "Selec
         )
         reinit_button.pack(side="right", padx=5)
 
+        # Add the data check button, disabled like the reinit button
+        check_button = ttk.Button(
+            button_frame,
+            text="Check Data",
+            command=show_integrity_check,
+            width=15,
+            state="disabled" if not data_dir.get().strip() else "normal",
+        )
+        check_button.pack(side="right", padx=5)
+
         # Initial button state
         update_reinit_button()
 
@@ -1774,7 +5894,436 @@ def load_config():
         return 1
 
 
+# Version of the shard plan
+SHARD_PLAN_VERSION = "shard-plan-v1"
+
+# File names inside a plan directory
+SHARD_PLAN_FILE = "shard_plan.yaml"
+SHARD_SAMPLE_FILE = "sample_ids.csv"
+SHARD_VARIABLES_FILE = "variables.yaml"
+
+
+# This function fingerprints a file with SHA-256
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(INTEGRITY_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# This function splits months into contiguous shards of similar size
+def split_months(months, weights, shards):
+    cumulative = np.cumsum(np.asarray(weights, dtype="float64"))
+    total = cumulative[-1] if len(cumulative) else 0.0
+    cuts = [0]
+    for shard in range(1, shards):
+        cut = int(np.searchsorted(cumulative, total * shard / shards)) + 1
+        cuts.append(min(max(cut, cuts[-1] + 1), len(months) - (shards - shard)))
+    cuts.append(len(months))
+    return [months[start:end] for start, end in zip(cuts, cuts[1:])]
+
+
+# This function loads a shard plan and its fingerprint
+def load_shard_plan(plan_dir):
+    plan_path = Path(plan_dir).joinpath(SHARD_PLAN_FILE)
+    if not plan_path.exists():
+        print(f"Error: no shard plan found in {plan_dir}.", file=sys.stderr)
+        return None, None
+    plan_bytes = plan_path.read_bytes()
+    plan = yaml.safe_load(plan_bytes)
+    if plan.get("version") != SHARD_PLAN_VERSION:
+        print(f"Error: {plan_path} was written by another version of the program.", file=sys.stderr)
+        return None, None
+    return plan, hashlib.sha256(plan_bytes).hexdigest()
+
+
+# This function writes the summary of a shard plan
+def shard_plan_summary(plan):
+    summary_text = f"""Pyramid Build Summary (sharded)
+
+Data Directory: {plan["data_directory"]}
+Export Format: {plan["file_format"]}
+Compression: {plan["compression"]}
+File Size: {plan["file_size"]} GB
+Backend: {plan["backend"]}
+
+Date Range: {plan["start_date"]} to {plan["end_date"]}
+Shards: {len(plan["shards"])}
+
+Variable Selection: {"Selected Variables" if plan["variables"] else "All Variables"}"""
+    if plan["sample"]:
+        summary_text += f"\n\n{plan['sample']}"
+    return summary_text
+
+
+# This function writes the summary that opens the log of one shard
+def shard_summary(plan, shard):
+    return (
+        shard_plan_summary(plan)
+        + f"\n\nShard: {shard['shard']} of {len(plan['shards'])} ({shard['start_date']} to {shard['end_date']})"
+    )
+
+
+# This function plans a build as independent shards of contiguous months
+def shard_plan(args):
+    plan_dir = Path(args.plan_dir).resolve()
+    if plan_dir.joinpath(SHARD_PLAN_FILE).exists():
+        print(f"Error: {plan_dir} already holds a shard plan.", file=sys.stderr)
+        return 1
+    try:
+        start_month = datetime.strptime(args.start, "%m-%Y")
+        end_month = datetime.strptime(args.end, "%m-%Y")
+    except ValueError:
+        print("Error: dates must be given as MM-YYYY.", file=sys.stderr)
+        return 1
+    if start_month > end_month:
+        print("Error: the start date is after the end date.", file=sys.stderr)
+        return 1
+    if args.format == ".feather":
+        codecs = FEATHER_COMPRESSIONS
+    elif args.format == ".parquet":
+        codecs = ("none", "gzip", "zstd", "lz4")
+    else:
+        codecs = ("none", *COMPRESSION_EXTENSIONS)
+    if args.compression not in codecs:
+        print(f"Error: {args.format} output cannot be compressed with {args.compression}.", file=sys.stderr)
+        return 1
+
+    # Variable selection as either the selected list or all variables
+    selected_vars = None
+    pyramid_types = [
+        "ASPIRATIONAL_WAVES",
+        "CONSUMPTION_MONTHLY",
+        "CONSUMPTION_WAVES",
+        "HH_INC_MONTHLY",
+        "INDIV_INC_MONTHLY",
+        "PEOPLE_WAVES",
+    ]
+    if args.variables:
+        with open(args.variables, "r") as f:
+            selected_vars = yaml.safe_load(f)
+        pyramid_types = [
+            key
+            for key in selected_vars.keys()
+            if selected_vars[key] and key not in RESERVED_SELECTION_KEYS
+        ]
+        if selected_vars.get("AGGREGATION"):
+            print("Error: sharded builds write microdata, remove AGGREGATION from the selection.", file=sys.stderr)
+            return 1
+
+    # A month's weight is the size of the files it reads
+    months = []
+    month = start_month
+    while month <= end_month:
+        months.append(month.strftime("%Y-%m"))
+        month = add_month(month)
+    if args.shards < 1 or args.shards > len(months):
+        print(f"Error: the number of shards must be between 1 and the {len(months)} months of the build.", file=sys.stderr)
+        return 1
+    input_files = []
+    month_bytes = dict.fromkeys(months, 0)
+    for pyramid_type in pyramid_types:
+        for file in list_pyramid_files(Path(config["DATA_DIRECTORY"]).joinpath(config[pyramid_type + "_LOCATION"])):
+            file_months = [month for month in pyramid_file_months(file) if month in month_bytes]
+            if not file_months:
+                continue
+            stat = os.stat(file)
+            input_files.append({"path": str(file.resolve()), "size": stat.st_size, "mtime": stat.st_mtime_ns})
+            for month in file_months:
+                month_bytes[month] += stat.st_size
+
+    # The files are checked once here rather than by every shard
+    report = integrity_scan(config, pyramid_types=pyramid_types, start_month=start_month, end_month=end_month)
+    if report["problems"]:
+        print(f"Error: {len(report['problems'])} problems found in the pyramid files:", file=sys.stderr)
+        print("\n".join(report["problems"]), file=sys.stderr)
+        return 1
+
+    # The sample is drawn once and shared, so that every shard follows the same IDs
+    sample_ids_frame = None
+    sample_text = None
+    if args.households or args.individuals:
+        sample_type = "households" if args.households else "individuals"
+        sampled, eligible = draw_sample(
+            sample_type,
+            args.households or args.individuals,
+            args.seed,
+            args.start,
+            args.end,
+            args.strata,
+            args.balanced_panel,
+        )
+        if sampled is None:
+            print("Error: presence index not found. Please reinitialize the program.", file=sys.stderr)
+            return 1
+        if sample_type == "households":
+            sample_ids_frame = pd.DataFrame({"HH_ID": sampled})
+        else:
+            sample_ids_frame = pd.DataFrame({"HH_ID": sampled // 100, "MEM_ID": sampled % 100})
+        sample_text = (
+            f"Sample Observations: {sample_type.capitalize()}\n"
+            f"Sample Count: {args.households or args.individuals}\n"
+            f"Sampling Algorithm: {SAMPLING_ALGORITHM} (numpy {np.__version__})\n"
+            f"Sampling Seed: {args.seed}\n"
+            f"Sampling Design: "
+            + (f"stratified by {' and '.join(args.strata)}" if args.strata else "simple random")
+            + (", balanced panel" if args.balanced_panel else "")
+        )
+        if eligible is not None:
+            sample_text += f"\nBalanced Panel Eligible {sample_type.capitalize()}: {int(eligible.sum())}"
+    elif args.ids:
+        sample_ids_frame = pd.read_csv(args.ids)
+        if "HH_ID" not in sample_ids_frame.columns:
+            print("Error: the IDs file needs an HH_ID column.", file=sys.stderr)
+            return 1
+        sample_ids_frame = sample_ids_frame[[col for col in ["HH_ID", "MEM_ID"] if col in sample_ids_frame.columns]]
+        sample_text = f"Sample Type: Selected IDs\nIDs File: {Path(args.ids).resolve()}"
+
+    shards = [
+        {
+            "shard": shard,
+            "start_date": datetime.strptime(shard_months[0], "%Y-%m").strftime("%m-%Y"),
+            "end_date": datetime.strptime(shard_months[-1], "%Y-%m").strftime("%m-%Y"),
+            "raw_gb": round(sum(month_bytes[month] for month in shard_months) / 1024**3, 3),
+        }
+        for shard, shard_months in enumerate(
+            split_months(months, [month_bytes[month] for month in months], args.shards), start=1
+        )
+    ]
+    plan = {
+        "version": SHARD_PLAN_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "data_directory": str(Path(config["DATA_DIRECTORY"]).resolve()),
+        "start_date": args.start,
+        "end_date": args.end,
+        "file_format": args.format,
+        "compression": args.compression,
+        "file_size": args.file_size,
+        "backend": args.backend,
+        "random_seed": args.seed,
+        "variables": SHARD_VARIABLES_FILE if selected_vars else None,
+        "sample": sample_text,
+        "shards": shards,
+        "inputs": input_files,
+    }
+    plan_dir.mkdir(parents=True, exist_ok=True)
+    if selected_vars:
+        with open(plan_dir.joinpath(SHARD_VARIABLES_FILE), "w") as f:
+            yaml.dump(selected_vars, f, sort_keys=False)
+    if sample_ids_frame is not None:
+        sample_ids_frame.to_csv(plan_dir.joinpath(SHARD_SAMPLE_FILE), index=False)
+    # Writing the plan last
+    with open(plan_dir.joinpath(SHARD_PLAN_FILE), "w") as f:
+        yaml.dump(plan, f, sort_keys=False)
+    for shard in shards:
+        print(f"Shard {shard['shard']}: {shard['start_date']} to {shard['end_date']} (~{shard['raw_gb']} GB of raw files)")
+    return 0
+
+
+# This function builds one shard of a plan and records its parts in a manifest
+def shard_run(args):
+    plan_dir = Path(args.plan_dir).resolve()
+    plan, plan_hash = load_shard_plan(plan_dir)
+    if plan is None:
+        return 1
+    shard = next((shard for shard in plan["shards"] if shard["shard"] == args.shard), None)
+    if shard is None:
+        print(f"Error: the plan has no shard {args.shard}, shards are numbered 1 to {len(plan['shards'])}.", file=sys.stderr)
+        return 1
+    # Files changed after planning would make the shards disagree
+    changed = []
+    for input_file in plan["inputs"]:
+        try:
+            stat = os.stat(input_file["path"])
+        except OSError:
+            changed.append(input_file["path"])
+            continue
+        if stat.st_size != input_file["size"] or stat.st_mtime_ns != input_file["mtime"]:
+            changed.append(input_file["path"])
+    if changed:
+        print("Error: pyramid files changed since the plan was made:\n" + "\n".join(changed), file=sys.stderr)
+        return 1
+
+    config["DATA_DIRECTORY"] = plan["data_directory"]
+    # The plan step already checked the files
+    config["INTEGRITY_CHECK_BEFORE_BUILD"] = False
+    shard_dir = plan_dir.joinpath("shards", f"shard_{shard['shard']}")
+    manifest_path = plan_dir.joinpath("shards", f"shard_{shard['shard']}.yaml")
+    # A shard run again starts over
+    manifest_path.unlink(missing_ok=True)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    shard_dir.mkdir(parents=True)
+
+    sample = plan_dir.joinpath(SHARD_SAMPLE_FILE)
+    output_folder = pyramid_builder(
+        data_dir=plan["data_directory"],
+        output_dir=str(shard_dir),
+        file_format=plan["file_format"],
+        file_size=plan["file_size"],
+        random_seed=plan["random_seed"],
+        start_date=plan["start_date"],
+        end_date=plan["end_date"],
+        var_selection="selected" if plan["variables"] else "all",
+        selected_vars_location=str(plan_dir.joinpath(plan["variables"])) if plan["variables"] else None,
+        is_sample_enabled=sample.exists(),
+        sample_type="ids",
+        selected_ids_location=str(sample) if sample.exists() else None,
+        summary_text=shard_summary(plan, shard),
+        backend=plan["backend"],
+        compression=plan["compression"],
+        shard_dates=(shard["start_date"], shard["end_date"]),
+    )
+    if output_folder == 1:
+        return 1
+
+    parts = sorted(
+        Path(output_folder).glob("pyramid_part_*"),
+        key=lambda part: int(part.name.split(".")[0].split("_")[-1]),
+    )
+    manifest = {
+        "shard": shard["shard"],
+        "plan_sha256": plan_hash,
+        "start_date": shard["start_date"],
+        "end_date": shard["end_date"],
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "output_folder": str(Path(output_folder).relative_to(plan_dir)),
+        "parts": [
+            {
+                "file": str(part.relative_to(plan_dir)),
+                "size": part.stat().st_size,
+                "sha256": file_sha256(part),
+            }
+            for part in parts
+        ],
+    }
+    # The manifest is written last, so its presence marks a finished shard
+    with open(manifest_path, "w") as f:
+        yaml.dump(manifest, f, sort_keys=False)
+    print(f"Shard {shard['shard']} finished with {len(parts)} parts in {output_folder}")
+    return 0
+
+
+# This function links the parts of every shard into one output
+def shard_finalize(args):
+    plan_dir = Path(args.plan_dir).resolve()
+    plan, plan_hash = load_shard_plan(plan_dir)
+    if plan is None:
+        return 1
+    problems = []
+    manifests = []
+    for shard in plan["shards"]:
+        manifest_path = plan_dir.joinpath("shards", f"shard_{shard['shard']}.yaml")
+        if not manifest_path.exists():
+            problems.append(f"Shard {shard['shard']} has not finished")
+            continue
+        with open(manifest_path, "r") as f:
+            manifest = yaml.safe_load(f)
+        if manifest.get("plan_sha256") != plan_hash:
+            problems.append(f"Shard {shard['shard']} was built from a different plan")
+            continue
+        manifests.append(manifest)
+
+    # Function used to check that a part is still the file the shard wrote
+    def check_part(part):
+        path = plan_dir.joinpath(part["file"])
+        if not path.exists():
+            return f"{part['file']} is missing"
+        if path.stat().st_size != part["size"] or file_sha256(path) != part["sha256"]:
+            return f"{part['file']} changed after its shard finished"
+        return None
+
+    threads = config.get("INTEGRITY_THREADS") or min(4, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        problems += [
+            problem
+            for problem in executor.map(check_part, [part for manifest in manifests for part in manifest["parts"]])
+            if problem
+        ]
+    if problems:
+        print("Error: the shards cannot be finalized:\n" + "\n".join(problems), file=sys.stderr)
+        return 1
+
+    # Parts are numbered across the shards in month order
+    output_folder = plan_dir.joinpath("pyramids")
+    shutil.rmtree(output_folder, ignore_errors=True)
+    output_folder.mkdir()
+    file_counter = 1
+    for manifest in manifests:
+        for part in manifest["parts"]:
+            extension = Path(part["file"]).name.split(".", 1)[1]
+            link_or_copy(plan_dir.joinpath(part["file"]), output_folder.joinpath(f"pyramid_part_{file_counter}.{extension}"))
+            file_counter += 1
+
+    # The log keeps the notes of every shard after the plan's summary
+    with open(output_folder.joinpath("log.txt"), "w") as f:
+        f.write(shard_plan_summary(plan))
+        for shard, manifest in zip(plan["shards"], manifests):
+            shard_log = plan_dir.joinpath(manifest["output_folder"], "log.txt")
+            f.write(f"\n\n--- Shard {shard['shard']}: {shard['start_date']} to {shard['end_date']} ---")
+            f.write(f"\n\nFinished: {manifest['finished']}\nParts: {len(manifest['parts'])}")
+            if shard_log.exists():
+                # The shard's own summary repeats the plan's, only the notes after it are kept
+                f.write(shard_log.read_text().removeprefix(shard_summary(plan, shard)))
+    print(f"Finalized {file_counter - 1} parts from {len(manifests)} shards in {output_folder}")
+    return 0
+
+
+# This function runs the sharding commands
+def command_line(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="cpm.py",
+        description="Plan, run and finalize a pyramid build split into shards of contiguous months. Run without arguments to open the program.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="split a build into shards sharing one sample")
+    plan_parser.add_argument("plan_dir", help="directory for the plan, the shards and the finished build")
+    plan_parser.add_argument("--start", required=True, help="first month, MM-YYYY")
+    plan_parser.add_argument("--end", required=True, help="last month, MM-YYYY")
+    plan_parser.add_argument("--shards", type=int, required=True, help="number of shards")
+    plan_parser.add_argument("--variables", help="variable selection file, all variables when left out")
+    sample_group = plan_parser.add_mutually_exclusive_group()
+    sample_group.add_argument("--households", type=int, help="number of households to sample")
+    sample_group.add_argument("--individuals", type=int, help="number of individuals to sample")
+    sample_group.add_argument("--ids", help="csv of the HH_ID (and MEM_ID) to keep")
+    plan_parser.add_argument("--seed", type=int, default=RANDOM_SEED, help="random seed of the sample")
+    plan_parser.add_argument("--strata", nargs="+", choices=STRATA_VARIABLES, help="stratify the sample")
+    plan_parser.add_argument("--balanced-panel", action="store_true", help="only sample IDs surveyed in every wave")
+    plan_parser.add_argument("--format", default=".csv", choices=[".csv", ".dta", ".parquet", ".feather"])
+    plan_parser.add_argument("--compression", default="none", choices=["none", "gzip", "zstd", "lz4"])
+    plan_parser.add_argument("--file-size", type=float, default=1.0, help="size of each part in GB")
+    plan_parser.add_argument("--backend", default="pandas", choices=["pandas", "duckdb"])
+    plan_parser.set_defaults(function=shard_plan)
+
+    run_parser = commands.add_parser("run-shard", help="build one shard of a plan")
+    run_parser.add_argument("plan_dir")
+    run_parser.add_argument("--shard", type=int, required=True, help="shard number, from 1")
+    run_parser.set_defaults(function=shard_run)
+
+    finalize_parser = commands.add_parser("finalize", help="check the shards and number their parts as one build")
+    finalize_parser.add_argument("plan_dir")
+    finalize_parser.set_defaults(function=shard_finalize)
+
+    global config
+    args = parser.parse_args(argv)
+    with open(resource_path("config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    # Without a window, the builder's error dialogs are printed instead
+    showerror = messagebox.showerror
+    messagebox.showerror = lambda title, message, **kwargs: print(f"{title}: {message}", file=sys.stderr)
+    try:
+        return args.function(args)
+    finally:
+        messagebox.showerror = showerror
+
+
 if __name__ == "__main__":
+    # The sharding commands run without a window
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-psn_"):
+        sys.exit(command_line(sys.argv[1:]))
     if load_config():
         app = CPB_GUI()
         app.run()
@@ -0,0 +1,157 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+import cpm
+
+START, END = "01-2019", "06-2019"
+
+
+# Every test starts from the shipped config.yaml
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    with open(REPO_ROOT.joinpath("config.yaml"), "r") as f:
+        settings = yaml.safe_load(f)
+    monkeypatch.setattr(cpm, "config", settings, raising=False)
+    return settings
+
+
+# A small pyramid tree of six months and two waves, the working directory of the test
+@pytest.fixture
+def data_directory(tmp_path, monkeypatch, config):
+    rng = np.random.default_rng(0)
+    households = np.arange(10_000_001, 10_000_121)
+    members = rng.integers(1, 4, len(households))
+    states = rng.choice(["Goa", "Kerala"], len(households))
+
+    def write(pyramid_type, name, df):
+        directory = tmp_path.joinpath("data", config[pyramid_type + "_LOCATION"])
+        directory.mkdir(parents=True, exist_ok=True)
+        df.to_csv(directory.joinpath(name), index=False)
+
+    for month in pd.date_range("2019-01-01", "2019-06-01", freq="MS"):
+        present = households[rng.random(len(households)) < 0.9]
+        month_end = (month + pd.offsets.MonthEnd(0)).strftime("%Y%m%d")
+        month_name = month.strftime("%b %Y")
+        state = pd.Series(rng.choice(["Goa", "Kerala"], len(present)))
+        # A few households have no state
+        state[rng.random(len(present)) < 0.05] = None
+        write(
+            "CONSUMPTION_MONTHLY",
+            f"consumption_pyramids_{month_end}_MS_rev.csv",
+            pd.DataFrame(
+                {"HH_ID": present, "MONTH": month_name, "EXPENSE_ON_FOOD": rng.integers(0, 5_000, len(present))}
+            ),
+        )
+        write(
+            "HH_INC_MONTHLY",
+            f"household_income_{month_end}_MS_rev.csv",
+            pd.DataFrame(
+                {
+                    "HH_ID": present,
+                    "MONTH": month_name,
+                    "INCOME": np.round(rng.random(len(present)) * 10_000, 2),
+                    "STATE": state,
+                }
+            ),
+        )
+        member_households = np.repeat(present, members[np.searchsorted(households, present)])
+        write(
+            "INDIV_INC_MONTHLY",
+            f"member_income_{month_end}_MS_rev.csv",
+            pd.DataFrame(
+                {
+                    "HH_ID": member_households,
+                    "MEM_ID": pd.Series(member_households).groupby(member_households).cumcount() + 1,
+                    "MONTH": month_name,
+                    "WAGES": rng.integers(0, 20_000, len(member_households)),
+                }
+            ),
+        )
+    for wave, (wave_start, wave_end) in enumerate([("20190101", "20190430"), ("20190501", "20190831")], 1):
+        member_households = np.repeat(households, members)
+        write(
+            "PEOPLE_WAVES",
+            f"people_of_india_{wave_start}_{wave_end}_T.csv",
+            pd.DataFrame(
+                {
+                    "HH_ID": member_households,
+                    "MEM_ID": pd.Series(member_households).groupby(member_households).cumcount() + 1,
+                    "WAVE_NO": wave,
+                    "STATE": np.repeat(states, members),
+                    "REGION_TYPE": rng.choice(["URBAN", "RURAL"], len(member_households)),
+                    "AGE_YRS": rng.integers(0, 90, len(member_households)),
+                }
+            ),
+        )
+    config["DATA_DIRECTORY"] = str(tmp_path.joinpath("data"))
+    # The commands read config.yaml from the working directory
+    with open(tmp_path.joinpath("config.yaml"), "w") as f:
+        yaml.dump(config, f)
+    with open(tmp_path.joinpath("variables.yaml"), "w") as f:
+        yaml.dump({"CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"], "HH_INC_MONTHLY": ["INCOME", "STATE"]}, f)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+class Progress(dict):
+    def update(self):
+        pass
+
+
+# The test tree after a reinitialization, with its ID registry, presence index and file index
+@pytest.fixture
+def initialized_directory(data_directory, config):
+    assert cpm.reinitializer(config, Progress(value=0), Progress()) is None
+    return data_directory
+
+
+# Runs the Pyramid Builder on the test tree, the variables given as a dictionary of pyramid types
+@pytest.fixture
+def build(data_directory, config):
+    def run(name="build", variables=None, file_format=".csv", file_size="1", **kwargs):
+        selected_vars_location = "variables.yaml"
+        if variables is not None:
+            selected_vars_location = f"variables_{name}.yaml"
+            with open(data_directory.joinpath(selected_vars_location), "w") as f:
+                yaml.dump(variables, f)
+        arguments = dict(
+            data_dir=config["DATA_DIRECTORY"],
+            output_dir=str(data_directory.joinpath(name)),
+            file_format=file_format,
+            file_size=file_size,
+            random_seed=cpm.RANDOM_SEED,
+            start_date=START,
+            end_date=END,
+            var_selection="selected",
+            selected_vars_location=selected_vars_location,
+            is_sample_enabled=False,
+            sample_type="households",
+            selected_ids_location=None,
+            summary_text="",
+            update_status=lambda message: None,
+        )
+        arguments.update(kwargs)
+        output_folder = cpm.pyramid_builder(**arguments)
+        assert output_folder != 1
+        return Path(output_folder)
+
+    return run
+
+
+# Reads the CSV parts of a build in order
+def read_csv_parts(folder):
+    parts = sorted(Path(folder).glob("pyramid_part_*.csv"), key=lambda part: int(part.stem.split("_")[-1]))
+    return pd.concat([pd.read_csv(part) for part in parts], ignore_index=True)
+
+
+@pytest.fixture
+def read_parts():
+    return read_csv_parts
@@ -0,0 +1,42 @@
+import importlib.util
+
+import pandas as pd
+import pytest
+
+VARIABLES = {"CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"], "HH_INC_MONTHLY": ["INCOME", "STATE"]}
+
+BACKENDS = [
+    "pandas",
+    pytest.param("duckdb", marks=pytest.mark.skipif(importlib.util.find_spec("duckdb") is None, reason="needs duckdb")),
+]
+
+
+def aggregate_build(build, **kwargs):
+    variables = dict(VARIABLES, AGGREGATION={"GROUP_BY": ["STATE", "MONTH"], "VARIABLES": ["INCOME", "EXPENSE_ON_FOOD"]})
+    folder = build("aggregates", variables=variables, output_mode="aggregates", **kwargs)
+    return pd.read_csv(folder.joinpath("pyramid_aggregates.csv"))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_aggregates_match_a_groupby_of_the_microdata(build, read_parts, backend):
+    table = aggregate_build(build, backend=backend)
+    microdata = read_parts(build("microdata", variables=VARIABLES))
+    expected = microdata.groupby(["STATE", "MONTH"], dropna=False).agg(
+        N=("HH_ID", "size"),
+        INCOME_N=("INCOME", "count"),
+        INCOME_SUM=("INCOME", "sum"),
+        INCOME_MEAN=("INCOME", "mean"),
+        EXPENSE_ON_FOOD_SUM=("EXPENSE_ON_FOOD", "sum"),
+    )
+    actual = table.set_index(["STATE", "MONTH"])[expected.columns].sort_index()
+    pd.testing.assert_frame_equal(actual, expected.sort_index(), check_dtype=False)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_aggregate_months_are_in_calendar_order(build, backend):
+    table = aggregate_build(build, backend=backend)
+    for state, months in table.groupby("STATE", dropna=False)["MONTH"]:
+        assert months.tolist() == ["Jan 2019", "Feb 2019", "Mar 2019", "Apr 2019", "May 2019", "Jun 2019"]
+    # States keep their order, the missing state last
+    assert table["STATE"].drop_duplicates().tolist()[:2] == ["Goa", "Kerala"]
+    assert table["STATE"].isna().iloc[-1]
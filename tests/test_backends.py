@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("duckdb")
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+
+def output_files(folder):
+    return {
+        path.relative_to(folder).as_posix(): path.read_bytes()
+        for path in sorted(folder.rglob("*"))
+        if path.is_file() and path.name != "log.txt"
+    }
+
+
+@pytest.mark.parametrize("output_mode", ["microdata", "tables", "wide", "aggregates"])
+def test_duckdb_backend_matches_pandas(initialized_directory, build, output_mode):
+    pandas_files = output_files(build("pandas", variables=VARIABLES, output_mode=output_mode))
+    duckdb_files = output_files(build("duckdb", variables=VARIABLES, output_mode=output_mode, backend="duckdb"))
+    assert len(pandas_files) > 0
+    assert duckdb_files == pandas_files
+
+
+def test_duckdb_backend_matches_pandas_with_a_row_filter(initialized_directory, build):
+    filters = {"filter_expression": "INCOME > 2000 and REGION_TYPE == 'URBAN'"}
+    pandas_files = output_files(build("pandas", variables=VARIABLES, **filters))
+    duckdb_files = output_files(build("duckdb", variables=VARIABLES, backend="duckdb", **filters))
+    assert duckdb_files == pandas_files
+
+
+def test_duckdb_backend_matches_pandas_across_parts(initialized_directory, build, read_parts):
+    pandas_rows = read_parts(build("pandas", variables=VARIABLES, file_size="0.00002"))
+    duckdb_folder = build("duckdb", variables=VARIABLES, file_size="0.00002", backend="duckdb")
+    assert len(list(duckdb_folder.glob("pyramid_part_*.csv"))) > 1
+    assert read_parts(duckdb_folder).equals(pandas_rows)
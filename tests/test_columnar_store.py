@@ -0,0 +1,91 @@
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cpm
+
+pytest.importorskip("pyarrow")
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+BACKENDS = [
+    "pandas",
+    pytest.param("duckdb", marks=pytest.mark.skipif(importlib.util.find_spec("duckdb") is None, reason="needs duckdb")),
+]
+
+
+class Progress(dict):
+    def update(self):
+        pass
+
+
+@pytest.fixture
+def stored_file(tmp_path, monkeypatch, config):
+    # Households are out of order in the raw file
+    households = np.repeat(np.arange(400, 100, -3), 2)
+    df = pd.DataFrame(
+        {
+            "HH_ID": households,
+            "MEM_ID": np.tile([2, 1], len(households) // 2),
+            "INCOME": np.round(np.linspace(0.1, 9999.9, len(households)), 3),
+        }
+    )
+    directory = tmp_path.joinpath("data", config["INDIV_INC_MONTHLY_LOCATION"])
+    directory.mkdir(parents=True)
+    path = directory.joinpath("member_income_20190131_MS_rev.csv")
+    df.to_csv(path, index=False)
+    config["DATA_DIRECTORY"] = str(tmp_path.joinpath("data"))
+    config["COLUMNAR_STORE_DIRECTORY"] = str(tmp_path.joinpath("store"))
+    config["COLUMNAR_STORE_ROW_GROUP_ROWS"] = 20
+    monkeypatch.chdir(tmp_path)
+    cpm.write_columnar_store(path, cpm.columnar_store_path(path))
+    return path, df
+
+
+def test_columnar_store_reads_only_the_row_groups_of_the_households(stored_file):
+    path, df = stored_file
+    store_file = cpm.columnar_store_file(path)
+    assert store_file.metadata.num_row_groups == 10
+    read_groups = []
+    read_row_groups = store_file.read_row_groups
+
+    def record_row_groups(row_groups, **kwargs):
+        read_groups.append(row_groups)
+        return read_row_groups(row_groups, **kwargs)
+
+    store_file.read_row_groups = record_row_groups
+    households = np.array([109, 394])
+    pyramid = cpm.read_columnar_store(store_file, ["HH_ID", "MEM_ID", "INCOME"], households)
+    # The rows come back in the raw file's order
+    pd.testing.assert_frame_equal(pyramid, df[df["HH_ID"].isin(households)].reset_index(drop=True))
+    assert read_groups == [[0, 9]]
+
+
+def test_columnar_store_ignores_a_changed_raw_file(stored_file):
+    path, df = stored_file
+    assert cpm.pyramid_read_method(path, np.array([109])) == "columnar store"
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert cpm.columnar_store_file(path) is None
+    assert cpm.pyramid_read_method(path, np.array([109])) == "full scan"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_sampled_builds_through_the_columnar_store_match_the_raw_files(data_directory, build, config, tmp_path, backend):
+    config["COLUMNAR_STORE_DIRECTORY"] = str(tmp_path.joinpath("store"))
+    assert cpm.reinitializer(config, Progress(value=0), Progress()) is None
+    sampling = dict(is_sample_enabled=True, n_households=20, backend=backend)
+    stored = build("stored", variables=VARIABLES, **sampling)
+    assert "Pyramid File Reads (columnar store):" in stored.joinpath("log.txt").read_text()
+    config["COLUMNAR_STORE_DIRECTORY"] = None
+    raw = build("raw", variables=VARIABLES, **sampling)
+    assert "Pyramid File Reads (columnar store):" not in raw.joinpath("log.txt").read_text()
+    assert stored.joinpath("pyramid_part_1.csv").read_bytes() == raw.joinpath("pyramid_part_1.csv").read_bytes()
@@ -0,0 +1,98 @@
+import gzip
+import importlib.util
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+import cpm
+
+
+@pytest.mark.parametrize("codec,extension", [("gzip", ".csv.gz"), ("zstd", ".csv.zst")])
+def test_parallel_compressed_writer_round_trip(tmp_path, codec, extension):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    data = os.urandom(50_000) + b"HH_ID,MEM_ID\n" * 20_000
+    path = tmp_path.joinpath("part" + extension)
+    with cpm.ParallelCompressedWriter(path, codec, threads=4, block_size=7_000) as writer:
+        # Writes of uneven sizes cross the block boundaries
+        for start in range(0, len(data), 3_001):
+            writer.write(data[start : start + 3_001])
+    with cpm.open_pyramid_file(path) as f:
+        assert f.read() == data
+
+
+def test_parallel_compressed_writer_blocks_are_independent_members(tmp_path):
+    data = b"0123456789" * 10_000
+    path = tmp_path.joinpath("part.csv.gz")
+    with cpm.ParallelCompressedWriter(path, "gzip", threads=2, block_size=1_000) as writer:
+        writer.write(data)
+    assert gzip.decompress(path.read_bytes()) == data
+    assert path.read_bytes().count(b"\x1f\x8b\x08") >= len(data) // 1_000
+
+
+def test_parallel_compressed_writer_empty_file(tmp_path):
+    path = tmp_path.joinpath("part.csv.gz")
+    with cpm.ParallelCompressedWriter(path, "gzip", threads=2) as writer:
+        writer.write(b"")
+    assert gzip.decompress(path.read_bytes()) == b""
+
+
+def test_block_compressor_rejects_unknown_codec():
+    with pytest.raises(ValueError):
+        cpm.block_compressor("brotli")
+
+
+# This function replaces every raw pyramid file of the test tree with a compressed copy
+def compress_pyramid_files(data_directory, config):
+    import zstandard
+
+    for pyramid_type, extension in [
+        ("CONSUMPTION_MONTHLY", ".csv.gz"),
+        ("HH_INC_MONTHLY", ".csv.zst"),
+        ("INDIV_INC_MONTHLY", ".csv.zip"),
+        ("PEOPLE_WAVES", ".zip"),
+    ]:
+        for path in data_directory.joinpath("data", config[pyramid_type + "_LOCATION"]).glob("*.csv"):
+            compressed = path.with_name(path.stem + extension)
+            if extension == ".csv.gz":
+                compressed.write_bytes(gzip.compress(path.read_bytes()))
+            elif extension == ".csv.zst":
+                compressed.write_bytes(zstandard.ZstdCompressor().compress(path.read_bytes()))
+            else:
+                with zipfile.ZipFile(compressed, "w", zipfile.ZIP_DEFLATED) as archive:
+                    archive.write(path, path.name)
+            path.unlink()
+
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+BACKENDS = [
+    "pandas",
+    pytest.param("duckdb", marks=pytest.mark.skipif(importlib.util.find_spec("duckdb") is None, reason="needs duckdb")),
+]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_compressed_pyramid_files_build_like_plain_files(data_directory, build, read_parts, config, backend):
+    pytest.importorskip("zstandard")
+    plain = read_parts(build("plain", variables=VARIABLES))
+    compress_pyramid_files(data_directory, config)
+    assert not list(data_directory.joinpath("data").rglob("*.csv"))
+    compressed = read_parts(build("compressed", variables=VARIABLES, backend=backend))
+    pd.testing.assert_frame_equal(compressed, plain)
+
+
+def test_zip_archive_reads_the_csv_member(tmp_path):
+    path = tmp_path.joinpath("consumption_pyramids_20190131_MS_rev.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("readme.txt", "Not a pyramid")
+        archive.writestr("consumption_pyramids_20190131_MS_rev.csv", "HH_ID,EXPENSE_ON_FOOD\n1,2.5\n")
+    assert cpm.list_pyramid_files(tmp_path) == [path]
+    assert cpm.read_pyramid_csv(path).to_dict("list") == {"HH_ID": [1], "EXPENSE_ON_FOOD": [2.5]}
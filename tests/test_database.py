@@ -0,0 +1,40 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import cpm
+
+VARIABLES = {"PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"], "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"]}
+
+
+def test_sqlite_database_holds_the_same_rows_as_csv_parts(build, read_parts):
+    csv = read_parts(build("csv", variables=VARIABLES, file_size="0.00002"))
+    folder = build("sqlite", variables=VARIABLES, file_format=".sqlite")
+    with sqlite3.connect(folder.joinpath("pyramids.sqlite")) as con:
+        database = pd.read_sql_query("SELECT * FROM pyramids ORDER BY rowid", con)
+        indexes = {row[1] for row in con.execute("SELECT * FROM sqlite_master WHERE type = 'index'")}
+    # Every month is loaded on its own, and the duplicates are still dropped across months
+    assert len(database) == len(csv)
+    pd.testing.assert_frame_equal(database, csv, check_dtype=False)
+    assert indexes == {"pyramids_HH_ID", "pyramids_MEM_ID", "pyramids_MONTH"}
+
+
+def test_duckdb_database_holds_the_same_rows_as_csv_parts(build, read_parts):
+    duckdb = pytest.importorskip("duckdb")
+    csv = read_parts(build("csv", variables=VARIABLES))
+    folder = build("duckdb", variables=VARIABLES, file_format=".duckdb")
+    con = duckdb.connect(str(folder.joinpath("pyramids.duckdb")), read_only=True)
+    try:
+        database = con.execute("SELECT * FROM pyramids").df()
+    finally:
+        con.close()
+    pd.testing.assert_frame_equal(database, csv, check_dtype=False)
+
+
+def test_sqlite_values_turn_missing_values_into_nulls():
+    values = pd.Series([1, None], dtype="Int64")
+    assert cpm.sqlite_values(values) == [1, None]
+    assert cpm.sqlite_column_type(values.dtype) == "INTEGER"
+    assert cpm.sqlite_column_type(pd.Series([1.5]).dtype) == "REAL"
+    assert cpm.sqlite_column_type(pd.Series(["Goa"]).dtype) == "TEXT"
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+VARIABLES = {"HH_INC_MONTHLY": ["INCOME", "STATE"], "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"]}
+
+
+# Reads the Feather parts of a build in order
+def read_feather_parts(folder):
+    parts = sorted(folder.glob("pyramid_part_*.feather"), key=lambda part: int(part.stem.split("_")[-1]))
+    return pd.concat([pd.read_feather(part) for part in parts], ignore_index=True)
+
+
+@pytest.mark.parametrize("compression", [None, "zstd", "lz4"])
+def test_feather_parts_hold_the_same_rows_as_csv_parts(build, read_parts, compression):
+    csv = read_parts(build("csv", variables=VARIABLES))
+    folder = build("feather", variables=VARIABLES, file_format=".feather", file_size="0.00002", compression=compression)
+    # Compressed parts are sized from their compressed bytes, so fewer are written
+    if compression is None:
+        assert len(list(folder.glob("pyramid_part_*.feather"))) > 1
+    feather = read_feather_parts(folder)
+    pd.testing.assert_frame_equal(feather, csv, check_dtype=False)
+
+
+def test_feather_parts_keep_the_output_schema(build):
+    folder = build("feather", variables=VARIABLES, file_format=".feather", file_size="0.00002")
+    # Every part has the same columns and types, whole-number columns nullable
+    schemas = {tuple(pd.read_feather(part).dtypes.astype(str)) for part in folder.glob("pyramid_part_*.feather")}
+    assert len(schemas) == 1
+    assert read_feather_parts(folder)["AGE_YRS"].dtype == "Int64"
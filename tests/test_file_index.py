@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import cpm
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+
+def consumption_files(data_directory, config):
+    return sorted(data_directory.joinpath("data", config["CONSUMPTION_MONTHLY_LOCATION"]).glob("*.csv"))
+
+
+def test_file_has_households_reads_the_index(initialized_directory, config):
+    file_index = cpm.load_file_index()
+    path = consumption_files(initialized_directory, config)[0]
+    households = pd.read_csv(path)["HH_ID"].to_numpy("int64")
+    assert cpm.file_has_households(file_index, path, households[:1])
+    assert not cpm.file_has_households(file_index, path, np.array([1, 2], dtype="int64"))
+    # A file changed after indexing has to be read
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert cpm.file_has_households(file_index, path, np.array([1, 2], dtype="int64"))
+
+
+def test_files_without_sampled_households_are_skipped(initialized_directory, build, config):
+    # Households missing from January are sampled, so January's month files hold none of them
+    first, *later = [pd.read_csv(path)["HH_ID"] for path in consumption_files(initialized_directory, config)]
+    households = sorted(set(pd.concat(later)) - set(first))[:3]
+    assert households
+    pd.DataFrame({"HH_ID": households}).to_csv(initialized_directory.joinpath("ids.csv"), index=False)
+    sampling = dict(is_sample_enabled=True, sample_type="ids", selected_ids_location="ids.csv")
+    indexed = build("indexed", variables=VARIABLES, **sampling)
+    assert "Pyramid File Reads Skipped (no sampled households): 3" in indexed.joinpath("log.txt").read_text()
+    # Without the index every file is read, and the output is the same
+    initialized_directory.joinpath("pyramid_file_index.npz").unlink()
+    unindexed = build("unindexed", variables=VARIABLES, **sampling)
+    assert "Pyramid File Reads Skipped (no sampled households): 0" in unindexed.joinpath("log.txt").read_text()
+    assert indexed.joinpath("pyramid_part_1.csv").read_bytes() == unindexed.joinpath("pyramid_part_1.csv").read_bytes()
+    assert set(pd.read_csv(indexed.joinpath("pyramid_part_1.csv"))["HH_ID"]) == set(households)
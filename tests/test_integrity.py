@@ -0,0 +1,33 @@
+import cpm
+
+
+class Progress(dict):
+    def update(self):
+        pass
+
+
+def short_row(config, data_directory):
+    path = next(data_directory.joinpath("data", config["CONSUMPTION_MONTHLY_LOCATION"]).glob("*.csv"))
+    path.write_text(path.read_text() + "10000001,Jan 2019\n")
+    return path
+
+
+def test_reinitialization_reports_problems_and_continues(data_directory, config, monkeypatch):
+    path = short_row(config, data_directory)
+    shown = []
+    monkeypatch.setattr(cpm.messagebox, "showwarning", lambda title, message, **kwargs: shown.append(message))
+    assert cpm.reinitializer(config, Progress(value=0), Progress()) is None
+    assert path.name in shown[0]
+    assert path.name in data_directory.joinpath("pyramid_integrity_report.txt").read_text()
+    assert data_directory.joinpath("pyramid_ids.npz").exists()
+    assert config["TOTAL_HOUSEHOLDS"] == 120
+
+
+def test_reinitialization_stops_on_problems_when_asked(data_directory, config, monkeypatch):
+    short_row(config, data_directory)
+    shown = []
+    monkeypatch.setattr(cpm.messagebox, "showerror", lambda title, message, **kwargs: shown.append(message))
+    config["INTEGRITY_STOP_ON_PROBLEMS"] = True
+    assert cpm.reinitializer(config, Progress(value=0), Progress()) == 1
+    assert shown
+    assert not data_directory.joinpath("pyramid_ids.npz").exists()
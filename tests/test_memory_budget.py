@@ -0,0 +1,96 @@
+import pandas as pd
+import pytest
+
+import cpm
+
+# Wave rows of households missing from a month's consumption pyramid repeat in every month of the wave
+VARIABLES = {"PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"], "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"]}
+
+
+def test_duplicates_are_dropped_across_parts(build, read_parts):
+    single = read_parts(build("single", variables=VARIABLES))
+    parts = build("parts", variables=VARIABLES, file_size="0.00002")
+    assert len(list(parts.glob("pyramid_part_*.csv"))) > 1
+    assert not single.duplicated().any()
+    pd.testing.assert_frame_equal(read_parts(parts), single)
+    assert "Duplicate Rows Dropped:" in parts.joinpath("log.txt").read_text()
+
+
+@pytest.mark.parametrize("budget", [0.01, 0.15])
+def test_a_memory_budget_does_not_change_the_output(build, read_parts, config, budget):
+    unbudgeted = read_parts(build("unbudgeted", variables=VARIABLES))
+    config["MEMORY_BUDGET_GB"] = budget
+    budgeted = build("budgeted", variables=VARIABLES)
+    pd.testing.assert_frame_equal(read_parts(budgeted), unbudgeted)
+    assert "Early Flushes:" in budgeted.joinpath("log.txt").read_text()
+
+
+def test_exported_rows_spilled_to_disk_still_match(tmp_path):
+    rows = cpm.ExportedRows(str(tmp_path))
+    first = pd.DataFrame({"HH_ID": [1, 2, 3], "INCOME": [1.5, None, 2.0]})
+    rows.add(first)
+    rows.spill()
+    rows.add(pd.DataFrame({"HH_ID": [4], "INCOME": [3.0]}))
+    later = pd.DataFrame({"HH_ID": pd.array([2, 4, 5, 5], dtype="Int64"), "INCOME": [None, 3.0, 1.0, 1.0]})
+    assert rows.drop_seen(later)["HH_ID"].tolist() == [5]
+    assert rows.dropped == 3
+    assert len(list(tmp_path.glob("*.npy"))) == 4
+
+
+# A DuckDB connection that runs out of memory reading the raw files
+class OutOfMemoryConnection:
+    def __init__(self, con, duckdb):
+        self.con = con
+        self.duckdb = duckdb
+
+    def execute(self, query, *args):
+        if "month_rows AS" in query and "read_csv" in query:
+            raise self.duckdb.OutOfMemoryException("Out of Memory Error: could not allocate block")
+        return self.con.execute(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+
+@pytest.mark.parametrize("output_mode", ["microdata", "wide"])
+def test_duckdb_out_of_memory_falls_back_to_pandas(initialized_directory, build, monkeypatch, output_mode):
+    duckdb = pytest.importorskip("duckdb")
+    variables = dict(VARIABLES, HH_INC_MONTHLY=["INCOME", "STATE"])
+    expected = build("pandas", variables=variables, output_mode=output_mode)
+    connect = cpm.duckdb_connect
+    monkeypatch.setattr(cpm, "duckdb_connect", lambda *args: OutOfMemoryConnection(connect(*args), duckdb))
+    folder = build("duckdb", variables=variables, output_mode=output_mode, backend="duckdb")
+    for path in expected.glob("pyramid_*.csv"):
+        assert folder.joinpath(path.name).read_bytes() == path.read_bytes()
+    assert folder.joinpath("log.txt").read_text().count("which was merged with pandas") == 6
+
+
+@pytest.mark.parametrize("backend", ["pandas", "duckdb"])
+def test_small_budgets_build_on_both_backends(build, read_parts, config, backend):
+    if backend == "duckdb":
+        pytest.importorskip("duckdb")
+    unbudgeted = read_parts(build("unbudgeted", variables=VARIABLES))
+    config["MEMORY_BUDGET_GB"] = 0.01
+    budgeted = build("budgeted", variables=VARIABLES, backend=backend)
+    pd.testing.assert_frame_equal(read_parts(budgeted), unbudgeted)
+
+
+def test_duckdb_keeps_a_minimum_memory_limit(tmp_path, config):
+    pytest.importorskip("duckdb")
+    config["MEMORY_BUDGET_GB"] = 0.01
+    con = cpm.duckdb_connect(tmp_path)
+    try:
+        limit = con.execute("SELECT current_setting('memory_limit')").fetchone()[0]
+    finally:
+        con.close()
+    assert limit.startswith(("476", "500"))
+
+
+def test_merge_inputs_are_only_spilled_before_a_read_that_would_not_fit(build, config):
+    # Without headroom the first pyramid of each month is spilled before the second is read, the second never
+    config["MEMORY_BUDGET_GB"] = 0.01
+    log = build("tight", variables=VARIABLES, backend="pandas").joinpath("log.txt").read_text()
+    assert "Spilled Merge Inputs: 6" in log
+    config["MEMORY_BUDGET_GB"] = 1000
+    log = build("ample", variables=VARIABLES, backend="pandas").joinpath("log.txt").read_text()
+    assert "Spilled Merge Inputs" not in log
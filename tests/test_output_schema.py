@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+import cpm
+
+
+def schema():
+    return cpm.OutputSchema({"HH_ID": "int64", "INCOME": "int64", "STATE": None, "AGE": "float64"}, {"AGE", "STATE"})
+
+
+def test_wider_dtype_keeps_matching_types():
+    assert schema().wider_dtype("int64", pd.Series([1, 2], name="INCOME")) == "int64"
+    assert schema().wider_dtype("float64", pd.Series([1.5], name="AGE")) == "float64"
+
+
+def test_wider_dtype_widens_integers_to_floats():
+    assert schema().wider_dtype("int64", pd.Series([1.5, np.nan], name="INCOME")) == "float64"
+
+
+def test_wider_dtype_nullable_integers_are_floats():
+    # Integers of a column that can be missing are held as floats
+    assert schema().wider_dtype("float64", pd.Series([30, 40], name="AGE")) == "float64"
+
+
+def test_wider_dtype_keeps_nullable_integers_and_booleans():
+    output = cpm.OutputSchema({"WAGES": "Int64", "OWNS_HOUSE": "boolean"}, {"WAGES", "OWNS_HOUSE"})
+    # Merges leave integers with missing values as floats and booleans as objects
+    assert output.wider_dtype("Int64", pd.Series([1.0, np.nan], name="WAGES")) == "Int64"
+    assert output.wider_dtype("Int64", pd.Series([np.nan], name="WAGES")) == "Int64"
+    assert output.wider_dtype("Int64", pd.Series([1.5, np.nan], name="WAGES")) == "float64"
+    assert output.wider_dtype("boolean", pd.Series([True, np.nan], dtype=object, name="OWNS_HOUSE")) == "boolean"
+    assert output.wider_dtype("boolean", pd.Series([True, "yes"], dtype=object, name="OWNS_HOUSE")) == "object"
+
+
+def test_conform_writes_nullable_integers_as_integers():
+    output = cpm.OutputSchema({"HH_ID": "int64", "MEM_ID": "Int64"}, {"MEM_ID"})
+    df, widened = output.conform(pd.DataFrame({"HH_ID": [1, 2], "MEM_ID": [1.0, np.nan]}))
+    assert widened == []
+    assert df["MEM_ID"].dtype == "Int64"
+    assert df.to_csv(index=False) == "HH_ID,MEM_ID\n1,1\n2,\n"
+
+
+def test_wider_dtype_keeps_text_left_missing():
+    text = str(pd.Series(["Kerala"]).dtype)
+    assert schema().wider_dtype(text, pd.Series([np.nan, np.nan], name="STATE")) == text
+
+
+def test_wider_dtype_text_with_numbers_is_object():
+    text = str(pd.Series(["Kerala"]).dtype)
+    assert schema().wider_dtype(text, pd.Series([1.5, np.nan], name="STATE")) == "object"
+    assert schema().wider_dtype("bool", pd.Series([1.0], name="STATE")) == "object"
+    assert schema().wider_dtype("int64", pd.Series([True], name="INCOME")) == "object"
+
+
+def test_conform_fills_and_widens_columns():
+    output = schema()
+    df, widened = output.conform(pd.DataFrame({"HH_ID": [1, 2], "INCOME": [1.5, 2.0], "STATE": ["Goa", None]}))
+    assert list(df.columns) == ["HH_ID", "INCOME", "STATE", "AGE"]
+    assert widened == ["INCOME"]
+    assert output.dtypes["INCOME"] == "float64"
+    assert output.widened == {"INCOME"}
+    assert df["AGE"].dtype == "float64" and df["AGE"].isna().all()
+    # Columns first seen in this month take its type
+    assert output.dtypes["STATE"] == str(df["STATE"].dtype)
+    # A later month with whole numbers keeps the widened type
+    df, widened = output.conform(pd.DataFrame({"HH_ID": [3], "INCOME": [7], "STATE": [np.nan], "AGE": [40.0]}))
+    assert widened == []
+    assert df["INCOME"].dtype == "float64"
+
+
+def month_plans(config, data_directory, variables):
+    plans = []
+    for month_end in ["20190131", "20190228"]:
+        month_files = {}
+        for pyramid_type, columns in variables.items():
+            directory = data_directory.joinpath("data", config[pyramid_type + "_LOCATION"])
+            month_files[pyramid_type] = (next(directory.glob(f"*{month_end}*")), columns)
+        plans.append(month_files)
+    return plans
+
+
+def test_from_month_files_types_files_outside_the_catalog(data_directory, config):
+    plans = month_plans(
+        config,
+        data_directory,
+        {
+            "CONSUMPTION_MONTHLY": ["HH_ID", "MONTH", "EXPENSE_ON_FOOD"],
+            "HH_INC_MONTHLY": ["HH_ID", "MONTH", "INCOME", "STATE"],
+        },
+    )
+    output = cpm.OutputSchema.from_month_files(plans, None, {})
+    assert output.sniffed_files == 4
+    assert output.catalog_typed == len(output.dtypes) == 5
+    assert output.dtypes["HH_ID"] == "int64"
+    assert output.dtypes["INCOME"] == "float64"
+    assert output.dtypes["STATE"] == str(pd.Series(["Goa"]).dtype)
+    # Households missing from one of the pyramids leave the other's columns empty
+    assert output.nullable >= {"EXPENSE_ON_FOOD", "INCOME", "STATE"}
+    assert output.dtypes["EXPENSE_ON_FOOD"] == "Int64"
+    assert "HH_ID" not in output.nullable
+
+
+def test_sniffing_leaves_empty_columns_untyped(tmp_path):
+    path = tmp_path.joinpath("household_income_20190131_MS_rev.csv")
+    pd.DataFrame({"HH_ID": [1, 2], "INCOME": [np.nan, np.nan], "STATE": ["Goa", "Goa"]}).to_csv(path, index=False)
+    assert cpm.sniff_pyramid_dtypes(path, ["HH_ID", "INCOME"]) == {"HH_ID": "int64"}
+
+
+def test_from_month_files_keeps_member_ids_integers_in_mixed_months(data_directory, config):
+    plans = month_plans(
+        config,
+        data_directory,
+        {
+            "INDIV_INC_MONTHLY": ["HH_ID", "MEM_ID", "MONTH", "WAGES"],
+            "HH_INC_MONTHLY": ["HH_ID", "MONTH", "INCOME"],
+        },
+    )
+    output = cpm.OutputSchema.from_month_files(plans, None, {})
+    # Households without member rows leave MEM_ID missing
+    assert output.dtypes["MEM_ID"] == "Int64"
+    assert output.dtypes["WAGES"] == "Int64"
+    assert output.dtypes["HH_ID"] == "int64"
+    assert cpm.OutputSchema.from_month_files(plans, None, {}, merge_keys=["HH_ID", "MEM_ID"]).dtypes["MEM_ID"] == "int64"
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+import cpm
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+PART_GB = 0.00001
+
+
+@pytest.mark.parametrize(
+    "file_format,compression",
+    [(".csv", None), (".csv", "gzip"), (".parquet", None), (".parquet", "zstd"), (".dta", None)],
+)
+def test_parts_are_close_to_the_requested_size_on_disk(build, file_format, compression):
+    folder = build("parts", variables=VARIABLES, file_format=file_format, compression=compression, file_size=str(PART_GB))
+    parts = sorted(folder.glob("pyramid_part_*"), key=lambda part: int(part.name.split("_")[2].split(".")[0]))
+    assert len(parts) > 1
+    # Every part but the last is filled, whatever the format
+    for part in parts[:-1]:
+        assert 0.75 < part.stat().st_size / (PART_GB * 1024**3) < 1.35
+    assert parts[-1].stat().st_size < 1.35 * PART_GB * 1024**3
+
+
+def test_csv_parts_hold_the_rows_of_a_single_part(build, read_parts):
+    single = read_parts(build("single", variables=VARIABLES))
+    parts = build("parts", variables=VARIABLES, file_size=str(PART_GB))
+    pd.testing.assert_frame_equal(read_parts(parts), single)
+
+
+def test_size_estimator_recalibrates_from_written_parts(tmp_path):
+    estimator = cpm.OutputSizeEstimator(".csv", None, str(tmp_path.joinpath("calibration")), sample_rows=100)
+    df = pd.DataFrame({"HH_ID": range(1_000), "STATE": "Kerala"})
+    sample_bytes = estimator.bytes_per_row(df)
+    assert estimator.calibrated and sample_bytes > 0
+    # The sample export is removed
+    assert list(tmp_path.iterdir()) == []
+    part = tmp_path.joinpath("part.csv")
+    part.write_bytes(b"x" * 5_000)
+    estimator.record(100, part)
+    assert estimator.bytes_per_row(df) == 50
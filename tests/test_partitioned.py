@@ -0,0 +1,22 @@
+import pandas as pd
+
+
+def test_partitioned_dataset_reads_back_with_missing_states(build, read_parts):
+    folder = build("dataset", file_format=".parquet (partitioned)", partition_by_state=True)
+    dataset = pd.read_parquet(folder.joinpath("pyramid_dataset"))
+    microdata = read_parts(build("microdata"))
+    assert len(dataset) == len(microdata)
+    assert microdata["STATE"].isna().any()
+    assert (dataset["STATE"].astype(str) == "UNKNOWN").sum() == microdata["STATE"].isna().sum()
+    assert sorted(dataset["YEAR"].unique()) == [2019]
+    assert sorted(dataset["MONTH_NUM"].unique()) == [1, 2, 3, 4, 5, 6]
+
+
+def test_partitioned_dataset_prunes_partitions(build):
+    folder = build("dataset", file_format=".parquet (partitioned)", partition_by_state=True)
+    kerala = pd.read_parquet(
+        folder.joinpath("pyramid_dataset"), filters=[("STATE", "==", "Kerala"), ("MONTH_NUM", "==", 2)]
+    )
+    assert len(kerala) > 0
+    assert set(kerala["MONTH"]) == {"Feb 2019"}
+    assert folder.joinpath("pyramid_dataset", "_metadata").exists()
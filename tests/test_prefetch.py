@@ -0,0 +1,29 @@
+import pytest
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+
+def output_files(folder):
+    return {
+        path.relative_to(folder).as_posix(): path.read_bytes()
+        for path in sorted(folder.rglob("*"))
+        if path.is_file() and path.name != "log.txt"
+    }
+
+
+@pytest.mark.parametrize("prefetch_months", [1, 3])
+@pytest.mark.parametrize("sampled", [False, True], ids=["full", "sampled"])
+def test_prefetching_does_not_change_the_output(initialized_directory, build, config, prefetch_months, sampled):
+    sampling = dict(is_sample_enabled=True, n_households=40) if sampled else {}
+    config["PREFETCH_MONTHS"] = 0
+    expected = build("serial", variables=VARIABLES, file_size="0.00002", **sampling)
+    assert "Prefetched Months" not in expected.joinpath("log.txt").read_text()
+    config["PREFETCH_MONTHS"] = prefetch_months
+    folder = build("prefetched", variables=VARIABLES, file_size="0.00002", **sampling)
+    assert output_files(folder) == output_files(expected)
+    assert f"Prefetched Months: 5 (up to {prefetch_months} ahead" in folder.joinpath("log.txt").read_text()
@@ -0,0 +1,71 @@
+import os
+
+import cpm
+
+VARIABLES = {"CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"], "HH_INC_MONTHLY": ["INCOME", "STATE"]}
+
+
+def output_files(folder):
+    return {
+        path.relative_to(folder).as_posix(): path.read_bytes()
+        for path in sorted(folder.rglob("*"))
+        if path.is_file() and path.name != "log.txt"
+    }
+
+
+def test_an_identical_build_reuses_the_cached_output(build, config, tmp_path):
+    config["RESULT_CACHE_DIRECTORY"] = str(tmp_path.joinpath("cache"))
+    first = build("first", variables=VARIABLES)
+    assert "Result Cache: stored as" in first.joinpath("log.txt").read_text()
+    second = build("second", variables=VARIABLES)
+    assert "Result Cache: reused the cached build" in second.joinpath("log.txt").read_text()
+    assert output_files(second) == output_files(first)
+    # The reused files are copies, so editing them leaves the cache alone
+    second.joinpath("pyramid_part_1.csv").write_text("edited")
+    third = build("third", variables=VARIABLES)
+    assert output_files(third) == output_files(first)
+
+
+def test_a_changed_input_file_misses_the_cache(build, config, data_directory, tmp_path):
+    config["RESULT_CACHE_DIRECTORY"] = str(tmp_path.joinpath("cache"))
+    build("first", variables=VARIABLES)
+    path = next(data_directory.joinpath("data", config["CONSUMPTION_MONTHLY_LOCATION"]).glob("*.csv"))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    second = build("second", variables=VARIABLES)
+    assert "reused the cached build" not in second.joinpath("log.txt").read_text()
+    assert len([path for path in tmp_path.joinpath("cache").iterdir() if path.is_dir()]) == 2
+
+
+def test_the_least_recently_used_builds_are_evicted(tmp_path):
+    cache = tmp_path.joinpath("cache")
+    for age, key in enumerate(["newest", "middle", "oldest"]):
+        entry = cache.joinpath(key)
+        entry.mkdir(parents=True)
+        entry.joinpath("pyramid_part_1.csv").write_bytes(b"x" * 1_000)
+        os.utime(entry, (1_000_000 - age, 1_000_000 - age))
+    output_folder = tmp_path.joinpath("output")
+    output_folder.mkdir()
+    output_folder.joinpath("pyramid_part_1.csv").write_bytes(b"x" * 1_000)
+    output_folder.joinpath("log.txt").write_text("not cached")
+    problems = cpm.store_cached_result(cache, "build", output_folder, max_bytes=2_500)
+    assert problems == []
+    assert sorted(path.name for path in cache.iterdir() if path.is_dir()) == ["build", "newest"]
+    assert not cache.joinpath("build", "log.txt").exists()
+
+
+def test_entries_that_cannot_be_evicted_are_reported(tmp_path, monkeypatch):
+    cache = tmp_path.joinpath("cache")
+    cache.joinpath("old").mkdir(parents=True)
+    cache.joinpath("old", "pyramid_part_1.csv").write_bytes(b"x" * 1_000)
+    output_folder = tmp_path.joinpath("output")
+    output_folder.mkdir()
+    output_folder.joinpath("pyramid_part_1.csv").write_bytes(b"x" * 1_000)
+
+    def remove_cache_entry(path):
+        raise PermissionError("owned by another user")
+
+    monkeypatch.setattr(cpm, "remove_cache_entry", remove_cache_entry)
+    problems = cpm.store_cached_result(cache, "build", output_folder, max_bytes=1_500)
+    assert problems == ["could not evict old (owned by another user)"]
+    assert cache.joinpath("build").is_dir()
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cpm
+
+FRAME = pd.DataFrame(
+    {
+        "STATE": ["Kerala", "Goa", None, "Bihar", "Kerala"],
+        "AGE": [25.0, np.nan, 70.0, 40.0, 17.0],
+        "INCOME": [100, 200, 300, 400, 500],
+    }
+)
+
+
+def kept(expressions, df=FRAME):
+    return df.index[cpm.RowFilter(expressions).mask(df)].tolist()
+
+
+def test_row_filter_comparisons():
+    assert kept("STATE == 'Kerala'") == [0, 4]
+    assert kept("INCOME >= 300") == [2, 3, 4]
+    assert kept("300 < INCOME") == [3, 4]
+    assert kept("18 <= AGE < 65") == [0, 3]
+    assert kept("STATE in ['Goa', 'Bihar']") == [1, 3]
+    assert kept("INCOME > -1 and not INCOME == 200") == [0, 2, 3, 4]
+
+
+def test_row_filter_expressions_all_hold():
+    assert kept(["STATE == 'Kerala'", "AGE >= 18"]) == [0]
+    assert kept(["", "  "]) == [0, 1, 2, 3, 4]
+
+
+def test_row_filter_columns():
+    assert cpm.RowFilter(["STATE == 'Goa' or AGE > 3", "INCOME < 5"]).columns == {"STATE", "AGE", "INCOME"}
+
+
+def test_row_filter_missing_values_are_unknown():
+    # A missing value neither passes a comparison nor its negation
+    assert kept("AGE > 30") == [2, 3]
+    assert kept("not AGE > 30") == [0, 4]
+    assert kept("STATE != 'Kerala'") == [1, 3]
+    assert kept("STATE not in ['Goa']") == [0, 3, 4]
+    # Unknown or true is true, unknown and false is false
+    assert kept("AGE > 30 or INCOME == 200") == [1, 2, 3]
+    assert kept("not (AGE > 30 and INCOME == 200)") == [0, 2, 3, 4]
+    # Columns the rows lack are missing
+    assert kept("DISTRICT == 'Pune'") == []
+    assert kept("not DISTRICT == 'Pune'") == []
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "STATE",
+        "STATE == AGE",
+        "1 == 1",
+        "len(STATE) > 2",
+        "STATE == 'Goa' +",
+        "STATE in 'Goa'",
+        "AGE > -STATE",
+        "AGE is None",
+    ],
+)
+def test_row_filter_rejects_other_expressions(expression):
+    with pytest.raises(ValueError):
+        cpm.RowFilter(expression)
+
+
+def test_row_filter_matches_duckdb_and_arrow():
+    duckdb = pytest.importorskip("duckdb")
+    import pyarrow as pa
+
+    expressions = [
+        "AGE > 30 or INCOME == 200",
+        "not STATE in ['Goa']",
+        "STATE not in []",
+        "DISTRICT == 'Pune' or INCOME < 300",
+    ]
+    table = pa.Table.from_pandas(FRAME, preserve_index=False)
+    con = duckdb.connect()
+    con.register("frame", FRAME.reset_index())
+    for expression in expressions:
+        row_filter = cpm.RowFilter(expression)
+        expected = kept(expression)
+        sql = row_filter.sql(FRAME.columns)
+        assert con.execute(f"SELECT index FROM frame WHERE {sql} ORDER BY index").df()["index"].tolist() == expected
+        if row_filter.columns <= set(FRAME.columns):
+            filtered = table.filter(row_filter.arrow_expression())
+            assert filtered.column("INCOME").to_pylist() == FRAME["INCOME"][expected].tolist()
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cpm
+
+
+class Progress(dict):
+    def update(self):
+        pass
+
+
+@pytest.fixture
+def indexed_file(tmp_path, monkeypatch, config):
+    # Household 30 appears in two separate runs of rows
+    households = [10, 10, 20, 30, 30, 40, 50, 50, 50, 30, 60] + list(range(100, 400))
+    df = pd.DataFrame(
+        {
+            "HH_ID": households,
+            "MEM_ID": np.arange(len(households)) % 5 + 1,
+            "INCOME": np.round(np.linspace(0.1, 9999.9, len(households)), 3),
+            "STATE": ["Kerala", "Goa", "Bihar"] * (len(households) // 3) + ["Goa"] * (len(households) % 3),
+        }
+    )
+    directory = tmp_path.joinpath("data", config["INDIV_INC_MONTHLY_LOCATION"])
+    directory.mkdir(parents=True)
+    path = directory.joinpath("member_income_20190131_MS_rev.csv")
+    # The last row has no newline
+    path.write_text(df.to_csv(index=False).rstrip("\n"))
+    config["DATA_DIRECTORY"] = str(tmp_path.joinpath("data"))
+    config["ROW_INDEX"] = True
+    config["ROW_INDEX_MAX_FRACTION"] = 1.0
+    monkeypatch.chdir(tmp_path)
+    cpm.file_index_builder(config, Progress(value=0), Progress())
+    return path, df, cpm.load_file_index()
+
+
+def read_ranges(path, ranges):
+    entry, starts, ends = ranges
+    with open(path, "rb") as f:
+        return [(f.seek(start), f.read(end - start))[1] for start, end in zip(starts, ends)]
+
+
+def test_row_index_ranges_cover_the_households_rows(indexed_file):
+    path, df, file_index = indexed_file
+    households = np.array([10, 30, 60, 399])
+    entry, starts, ends = cpm.row_index_ranges(file_index, path, households)
+    assert np.all(starts[1:] > ends[:-1])
+    rows = b"".join(read_ranges(path, (entry, starts, ends))).decode().splitlines()
+    expected = df[df["HH_ID"].isin(households)].to_csv(index=False, header=False).splitlines()
+    assert rows == expected
+
+
+def test_row_index_ranges_merge_adjacent_ranges(indexed_file):
+    path, df, file_index = indexed_file
+    # Households 10 and 20 are next to each other in the file, 40 is further on
+    _, starts, ends = cpm.row_index_ranges(file_index, path, np.array([10, 20]))
+    assert len(starts) == len(ends) == 1
+    _, starts, _ = cpm.row_index_ranges(file_index, path, np.array([10, 20, 60]))
+    assert len(starts) == 2
+
+
+def test_row_index_ranges_missing_households(indexed_file):
+    path, df, file_index = indexed_file
+    _, starts, ends = cpm.row_index_ranges(file_index, path, np.array([1, 2, 3]))
+    assert len(starts) == len(ends) == 0
+
+
+def test_row_index_ranges_fall_back_to_a_full_scan(indexed_file, config):
+    path, df, file_index = indexed_file
+    assert cpm.row_index_ranges(file_index, path, None) is None
+    assert cpm.row_index_ranges({}, path, np.array([10])) is None
+    # Reading most of the file is left to a full scan
+    config["ROW_INDEX_MAX_FRACTION"] = 0.05
+    assert cpm.row_index_ranges(file_index, path, np.unique(df["HH_ID"])) is None
+    assert cpm.row_index_ranges(file_index, path, np.array([10])) is not None
+
+
+def test_row_index_ranges_ignore_changed_files(indexed_file):
+    path, df, file_index = indexed_file
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert cpm.row_index_ranges(file_index, path, np.array([10])) is None
+
+
+def test_read_pyramid_file_through_the_row_index(indexed_file):
+    path, df, file_index = indexed_file
+    households = np.array([30, 50, 399])
+    result = cpm.read_pyramid_file(path, ["HH_ID", "INCOME", "STATE"], households, file_index)
+    expected = cpm.read_pyramid_csv(path, usecols=["HH_ID", "INCOME", "STATE"])
+    expected = expected[expected["HH_ID"].isin(households)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected)
@@ -0,0 +1,77 @@
+import numpy as np
+
+import cpm
+
+REGISTRY = np.arange(1_000, 3_000, 7, dtype="int64")
+
+
+def test_sample_ids_is_deterministic():
+    first = cpm.sample_ids(REGISTRY, 50, 126)
+    second = cpm.sample_ids(REGISTRY.copy(), 50, 126)
+    np.testing.assert_array_equal(first, second)
+    assert not np.array_equal(first, cpm.sample_ids(REGISTRY, 50, 127))
+
+
+def test_sample_ids_is_pinned():
+    # Changing these draws needs a new SAMPLING_ALGORITHM version
+    registry = np.arange(100, 120)
+    assert cpm.sample_ids(registry, 5, 126).tolist() == [100, 102, 105, 111, 112]
+    assert cpm.sample_ids(registry, 6, 126, strata=np.arange(20) % 2).tolist() == [100, 102, 105, 109, 111, 112]
+
+
+def test_sample_ids_draws_sorted_unique_registry_ids():
+    sampled = cpm.sample_ids(REGISTRY, 80, 1)
+    assert len(sampled) == 80
+    assert np.all(np.diff(sampled) > 0)
+    assert np.isin(sampled, REGISTRY).all()
+
+
+def test_sample_ids_nested_samples():
+    # A larger sample with the same seed contains the smaller one
+    small = cpm.sample_ids(REGISTRY, 20, 5)
+    large = cpm.sample_ids(REGISTRY, 60, 5)
+    assert np.isin(small, large).all()
+
+
+def test_sample_ids_caps_at_registry_size():
+    np.testing.assert_array_equal(cpm.sample_ids(REGISTRY, len(REGISTRY) + 10, 3), REGISTRY)
+
+
+def test_sample_ids_only_draws_eligible_ids():
+    eligible = REGISTRY % 2 == 0
+    sampled = cpm.sample_ids(REGISTRY, 40, 9, eligible=eligible)
+    assert len(sampled) == 40
+    assert np.all(sampled % 2 == 0)
+    np.testing.assert_array_equal(cpm.sample_ids(REGISTRY, 10_000, 9, eligible=eligible), REGISTRY[eligible])
+
+
+def test_sample_ids_stratified():
+    strata = (np.arange(len(REGISTRY)) % 4 == 0).astype("int64")
+    sampled = cpm.sample_ids(REGISTRY, 100, 11, strata=strata)
+    sampled_strata = strata[np.searchsorted(REGISTRY, sampled)]
+    np.testing.assert_array_equal(
+        np.bincount(sampled_strata), cpm.proportional_allocation(np.bincount(strata), 100)
+    )
+
+
+def test_proportional_allocation_sums_to_n():
+    sizes = np.array([50, 30, 20, 7, 0, 1])
+    for n in [0, 1, 10, 33, 108]:
+        allocation = cpm.proportional_allocation(sizes, n)
+        assert allocation.sum() == n
+        assert np.all(allocation >= 0)
+        assert allocation[sizes == 0].sum() == 0
+
+
+def test_proportional_allocation_largest_remainders():
+    # Quotas of 3.5, 2.1 and 1.4 leave one draw for the largest remainder
+    np.testing.assert_array_equal(cpm.proportional_allocation(np.array([50, 30, 20]), 7), [4, 2, 1])
+    np.testing.assert_array_equal(cpm.proportional_allocation(np.array([1, 1, 1]), 2), [1, 1, 0])
+
+
+def test_proportional_allocation_exact_quotas():
+    np.testing.assert_array_equal(cpm.proportional_allocation(np.array([40, 60]), 10), [4, 6])
+
+
+def test_proportional_allocation_empty_strata():
+    np.testing.assert_array_equal(cpm.proportional_allocation(np.array([0, 0]), 5), [0, 0])
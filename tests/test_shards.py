@@ -0,0 +1,75 @@
+import pandas as pd
+import yaml
+
+import cpm
+
+START, END = "01-2019", "06-2019"
+
+
+def plan(directory, *arguments):
+    return cpm.command_line(
+        ["plan", str(directory.joinpath("plan")), "--start", START, "--end", END, "--variables", "variables.yaml"]
+        + list(arguments)
+    )
+
+
+def test_sharded_build_matches_a_single_build(data_directory, config, read_parts):
+    plan_dir = data_directory.joinpath("plan")
+    assert plan(data_directory, "--shards", "3", "--file-size", "0.00001") == 0
+    with open(plan_dir.joinpath(cpm.SHARD_PLAN_FILE), "r") as f:
+        shards = yaml.safe_load(f)["shards"]
+    assert shards[0]["start_date"] == START
+    assert shards[-1]["end_date"] == END
+    for shard in shards:
+        assert cpm.command_line(["run-shard", str(plan_dir), "--shard", str(shard["shard"])]) == 0
+    assert cpm.command_line(["finalize", str(plan_dir)]) == 0
+
+    output_folder = cpm.pyramid_builder(
+        data_dir=config["DATA_DIRECTORY"],
+        output_dir=str(data_directory.joinpath("single")),
+        file_format=".csv",
+        file_size="0.00001",
+        random_seed=cpm.RANDOM_SEED,
+        start_date=START,
+        end_date=END,
+        var_selection="selected",
+        selected_vars_location="variables.yaml",
+        is_sample_enabled=False,
+        sample_type="households",
+        selected_ids_location=None,
+        summary_text="",
+    )
+    sharded = read_parts(plan_dir.joinpath("pyramids"))
+    assert len(list(plan_dir.joinpath("pyramids").glob("pyramid_part_*.csv"))) > len(shards)
+    pd.testing.assert_frame_equal(sharded, read_parts(cpm.Path(output_folder)))
+    log = plan_dir.joinpath("pyramids", "log.txt").read_text()
+    assert all(f"--- Shard {shard['shard']}:" in log for shard in shards)
+
+
+def test_finalize_refuses_unfinished_or_changed_shards(data_directory):
+    plan_dir = data_directory.joinpath("plan")
+    assert plan(data_directory, "--shards", "2") == 0
+    assert cpm.command_line(["run-shard", str(plan_dir), "--shard", "1"]) == 0
+    assert cpm.command_line(["finalize", str(plan_dir)]) == 1
+    assert cpm.command_line(["run-shard", str(plan_dir), "--shard", "2"]) == 0
+    with open(plan_dir.joinpath("shards", "shard_2.yaml"), "r") as f:
+        part = plan_dir.joinpath(yaml.safe_load(f)["parts"][0]["file"])
+    part.write_text(part.read_text() + "\n")
+    assert cpm.command_line(["finalize", str(plan_dir)]) == 1
+    assert not plan_dir.joinpath("pyramids").exists()
+
+
+def test_split_months_is_contiguous_and_balanced():
+    months = [f"2019-{month:02d}" for month in range(1, 13)]
+    weights = [1] * 6 + [5] * 6
+    shards = cpm.split_months(months, weights, 4)
+    assert len(shards) == 4
+    assert [month for shard in shards for month in shard] == months
+    # The light months share a shard, the heavy ones are spread out
+    assert len(shards[0]) > len(shards[-1])
+
+
+def test_command_line_restores_the_error_dialog(data_directory):
+    showerror = cpm.messagebox.showerror
+    assert cpm.command_line(["run-shard", str(data_directory.joinpath("plan")), "--shard", "1"]) == 1
+    assert cpm.messagebox.showerror is showerror
@@ -0,0 +1,61 @@
+import re
+
+import pandas as pd
+
+import cpm
+
+
+def valid_stata_name(name):
+    return len(name) <= 32 and re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) is not None
+
+
+def test_stata_variable_names_keeps_valid_names():
+    assert cpm.stata_variable_names(["HH_ID", "MEM_ID", "AGE_YRS"]) == {
+        "HH_ID": "HH_ID",
+        "MEM_ID": "MEM_ID",
+        "AGE_YRS": "AGE_YRS",
+    }
+
+
+def test_stata_variable_names_replaces_invalid_characters():
+    names = cpm.stata_variable_names(["INCOME (RS)", "2019_WEIGHT"])
+    assert names["INCOME (RS)"] == "INCOME__RS_"
+    assert names["2019_WEIGHT"] == "_2019_WEIGHT"
+
+
+def test_stata_variable_names_resolves_collisions():
+    # All three clean to the same name
+    columns = ["A B", "A-B", "A_B"]
+    names = cpm.stata_variable_names(columns)
+    assert len(set(names.values())) == len(columns)
+    assert all(valid_stata_name(name) for name in names.values())
+    assert names["A B"] == "A_B"
+
+
+def test_stata_variable_names_shortens_long_names_uniquely():
+    prefix = "INCOME_OF_MEMBER_FROM_ALL_SOURCES_"
+    columns = [prefix + suffix for suffix in ["JAN", "FEB", "MAR"]] + [prefix[:32]]
+    names = cpm.stata_variable_names(columns)
+    assert len(set(names.values())) == len(columns)
+    assert all(valid_stata_name(name) for name in names.values())
+    # Names are derived from the columns alone, so every build renames alike
+    assert all(names[col] == cpm.stata_variable_names([col])[col] for col in columns)
+
+
+def test_write_stata_round_trip(tmp_path):
+    df = pd.DataFrame(
+        {
+            "HH_ID": [10000001, 10000002, 10000003],
+            "INCOME (RS)": [1.5, None, 3.25],
+            "STATE": ["Kerala", None, "Goa"],
+        }
+    )
+    names = cpm.stata_variable_names(df.columns)
+    path = tmp_path.joinpath("part.dta")
+    with open(path, "wb") as f:
+        cpm.write_stata(df, f, names)
+    result = pd.read_stata(path, convert_categoricals=True)
+    assert list(result.columns) == [names[col] for col in df.columns]
+    assert result["HH_ID"].tolist() == df["HH_ID"].tolist()
+    assert result["INCOME__RS_"].isna().tolist() == [False, True, False]
+    assert result["STATE"].astype(object).where(result["STATE"].notna(), None).tolist() == ["Kerala", None, "Goa"]
@@ -0,0 +1,58 @@
+import pandas as pd
+import yaml
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+
+# Reads every raw file of a pyramid type in the test tree
+def read_raw(data_directory, config, pyramid_type, columns):
+    directory = data_directory.joinpath("data", config[pyramid_type + "_LOCATION"])
+    return pd.concat([pd.read_csv(path, usecols=columns) for path in sorted(directory.glob("*.csv"))], ignore_index=True)
+
+
+# Reads the parts of a table listed in the manifest
+def read_table(folder, entry):
+    return pd.concat([pd.read_csv(folder.joinpath(file)) for file in entry["files"]], ignore_index=True)
+
+
+def test_tables_hold_one_row_per_key_as_listed_in_the_manifest(build):
+    folder = build("tables", variables=VARIABLES, output_mode="tables", file_size="0.00001")
+    manifest = yaml.safe_load(folder.joinpath("manifest.yaml").read_text())
+    assert list(manifest["tables"]) == ["household_month", "member_month", "member_wave"]
+    assert len(manifest["tables"]["member_month"]["files"]) > 1
+    for table, entry in manifest["tables"].items():
+        df = read_table(folder, entry)
+        assert list(df.columns) == list(entry["columns"])
+        assert len(df) == entry["rows"]
+        assert not df.duplicated(entry["keys"]).any()
+    # Joins only name tables that were written
+    for join in manifest["joins"]:
+        assert {join["from"], join["to"]} <= set(manifest["tables"])
+
+
+def test_tables_hold_the_rows_of_their_pyramids(build, data_directory, config):
+    folder = build("tables", variables=VARIABLES, output_mode="tables")
+    manifest = yaml.safe_load(folder.joinpath("manifest.yaml").read_text())
+    household_month = read_raw(data_directory, config, "CONSUMPTION_MONTHLY", ["HH_ID", "MONTH", "EXPENSE_ON_FOOD"]).merge(
+        read_raw(data_directory, config, "HH_INC_MONTHLY", ["HH_ID", "MONTH", "INCOME", "STATE"]),
+        on=["HH_ID", "MONTH"],
+        how="outer",
+    )
+    expected = {
+        "household_month": household_month,
+        "member_month": read_raw(data_directory, config, "INDIV_INC_MONTHLY", ["HH_ID", "MEM_ID", "MONTH", "WAGES"]),
+        # Wave files are read once, not once for every month they cover
+        "member_wave": read_raw(
+            data_directory, config, "PEOPLE_WAVES", ["HH_ID", "MEM_ID", "WAVE_NO", "REGION_TYPE", "AGE_YRS"]
+        ),
+    }
+    for table, rows in expected.items():
+        entry = manifest["tables"][table]
+        actual = read_table(folder, entry).sort_values(entry["keys"], ignore_index=True)
+        rows = rows[list(entry["columns"])].sort_values(entry["keys"], ignore_index=True)
+        pd.testing.assert_frame_equal(actual, rows, check_dtype=False)
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+VARIABLES = {
+    "CONSUMPTION_MONTHLY": ["EXPENSE_ON_FOOD"],
+    "HH_INC_MONTHLY": ["INCOME", "STATE"],
+    "INDIV_INC_MONTHLY": ["WAGES"],
+    "PEOPLE_WAVES": ["AGE_YRS", "REGION_TYPE"],
+}
+
+
+# Pivots the long microdata into one column per variable and month
+def pivot_microdata(microdata, ids):
+    # Wave rows of members missing from a month's pyramids have no month column to go in
+    microdata = microdata[microdata["MONTH"].notna()].drop(columns="WAVE_NO", errors="ignore")
+    month = pd.to_datetime(microdata["MONTH"], format="%b %Y").dt.strftime("%Y_%m")
+    wide = microdata.drop(columns="MONTH").assign(MONTH=month).pivot(index=ids, columns="MONTH")
+    wide.columns = [f"{variable}_{month}" for variable, month in wide.columns]
+    return wide.reset_index()
+
+
+@pytest.mark.parametrize(
+    "variables,ids",
+    [(VARIABLES, ["HH_ID", "MEM_ID"]), ({"HH_INC_MONTHLY": ["INCOME", "STATE"]}, ["HH_ID"])],
+    ids=["individuals", "households"],
+)
+def test_wide_panel_is_a_pivot_of_the_microdata(initialized_directory, build, read_parts, variables, ids):
+    microdata = read_parts(build("microdata", variables=variables))
+    folder = build("wide", variables=variables, output_mode="wide")
+    wide = pd.read_csv(folder.joinpath("pyramid_wide.csv"))
+    # One row per ID, the ID columns first
+    assert list(wide.columns[: len(ids)]) == ids
+    assert not wide.duplicated(ids).any()
+    expected = pivot_microdata(microdata, ids)
+    assert set(wide.columns) == set(expected.columns)
+    wide = wide.sort_values(ids, ignore_index=True)
+    expected = expected[wide.columns].sort_values(ids, ignore_index=True)
+    wave_columns = [col for col in wide.columns if col.startswith(tuple(variables.get("PEOPLE_WAVES", [])))]
+    month_columns = [col for col in wide.columns if col not in wave_columns]
+    pd.testing.assert_frame_equal(wide[month_columns], expected[month_columns], check_dtype=False)
+    # Wave variables also fill the months a member is missing from the month pyramids
+    pd.testing.assert_frame_equal(
+        wide[wave_columns].where(expected[wave_columns].notna()), expected[wave_columns], check_dtype=False
+    )
+    assert not wide[wave_columns].isna().any().any()